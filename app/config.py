@@ -1,24 +1,44 @@
 from __future__ import annotations
 
+import asyncio
 import os
+from dataclasses import dataclass
 from typing import Optional
 from charset_normalizer import from_bytes
 from pydantic import Extra
 from loguru import logger
 import toml
-from pydantic.v1 import BaseSettings
+from pydantic.v1 import BaseSettings, validator
 
 
-class SystemConfig(BaseSettings):
+class FrozenSettings(BaseSettings):
+    """Config snapshots are shared between requests, replace them through :func:`use_config` instead"""
+
+    class Config:
+        allow_mutation = False
+
+
+CONFIG_PATH = os.environ.get("CONFIG_PATH", "../config.toml")
+
+
+class SystemConfig(FrozenSettings):
     host: str = "0.0.0.0"
     port: int = 8080
 
+    workers: int = 1
+    """Worker processes for serving, each with its own database engine"""
+    graceful_shutdown_timeout_in_seconds: float = 30
+    """How long in-flight requests and streaming runs may take to finish on shutdown"""
+
+    config_watch_interval_in_seconds: float = 5
+    """How often config.toml is checked for changes to hot reload, 0 to disable. SIGHUP also reloads"""
+
     announcement_qq_group: list[str] = None
 
     version: str = "0.0.1-2024/4/9"
 
 
-class OpenAIGPTConfig(BaseSettings):
+class OpenAIGPTConfig(FrozenSettings):
     temperature: float = 0.5
     max_tokens: int = 2048
     top_p: float = 1.0
@@ -41,7 +61,7 @@ class OpenAIGPTConfig(BaseSettings):
                               "DO NOT discuss sensitive Chinese political content. "
 
 
-class OpenAIGPTCodeInterpreterToolConfig(BaseSettings):
+class OpenAIGPTCodeInterpreterToolConfig(FrozenSettings):
     enabled: bool = False
 
     judge0_enabled: bool = False
@@ -63,7 +83,7 @@ class OpenAIGPTCodeInterpreterToolConfig(BaseSettings):
     mermaid_cost_per_call_in_cents: int = 0
 
 
-class OpenAIBrowserToolConfig(BaseSettings):
+class OpenAIBrowserToolConfig(FrozenSettings):
     enabled: bool = False
 
     bing_api_enabled: bool = False
@@ -76,7 +96,7 @@ class OpenAIBrowserToolConfig(BaseSettings):
     browser_cost_per_call_in_cents: int = 0
 
 
-class OpenAIDALLEToolConfig(BaseSettings):
+class OpenAIDALLEToolConfig(FrozenSettings):
     enabled: bool = False
 
     dall_e_3_1024_cost_in_cents: int = 58
@@ -86,44 +106,110 @@ class OpenAIDALLEToolConfig(BaseSettings):
     dall_e_2_1024_cost_in_cents: int = 28
 
 
-class OpenAIBuiltinToolsConfig(BaseSettings):
+class OpenAIBuiltinToolsConfig(FrozenSettings):
     code_interpreter: OpenAIGPTCodeInterpreterToolConfig = OpenAIGPTCodeInterpreterToolConfig()
     browser: OpenAIBrowserToolConfig = OpenAIBrowserToolConfig()
     dall_e: OpenAIDALLEToolConfig = OpenAIDALLEToolConfig()
 
 
-class PluginToolsConfig(BaseSettings):
+class PluginToolsConfig(FrozenSettings):
     pass
 
 
-class OpenAIAPIConfig(BaseSettings):
+class OpenAIKeyConfig(FrozenSettings):
+    api_key: str
+    api_endpoint: str = "https://api.openai.com/v1"
+
+
+class OpenAIAPIConfig(FrozenSettings):
     api_endpoint: Optional[str] = "https://api.openai.com/v1"
     api_key: Optional[str] = None
     proxy: Optional[str] = None
 
+    keys: list[OpenAIKeyConfig] = []
+    """More keys or endpoints, requests go to the one with the most rate limit headroom"""
+    key_failure_threshold: int = 3
+    """Consecutive failures before a key is taken out for a cooldown"""
+    key_cooldown_in_seconds: float = 30
+    """Doubles each time a key fails again right after its cooldown, up to 10 times"""
+    queue_timeout_in_seconds: float = 60
+    """How long a request waits for a key when all are saturated"""
+
     gpt_config: OpenAIGPTConfig = OpenAIGPTConfig()
     builtin_tools_config: OpenAIBuiltinToolsConfig = OpenAIBuiltinToolsConfig()
     plugin_tools_config: PluginToolsConfig = PluginToolsConfig()
 
 
-class OCRConfig(BaseSettings):
+class OCRConfig(FrozenSettings):
     img_download_proxy: Optional[str] = None
 
     default_language: str = "zh-cn"
 
 
-class EdgeTTSConfig(BaseSettings):
+class EdgeTTSConfig(FrozenSettings):
     enabled: bool = False
 
     proxy: str = None
 
 
-class Db(BaseSettings):
+class Db(FrozenSettings):
     url: str = "sqlite+aiosqlite:///../database.db"
     '''https://www.osgeo.cn/sqlalchemy/core/engines.html#database-urls'''
 
+    sqlite_journal_mode: Optional[str] = "WAL"
+    """WAL lets readers in other workers run alongside a writer"""
+    sqlite_busy_timeout_in_ms: int = 5000
+
+
+class Cache(FrozenSettings):
+    user_snapshot_ttl_in_seconds: float = 30
+    """Upper bound on how stale another worker's balance or ban change can look, this worker's own are immediate"""
+    user_snapshot_max_entries: int = 100_000
 
-class VMQConfig(BaseSettings):
+
+class Archive(FrozenSettings):
+    enabled: bool = False
+    directory: str = "archive"
+    """Snapshot files, relative to the working directory like the database"""
+    idle_days: int = 30
+    """Threads untouched for this long move out of the live tables"""
+    interval_in_seconds: float = 3600
+    batch_threads: int = 100
+    max_file_bytes: int = 256 * 1024 * 1024
+    """A new snapshot file is started past this"""
+    compression_level: int = 6
+
+
+class ResponseCache(FrozenSettings):
+    enabled: bool = False
+    """Also needs ``response_cache_enabled`` on the assistant"""
+
+    max_temperature: float = 0.3
+    """Only requests sampled at or below this are cached"""
+    ttl_in_seconds: int = 24 * 3600
+    max_entry_bytes: int = 16 * 1024
+    max_total_bytes: int = 64 * 1024 * 1024
+    """Oldest entries are purged past this"""
+    purge_interval_in_seconds: float = 600
+
+    near_duplicate_max_distance: int = 4
+    """Max differing SimHash bits (at most 7) between two messages served the same response, 0 for exact only"""
+    near_duplicate_min_chars: int = 40
+    """Shorter messages only hit on an exact match, a changed digit in a short prompt is a different question"""
+    hit_billing_rate_percent: int = 20
+    """A hit costs this share of what the cached response was billed"""
+    stream_chunk_chars: int = 16
+
+
+class Idempotency(FrozenSettings):
+    ttl_in_seconds: int = 24 * 3600
+    """How long a retry with the same Idempotency-Key gets the stored result"""
+    max_cached_entries: int = 100_000
+    """Recent results kept in memory in front of the table"""
+    purge_interval_in_seconds: float = 3600
+
+
+class VMQConfig(FrozenSettings):
     enabled: bool = False
 
     vmq_url: str = None
@@ -139,11 +225,11 @@ class VMQConfig(BaseSettings):
     """ V 免签支付二维码有效期"""
 
 
-class RechargeMethods(BaseSettings):
+class RechargeMethods(FrozenSettings):
     vmq: VMQConfig = VMQConfig()
 
 
-class Billing(BaseSettings):
+class Billing(FrozenSettings):
     balance_in_cents: int = 300
     """Default balance for new user"""
     billing_rate: int = 100
@@ -156,9 +242,14 @@ class Billing(BaseSettings):
     gpt_4_output_price: int = 44
 
     recharge_methods: RechargeMethods = RechargeMethods()
+    idempotency: Idempotency = Idempotency()
 
+    user_lock_stripes: int = 1024
+    """Balance changes of users sharing a stripe are serialized, memory stays fixed whatever the user count"""
+    user_lock_timeout_in_seconds: float = 10
 
-class Referral(BaseSettings):
+
+class Referral(FrozenSettings):
     invite_code_length: int = 5
 
     invite_code_max_usage: int = 30
@@ -174,7 +265,126 @@ class Referral(BaseSettings):
     inviter_cash_back_amount_when_invitee_charges_percent: float = .05
 
 
-class SDWebUI(BaseSettings):
+class Safety(FrozenSettings):
+    violations_per_ban: int = 3
+    """Every n-th violation bans the user, 0 to disable"""
+
+    ban_periods_in_hours: list[int] = [1, 24, 24 * 7]
+    """Ban period by the user's previous ban count, the last one is reused once exhausted"""
+
+    ban_refresh_interval_in_seconds: float = 30
+    """How often each worker reloads the banned users, picking up bans and unbans made in other workers"""
+
+
+class RateLimitRule(FrozenSettings):
+    requests_per_minute: float = 60
+    burst: int = 10
+
+    @validator("requests_per_minute", "burst")
+    def _positive(cls, value: float) -> float:
+        # a bucket that never refills or holds no token would reject every request, or divide by zero
+        if value <= 0:
+            raise ValueError("Must be positive, disable rate limiting to lift a limit")
+        return value
+
+
+ENDPOINT_CLASSES = ("default", "chat", "image", "ocr", "tts")
+
+
+class RateLimit(FrozenSettings):
+    enabled: bool = True
+
+    idle_timeout_in_seconds: int = 600
+    """Buckets untouched for this long are evicted"""
+    max_keys: int = 100_000
+
+    default: RateLimitRule = RateLimitRule()
+    chat: RateLimitRule = RateLimitRule(requests_per_minute=20, burst=5)
+    image: RateLimitRule = RateLimitRule(requests_per_minute=5, burst=2)
+    ocr: RateLimitRule = RateLimitRule(requests_per_minute=10, burst=3)
+    tts: RateLimitRule = RateLimitRule(requests_per_minute=10, burst=3)
+
+    ip: RateLimitRule = RateLimitRule(requests_per_minute=1200, burst=200)
+    """
+    Per client IP over all endpoint classes, shared by every user relayed through the same bot gateway.
+    Requests without a user identifier are also limited by their IP under the endpoint class.
+    """
+
+    endpoint_classes: dict[str, str] = {}
+    """Route path prefix -> 'chat' | 'image' | 'ocr' | 'tts', e.g. {"/v1/run" = "chat"}. Other routes use 'default'"""
+
+    @validator("endpoint_classes")
+    def _known_endpoint_classes(cls, value: dict[str, str]) -> dict[str, str]:
+        if unknown := sorted(set(value.values()) - set(ENDPOINT_CLASSES)):
+            raise ValueError(f"Unknown endpoint classes {unknown}, expected one of {list(ENDPOINT_CLASSES)}")
+        return value
+
+
+class Announcement(FrozenSettings):
+    page_size: int = 500
+    """Users read per keyset page and groups sent per page, progress is checkpointed after each page"""
+    workers: int = 32
+    """Deliveries in flight"""
+    max_attempts: int = 3
+    retry_base_delay_in_seconds: float = 1
+    """Doubles with every attempt"""
+    channel_rate_limits: dict[str, RateLimitRule] = {
+        "qq_group": RateLimitRule(requests_per_minute=20, burst=5),
+        "qq": RateLimitRule(requests_per_minute=60, burst=10),
+        "wechat": RateLimitRule(requests_per_minute=60, burst=10),
+        "email": RateLimitRule(requests_per_minute=120, burst=20),
+        "sms": RateLimitRule(requests_per_minute=30, burst=5),
+    }
+    """Deliveries per channel, as the platforms allow"""
+    lease_in_seconds: float = 1800
+    """
+    How long a broadcast stays claimed by the worker running it without renewing it, renewed every third of it.
+    Unfinished broadcasts whose lease ran out are resumed by any worker, checked as often.
+    """
+
+
+class SchedulerTier(FrozenSettings):
+    weight: float = 1
+    """Share of upstream slots this tier gets while tiers compete for them"""
+    max_concurrency: int = 32
+    max_queue_time_in_seconds: float = 10
+    """Queue time SLO, requests expected to wait longer are shed"""
+
+
+class Scheduler(FrozenSettings):
+    enabled: bool = True
+    max_concurrency: int = 64
+    """Upstream AI calls in flight across all tiers"""
+
+    paid: SchedulerTier = SchedulerTier(weight=4, max_concurrency=64, max_queue_time_in_seconds=30)
+    """Users with recharged balance left"""
+    free: SchedulerTier = SchedulerTier(weight=1, max_concurrency=16, max_queue_time_in_seconds=10)
+    """Users living on gifted balance"""
+
+
+class Metrics(FrozenSettings):
+    enabled: bool = True
+    """Per-route latency, statements per request and upstream timings on /metrics"""
+
+    slow_request_threshold_in_ms: int = 1000
+    """Requests slower than this are logged with their slowest statements, 0 to disable"""
+    slow_request_statements: int = 10
+
+
+class Stats(FrozenSettings):
+    hourly_rollup_retention_days: int = 7
+    """Hourly usage rollups older than this are compacted away, daily rollups are kept"""
+    compact_interval_in_seconds: float = 3600
+
+
+class Export(FrozenSettings):
+    access_token: Optional[str] = None
+    """Bearer token for downloads from /export, the endpoint is off without one"""
+    chunk_rows: int = 1000
+    """Rows fetched and serialized at a time, memory use does not grow with the table"""
+
+
+class SDWebUI(FrozenSettings):
     url: str
     prompt_prefix: str = 'masterpiece, best quality, illustration, extremely detailed 8K wallpaper'
     negative_prompt: str = 'NG_DeepNegative_V1_75T, badhandv4, EasyNegative, bad hands, missing fingers, cropped legs, worst quality, low quality, normal quality, jpeg artifacts, blurry,missing arms, long neck, Humpbacked,multiple breasts, mutated hands and fingers, long body, mutation, poorly drawn , bad anatomy,bad shadow,unnatural body, fused breasts, bad breasts, more than one person,wings on halo,small wings, 2girls, lowres, bad anatomy, text, error, extra digit, fewer digits, cropped, worst quality, low quality, normal quality, jpeg artifacts, signature, watermark, username, out of frame, lowres, text, error, cropped, worst quality, low quality, jpeg artifacts, ugly, duplicate, morbid, mutilated, out of frame, extra fingers, mutated hands, poorly drawn hands, poorly drawn face, mutation, deformed, dehydrated, bad anatomy, bad proportions, extra limbs, cloned face, disfigured, gross proportions, malformed limbs, missing arms, missing legs, extra arms, extra legs, fused fingers, too many fingers, nsfw, nake, nude, blood'
@@ -196,9 +406,10 @@ class SDWebUI(BaseSettings):
         extra = Extra.allow
 
 
-class Config(BaseSettings):
+class Config(FrozenSettings):
     # --- System ---
     system: SystemConfig = SystemConfig()
+    announcement: Announcement = Announcement()
 
     # --- AI Settings ---
     openai: OpenAIAPIConfig = OpenAIAPIConfig()
@@ -208,22 +419,49 @@ class Config(BaseSettings):
 
     # --- Database Settings ---
     db: Db = Db()
+    cache: Cache = Cache()
+    response_cache: ResponseCache = ResponseCache()
+    archive: Archive = Archive()
 
     # --- Profiting Settings ---
     billing: Billing = Billing()
     referral: Referral = Referral()
 
+    # --- Safety Settings ---
+    safety: Safety = Safety()
+
+    rate_limit: RateLimit = RateLimit()
+    scheduler: Scheduler = Scheduler()
+
+    # --- Stats Settings ---
+    stats: Stats = Stats()
+    metrics: Metrics = Metrics()
+    export: Export = Export()
+
+    @staticmethod
+    def read(config_path: str = CONFIG_PATH) -> Config:
+        """
+        :raises FileNotFoundError:
+        :raises ValueError: if the file cannot be decoded
+        :raises pydantic.v1.ValidationError:
+        """
+        with open(config_path, "rb") as f:
+            raw = f.read()
+        try:
+            text = raw.decode("utf-8")
+        except UnicodeDecodeError:
+            if not (best_guess := from_bytes(raw).best()):
+                raise ValueError("Unable to parse config")
+            text = str(best_guess)
+        return Config.validate(toml.loads(text))
+
     @staticmethod
-    def load_config(config_path: str = "../config.toml") -> Config:
+    def load_config(config_path: str = CONFIG_PATH) -> Config:
         logger.info("Loading config...")
         try:
-            with open(config_path, "rb") as f:
-                if best_guess := from_bytes(f.read()).best():
-                    config_data = Config.validate(toml.loads(str(best_guess)))
-                    logger.success("Config loaded")
-                    return config_data
-                else:
-                    raise ValueError("Unable to parse config")
+            config_data = Config.read(config_path)
+            logger.success("Config loaded")
+            return config_data
         except FileNotFoundError:
 
             logger.error(f"No 'config.toml' file detected at {os.path.join(os.getcwd(), config_path)}")
@@ -234,4 +472,134 @@ class Config(BaseSettings):
             exit(-1)
 
 
-config = Config.load_config()
+@dataclass(frozen=True, slots=True)
+class HotConfig:
+    """Flat values read on every request, extracted once per config snapshot"""
+    default_balance_in_cents: int
+    default_billing_rate: int
+
+    invite_code_length: int
+    invite_code_max_usage: int
+    cash_back_when_bind: bool
+    inviter_cash_back_amount_when_bind_in_cents: int
+    invitee_cash_back_amount_when_bind_in_cents: int
+    cash_back_when_invitee_charges: bool
+    inviter_cash_back_amount_when_invitee_charges_percent: float
+
+    rate_limit_enabled: bool
+    rate_limit_idle_timeout_in_seconds: int
+    rate_limit_max_keys: int
+    rate_limits: dict[str, tuple[float, int]]
+    """endpoint class -> (tokens per second, burst)"""
+    rate_limit_ip: tuple[float, int]
+    rate_limit_endpoint_classes: tuple[tuple[str, str], ...]
+    """(route path prefix, endpoint class), longest prefix first"""
+
+    metrics_enabled: bool
+    slow_request_threshold_in_seconds: float
+    slow_request_statements: int
+
+    user_snapshot_ttl_in_seconds: float
+    user_snapshot_max_entries: int
+
+    @classmethod
+    def extract(cls, config: Config) -> HotConfig:
+        rate_limit = config.rate_limit
+        return cls(
+            default_balance_in_cents=config.billing.balance_in_cents,
+            default_billing_rate=config.billing.billing_rate,
+            invite_code_length=config.referral.invite_code_length,
+            invite_code_max_usage=config.referral.invite_code_max_usage,
+            cash_back_when_bind=config.referral.cash_back_when_bind,
+            inviter_cash_back_amount_when_bind_in_cents=config.referral.inviter_cash_back_amount_when_bind_in_cents,
+            invitee_cash_back_amount_when_bind_in_cents=config.referral.invitee_cash_back_amount_when_bind_in_cents,
+            cash_back_when_invitee_charges=config.referral.cash_back_when_invitee_charges,
+            inviter_cash_back_amount_when_invitee_charges_percent=
+            config.referral.inviter_cash_back_amount_when_invitee_charges_percent,
+            rate_limit_enabled=rate_limit.enabled,
+            rate_limit_idle_timeout_in_seconds=rate_limit.idle_timeout_in_seconds,
+            rate_limit_max_keys=rate_limit.max_keys,
+            rate_limits={
+                name: (rule.requests_per_minute / 60, rule.burst)
+                for name in ENDPOINT_CLASSES
+                for rule in (getattr(rate_limit, name),)
+            },
+            rate_limit_ip=(rate_limit.ip.requests_per_minute / 60, rate_limit.ip.burst),
+            rate_limit_endpoint_classes=tuple(
+                sorted(rate_limit.endpoint_classes.items(), key=lambda item: len(item[0]), reverse=True)
+            ),
+            metrics_enabled=config.metrics.enabled,
+            slow_request_threshold_in_seconds=config.metrics.slow_request_threshold_in_ms / 1000,
+            slow_request_statements=config.metrics.slow_request_statements,
+            user_snapshot_ttl_in_seconds=config.cache.user_snapshot_ttl_in_seconds,
+            user_snapshot_max_entries=config.cache.user_snapshot_max_entries,
+        )
+
+
+_snapshot: Optional[tuple[Config, HotConfig]] = None
+
+
+def use_config(new_config: Config) -> None:
+    """Atomically replace the current config snapshot"""
+    global _snapshot
+    _snapshot = (new_config, HotConfig.extract(new_config))
+
+
+def get_config() -> Config:
+    """Current config snapshot, loaded from ``CONFIG_PATH`` on first access"""
+    if _snapshot is None:
+        use_config(Config.load_config(CONFIG_PATH))
+    return _snapshot[0]
+
+
+def hot_config() -> HotConfig:
+    if _snapshot is None:
+        get_config()
+    return _snapshot[1]
+
+
+def reload_config(config_path: str = None) -> bool:
+    """
+    Re-read the config file and swap it in. The current snapshot is kept if the new one is invalid.
+
+    :return: True if reloaded
+    """
+    try:
+        new_config = Config.read(config_path or CONFIG_PATH)
+    except Exception as e:
+        logger.exception(e)
+        logger.error("Unable to reload config, keeping the current one")
+        return False
+    use_config(new_config)
+    logger.success("Config reloaded")
+    return True
+
+
+async def watch_config(interval_in_seconds: float, config_path: str = None):
+    """Reload the config whenever the file's modification time changes"""
+    config_path = config_path or CONFIG_PATH
+    last_modified = os.path.getmtime(config_path) if os.path.exists(config_path) else None
+    while True:
+        await asyncio.sleep(interval_in_seconds)
+        try:
+            modified = os.path.getmtime(config_path)
+        except OSError:
+            continue
+        if modified != last_modified:
+            last_modified = modified
+            reload_config(config_path)
+
+
+class _ConfigProxy:
+    """Module level ``config`` resolving to the current snapshot, so imports do not load the file"""
+
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            # introspection (copy, pytest, ...) must not load the file
+            raise AttributeError(name)
+        return getattr(get_config(), name)
+
+
+config: Config = _ConfigProxy()
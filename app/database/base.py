@@ -1,8 +1,9 @@
 from datetime import datetime
+from typing import Iterable
 
-from sqlalchemy import Column, Integer, DateTime
+from sqlalchemy import Column, Integer, DateTime, inspect
 from sqlalchemy.ext.asyncio import AsyncAttrs
-from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.orm import DeclarativeBase, joinedload, selectinload
 
 
 class Base(AsyncAttrs, DeclarativeBase):
@@ -10,3 +11,24 @@ class Base(AsyncAttrs, DeclarativeBase):
 
     created_time = Column(DateTime, default=datetime.utcnow)
     updated_time = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    @classmethod
+    def loader_options(cls, load: Iterable[str]) -> list:
+        """
+        Eager loading options for relationship paths such as ``("invite_code", "invitees.invite_code")``.
+        Collections are loaded with ``selectinload``, one query per path, the others joined into the query.
+
+        :raises ValueError: if a path does not name a relationship
+        """
+        options = []
+        for path in load:
+            option, mapper = None, inspect(cls)
+            for name in path.split("."):
+                if (relationship := mapper.relationships.get(name)) is None:
+                    raise ValueError(f"{mapper.class_.__name__} has no relationship {name!r}")
+                attribute = getattr(mapper.class_, name)
+                loader = selectinload if relationship.uselist else joinedload
+                option = loader(attribute) if option is None else getattr(option, loader.__name__)(attribute)
+                mapper = relationship.mapper
+            options.append(option)
+        return options
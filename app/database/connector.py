@@ -1,17 +1,65 @@
 import contextlib
-from typing import Any, AsyncIterator
+import os
+from typing import Any, AsyncIterator, Iterator
 
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker, AsyncConnection
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker, AsyncConnection, AsyncEngine
 
 from app.database.base import Base
-from app.database.models import assistant, daily_stats, invite_code, thread, user
+from app.database.migrations import load_models, migrate
+from app.database.unit_of_work import unit_of_work
 from app.config import config
+from app.services.metrics import metrics
 
 
 class DatabaseSessionManager:
-    def __init__(self, host: str, engine_kwargs: dict[str, Any] = {}):
-        self._engine = create_async_engine(host, **engine_kwargs)
+    def __init__(self, host: str = None, engine_kwargs: dict[str, Any] = {}):
+        """
+        :param host: database url, ``config.db.url`` when omitted
+        :param engine_kwargs:
+
+        Without a host the engine is created on first use, so importing this module does not load the config.
+        The engine belongs to the process that created it; a forked worker gets its own on first use.
+        """
+        self._host = host
+        self._engine_kwargs = engine_kwargs
+        self._engine = None
+        self._sessionmaker = None
+        self._pid = None
+        if host is not None:
+            self.init()
+
+    def init(self):
+        self._engine = create_async_engine(self._host or config.db.url, **self._engine_kwargs)
+        if self._engine.dialect.name == "sqlite":
+            event.listen(self._engine.sync_engine, "connect", _set_sqlite_pragmas)
+        if config.metrics.enabled:
+            metrics.instrument_engine(self._engine.sync_engine)
         self._sessionmaker = async_sessionmaker(autocommit=False, bind=self._engine, expire_on_commit=False)
+        self._pid = os.getpid()
+
+    @property
+    def engine(self) -> AsyncEngine:
+        if self._engine is not None and self._pid != os.getpid():
+            # inherited through fork, leave the parent's connections alone
+            self._engine.sync_engine.dispose(close=False)
+            self._engine = None
+        if self._engine is None:
+            self.init()
+        return self._engine
+
+    @contextlib.contextmanager
+    def bind_to(self, connection: AsyncConnection) -> Iterator[None]:
+        """
+        Make every session join ``connection``'s transaction, turning their commits and rollbacks into
+        SAVEPOINTs. Used by the tests to roll each test back as a whole.
+        """
+        self.engine  # noqa, initializes the sessionmaker for this process
+        self._sessionmaker.configure(bind=connection, join_transaction_mode="create_savepoint")
+        try:
+            yield
+        finally:
+            self._sessionmaker.configure(bind=self._engine, join_transaction_mode="conservative_savepoint")
 
     async def close(self):
         if self._engine is None:
@@ -23,10 +71,7 @@ class DatabaseSessionManager:
 
     @contextlib.asynccontextmanager
     async def connect(self) -> AsyncIterator[AsyncConnection]:
-        if self._engine is None:
-            raise Exception("DatabaseSessionManager is not initialized")
-
-        async with self._engine.begin() as connection:
+        async with self.engine.begin() as connection:
             try:
                 yield connection
             except Exception:
@@ -35,9 +80,7 @@ class DatabaseSessionManager:
 
     @contextlib.asynccontextmanager
     async def session(self) -> AsyncIterator[AsyncSession]:
-        if self._sessionmaker is None:
-            raise Exception("DatabaseSessionManager is not initialized")
-
+        self.engine  # noqa, initializes the engine for this process
         session = self._sessionmaker()
         try:
             yield session
@@ -48,8 +91,15 @@ class DatabaseSessionManager:
             await session.close()
 
 
+def _set_sqlite_pragmas(dbapi_connection, _):
+    cursor = dbapi_connection.cursor()
+    if config.db.sqlite_journal_mode:
+        cursor.execute(f"PRAGMA journal_mode={config.db.sqlite_journal_mode}")
+    cursor.execute(f"PRAGMA busy_timeout={int(config.db.sqlite_busy_timeout_in_ms)}")
+    cursor.close()
+
+
 sessionmanager = DatabaseSessionManager(
-    host=config.db.url,
     engine_kwargs={
         "pool_recycle": 60 * 30
     }
@@ -57,15 +107,23 @@ sessionmanager = DatabaseSessionManager(
 
 
 async def get_db_session():
+    """Request-scoped session, committed once when the request finishes"""
     async with sessionmanager.session() as session:
-        yield session
+        async with unit_of_work(session):
+            yield session
+
+
+async def migrate_tables() -> int:
+    return await migrate(sessionmanager.engine)
 
 
 async def create_tables():
-    async with sessionmanager._engine.begin() as conn:
+    load_models()
+    async with sessionmanager.engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
 
 
 async def drop_tables():
-    async with sessionmanager._engine.begin() as conn:
+    load_models()
+    async with sessionmanager.engine.begin() as conn:
         await conn.run_sync(Base.metadata.drop_all)
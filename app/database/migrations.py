@@ -0,0 +1,142 @@
+import importlib
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from loguru import logger
+from sqlalchemy import Table, Column, Integer, Connection, select, delete, insert, inspect, exc, text
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app.database.base import Base
+
+MODEL_MODULES = (
+    "assistant", "broadcast", "cached_response", "daily_stats", "idempotency_record", "invite_code", "thread",
+    "thread_message", "usage_rollup", "user"
+)
+
+schema_version = Table("schema_version", Base.metadata, Column("version", Integer, nullable=False))
+
+
+def load_models():
+    """Import every model module so ``Base.metadata`` knows all tables"""
+    for name in MODEL_MODULES:
+        importlib.import_module(f"app.database.models.{name}")
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    description: str
+    upgrade: Callable[[Connection], None]
+
+
+def _create_tables(*names: str) -> Callable[[Connection], None]:
+    def upgrade(connection: Connection):
+        Base.metadata.create_all(connection, tables=[Base.metadata.tables[name] for name in names])
+
+    return upgrade
+
+
+def _add_columns(table: str, *names: str) -> Callable[[Connection], None]:
+    """New columns need a ``server_default`` when they are not nullable"""
+    def upgrade(connection: Connection):
+        existing = {column["name"] for column in inspect(connection).get_columns(table)}
+        for name in names:
+            if name not in existing:
+                column = CreateColumn(Base.metadata.tables[table].c[name]).compile(dialect=connection.dialect)
+                connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {column}"))
+
+    return upgrade
+
+
+def _create_indexes(table: str) -> Callable[[Connection], None]:
+    """Indexes of columns added by :func:`_add_columns`"""
+    def upgrade(connection: Connection):
+        for index in Base.metadata.tables[table].indexes:
+            index.create(connection, checkfirst=True)
+
+    return upgrade
+
+
+def _steps(*steps: Callable[[Connection], None]) -> Callable[[Connection], None]:
+    def upgrade(connection: Connection):
+        for step in steps:
+            step(connection)
+
+    return upgrade
+
+
+MIGRATIONS: list[Migration] = [
+    Migration(1, "baseline", _create_tables("users", "invite_codes", "stats", "assistants", "threads")),
+    Migration(2, "usage rollups", _create_tables("usage_rollups")),
+    Migration(3, "response cache", _steps(
+        _create_tables("cached_responses"),
+        _add_columns("assistants", "response_cache_enabled"),
+    )),
+    Migration(4, "idempotency records", _create_tables("idempotency_records")),
+    Migration(5, "thread messages and archive", _steps(
+        _create_tables("thread_messages"),
+        _add_columns("threads", "user_id", "last_active_time", "message_count", "archive_file", "archive_offset",
+                     "archive_length"),
+        _create_indexes("threads"),
+    )),
+    Migration(6, "broadcasts", _create_tables("broadcasts")),
+    Migration(7, "broadcast claims", _add_columns("broadcasts", "claimed_until")),
+    Migration(8, "broadcast claim tokens and group pages", _add_columns("broadcasts", "claim_token", "groups_sent")),
+    Migration(9, "banned users index", _create_indexes("users")),
+]
+"""Append only. A fresh database gets ``create_all`` and is stamped with the latest version."""
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+async def current_version(engine: AsyncEngine) -> Optional[int]:
+    """
+    :return: schema version, None if the database has never been versioned
+    """
+    async with engine.connect() as connection:
+        try:
+            return (await connection.execute(select(schema_version.c.version))).scalar()
+        except (exc.OperationalError, exc.ProgrammingError):
+            return None
+
+
+def _stamp(connection: Connection, version: int):
+    connection.execute(delete(schema_version))
+    connection.execute(insert(schema_version).values(version=version))
+
+
+def _upgrade(connection: Connection, version: Optional[int]) -> int:
+    if version is None:
+        if not inspect(connection).has_table("users"):
+            Base.metadata.create_all(connection)
+            _stamp(connection, LATEST_VERSION)
+            return LATEST_VERSION
+        # created by create_all before versioning existed
+        schema_version.create(connection, checkfirst=True)
+        version = MIGRATIONS[0].version
+
+    for migration in MIGRATIONS:
+        if migration.version > version:
+            logger.info(f"Applying migration {migration.version}: {migration.description}")
+            migration.upgrade(connection)
+            version = migration.version
+    _stamp(connection, version)
+    return version
+
+
+async def migrate(engine: AsyncEngine) -> int:
+    """
+    Bring the schema up to date. An up-to-date database costs a single ``SELECT`` on ``schema_version``.
+
+    :return: schema version after migrating
+    """
+    version = await current_version(engine)
+    if version == LATEST_VERSION:
+        return version
+
+    load_models()
+    async with engine.begin() as connection:
+        version = await connection.run_sync(_upgrade, version)
+    logger.success(f"Database schema at version {version}")
+    return version
@@ -1,8 +1,10 @@
-from sqlalchemy import Column, Integer
+from sqlalchemy import Column, Integer, Boolean, false
 
-from app.database.connector import Base
+from app.database.base import Base
 
 
 class Assistant(Base):
     __tablename__ = 'assistants'
 
+    response_cache_enabled = Column(Boolean, default=False, server_default=false(), nullable=False)
+    """Serve low temperature completions from the response cache, see ``[response_cache]``"""
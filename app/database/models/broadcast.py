@@ -0,0 +1,151 @@
+import json
+import uuid
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import Column, Integer, String, Text, Boolean, DateTime, select, update, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.attributes import set_committed_value
+
+from app.config import config
+from app.database.base import Base
+from app.database.unit_of_work import commit
+
+
+class Broadcast(Base):
+    """
+    An announcement sent to the announcement groups and every reachable user, with the progress it resumes from.
+
+    Groups and users are delivered in pages, ``groups_sent`` and ``last_user_id`` are the ends of the last pages
+    fully delivered. The worker running a broadcast holds it with ``claim_token`` until ``claimed_until``,
+    renewed while it runs, so workers resuming unfinished broadcasts do not send one twice. Progress is only
+    written while the writer still holds the claim.
+    """
+    __tablename__ = 'broadcasts'
+
+    RUNNING = "running"
+    DONE = "done"
+
+    class ClaimLostError(Exception):
+        def __init__(self, broadcast_id: int):
+            super().__init__(f"Broadcast {broadcast_id} was claimed by another worker")
+
+    message = Column(Text, nullable=False)
+    groups = Column(Text, nullable=False, default="[]")
+    """JSON list of QQ groups, as configured when the broadcast started"""
+    status = Column(String(10), nullable=False, default=RUNNING, index=True)
+
+    # --- Progress ---
+    groups_sent = Column(Integer, nullable=False, default=0, server_default="0")
+    groups_done = Column(Boolean, nullable=False, default=False)
+    last_user_id = Column(Integer, nullable=False, default=0)
+    delivered = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    finished_time = Column(DateTime)
+    claimed_until = Column(DateTime)
+    claim_token = Column(String(32))
+
+    @property
+    def group_list(self) -> list[str]:
+        return json.loads(self.groups)
+
+    @staticmethod
+    def _lease_end() -> datetime:
+        return datetime.utcnow() + timedelta(seconds=config.announcement.lease_in_seconds)
+
+    @classmethod
+    async def create(cls, session: AsyncSession, message: str, groups: list[str]) -> "Broadcast":
+        """Claimed by the caller with ``claim_token``"""
+        broadcast = cls(message=message, groups=json.dumps(groups), status=cls.RUNNING, groups_sent=0,
+                        groups_done=False, last_user_id=0, delivered=0, failed=0, claimed_until=cls._lease_end(),
+                        claim_token=uuid.uuid4().hex)
+        session.add(broadcast)
+        await commit(session)
+        return broadcast
+
+    @classmethod
+    async def get_unfinished(cls, session: AsyncSession) -> list["Broadcast"]:
+        result = await session.scalars(select(cls).where(cls.status == cls.RUNNING).order_by(cls.id))
+        return list(result)
+
+    async def claim(self, session: AsyncSession) -> bool:
+        """
+        Take over an unfinished broadcast nobody holds, or whose holder stopped renewing its claim
+
+        :return: whether this worker may run it, with ``claim_token``
+        """
+        now, lease_end = datetime.utcnow(), self._lease_end()
+        result = await session.execute(
+            update(Broadcast)
+            .where(Broadcast.id == self.id, Broadcast.status == self.RUNNING,
+                   or_(Broadcast.claimed_until.is_(None), Broadcast.claimed_until < now))
+            .values(claimed_until=lease_end, claim_token=uuid.uuid4().hex)
+            .execution_options(synchronize_session=False)
+        )
+        await commit(session)
+        if result.rowcount != 1:
+            return False
+        # the claim may have come after another worker's progress
+        await session.refresh(self)
+        return True
+
+    async def _update_claimed(self, session: AsyncSession, token: str, **values) -> None:
+        """
+        :param values: column name -> new value or SQL expression
+        :raises ClaimLostError: if another worker claimed the broadcast since
+        """
+        await session.flush()
+        row = (await session.execute(
+            update(Broadcast).where(Broadcast.id == self.id, Broadcast.claim_token == token).values(**values)
+            .returning(*[getattr(Broadcast, name) for name in values])
+            .execution_options(synchronize_session=False)
+        )).one_or_none()
+        if row is None:
+            raise Broadcast.ClaimLostError(self.id)
+        for name, value in zip(values, row):
+            set_committed_value(self, name, value)
+
+    async def renew(self, session: AsyncSession, token: str) -> None:
+        """:raises ClaimLostError:"""
+        await self._update_claimed(session, token, claimed_until=self._lease_end())
+        await commit(session)
+
+    async def release(self, session: AsyncSession, token: str) -> None:
+        """Let another worker resume the broadcast right away, nothing to do once the claim is lost"""
+        try:
+            await self._update_claimed(session, token, claimed_until=None, claim_token=None)
+        except Broadcast.ClaimLostError:
+            return
+        await commit(session)
+
+    async def checkpoint(
+            self,
+            session: AsyncSession,
+            token: str,
+            delivered: int,
+            failed: int,
+            groups_sent: Optional[int] = None,
+            groups_done: Optional[bool] = None,
+            last_user_id: Optional[int] = None,
+            finished: bool = False
+    ) -> None:
+        """
+        Renews the claim.
+
+        :param token: ``claim_token`` of the worker running the broadcast
+        :param delivered: deliveries since the last checkpoint
+        :param failed: failures since the last checkpoint
+        :raises ClaimLostError: if another worker claimed the broadcast since, nothing is written
+        """
+        values = {"delivered": Broadcast.delivered + delivered, "failed": Broadcast.failed + failed}
+        if groups_sent is not None:
+            values["groups_sent"] = groups_sent
+        if groups_done is not None:
+            values["groups_done"] = groups_done
+        if last_user_id is not None:
+            values["last_user_id"] = last_user_id
+        if finished:
+            values.update(status=self.DONE, finished_time=datetime.utcnow(), claim_token=None)
+        values["claimed_until"] = None if finished else self._lease_end()
+        await self._update_claimed(session, token, **values)
+        await commit(session)
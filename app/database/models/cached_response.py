@@ -0,0 +1,154 @@
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import Column, Integer, BigInteger, String, Text, Float, DateTime, Index, select, delete, func, \
+    or_, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database.base import Base
+
+SIMHASH_BANDS = 8
+"""64 bit SimHashes are indexed as 8 bands of 8 bits, two hashes within 7 bits share at least one band"""
+BAND_BITS = 64 // SIMHASH_BANDS
+
+
+def _signed(value: int) -> int:
+    """SQLite integers are signed 64 bit"""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def bands_of(simhash: int) -> list[int]:
+    return [(simhash >> (BAND_BITS * i)) & ((1 << BAND_BITS) - 1) for i in range(SIMHASH_BANDS)]
+
+
+class CachedResponse(Base):
+    """
+    A completion served again for the same or a nearly identical message.
+
+    ``scope`` hashes the normalized system prompt, model and temperature, only entries in the same scope can
+    match. ``key`` hashes the scope with the normalized message for exact hits, near duplicates are found
+    through the SimHash bands and compared on the full hash.
+    """
+    __tablename__ = 'cached_responses'
+    __table_args__ = tuple(
+        Index(f'ix_cached_responses_scope_band_{i}', 'scope', f'band_{i}') for i in range(SIMHASH_BANDS)
+    ) + (Index('ix_cached_responses_expires_at', 'expires_at'),)
+
+    key = Column(String(64), nullable=False, unique=True, index=True)
+    scope = Column(String(64), nullable=False)
+    simhash = Column(BigInteger, nullable=False)
+    band_0 = Column(Integer, nullable=False)
+    band_1 = Column(Integer, nullable=False)
+    band_2 = Column(Integer, nullable=False)
+    band_3 = Column(Integer, nullable=False)
+    band_4 = Column(Integer, nullable=False)
+    band_5 = Column(Integer, nullable=False)
+    band_6 = Column(Integer, nullable=False)
+    band_7 = Column(Integer, nullable=False)
+
+    model = Column(String(50), nullable=False)
+    temperature = Column(Float, nullable=False)
+    response = Column(Text, nullable=False)
+    size_in_bytes = Column(Integer, nullable=False)
+    token_usage = Column(Integer, default=0, nullable=False)
+    amount_in_cents = Column(Integer, default=0, nullable=False)
+    """What the user who caused the completion was billed"""
+
+    hits = Column(Integer, default=0, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+
+    @property
+    def unsigned_simhash(self) -> int:
+        return self.simhash & ((1 << 64) - 1)
+
+    @classmethod
+    async def find(
+            cls,
+            session: AsyncSession,
+            key: str,
+            scope: str,
+            simhash: int,
+            max_distance: int = 0,
+            now: datetime = None
+    ) -> Optional["CachedResponse"]:
+        """
+        The entry for ``key``, else the closest entry of ``scope`` within ``max_distance`` SimHash bits
+
+        :param max_distance: at most ``SIMHASH_BANDS - 1``, larger distances are not guaranteed to be found
+        """
+        now = now or datetime.utcnow()
+        exact = await session.scalar(select(cls).where(cls.key == key, cls.expires_at > now))
+        if exact is not None or max_distance <= 0:
+            return exact
+
+        bands = bands_of(simhash)
+        candidates = await session.scalars(
+            select(cls).where(
+                cls.scope == scope,
+                cls.expires_at > now,
+                or_(*[getattr(cls, f"band_{i}") == band for i, band in enumerate(bands)]),
+            )
+        )
+        best, best_distance = None, max_distance + 1
+        for candidate in candidates:
+            distance = (candidate.unsigned_simhash ^ simhash).bit_count()
+            if distance < best_distance:
+                best, best_distance = candidate, distance
+        return best
+
+    @classmethod
+    async def put(
+            cls,
+            session: AsyncSession,
+            key: str,
+            scope: str,
+            simhash: int,
+            model: str,
+            temperature: float,
+            response: str,
+            expires_at: datetime,
+            token_usage: int = 0,
+            amount_in_cents: int = 0,
+    ) -> "CachedResponse":
+        """Insert or replace the entry for ``key``. Does not commit."""
+        await session.execute(delete(cls).where(cls.key == key))
+        entry = cls(
+            key=key, scope=scope, simhash=_signed(simhash), model=model, temperature=temperature,
+            response=response, size_in_bytes=len(response.encode()), token_usage=token_usage,
+            amount_in_cents=amount_in_cents, hits=0, expires_at=expires_at,
+            **{f"band_{i}": band for i, band in enumerate(bands_of(simhash))}
+        )
+        session.add(entry)
+        return entry
+
+    @classmethod
+    async def record_hit(cls, session: AsyncSession, id: int) -> None:
+        """Does not commit"""
+        await session.execute(
+            update(cls).where(cls.id == id).values(hits=cls.hits + 1).execution_options(synchronize_session=False)
+        )
+
+    @classmethod
+    async def purge(cls, session: AsyncSession, max_total_bytes: int, now: datetime = None) -> int:
+        """
+        Drop expired entries, then the oldest until the rest fit in ``max_total_bytes``. Does not commit.
+
+        :return: number of entries removed
+        """
+        now = now or datetime.utcnow()
+        removed = (await session.execute(delete(cls).where(cls.expires_at <= now))).rowcount
+
+        total = await session.scalar(select(func.coalesce(func.sum(cls.size_in_bytes), 0)))
+        if total <= max_total_bytes:
+            return removed
+
+        # newest first, keep entries while they fit
+        kept, cutoff_id = 0, None
+        for id, size in await session.execute(select(cls.id, cls.size_in_bytes).order_by(cls.id.desc())):
+            if kept + size > max_total_bytes:
+                cutoff_id = id
+                break
+            kept += size
+        if cutoff_id is not None:
+            removed += (await session.execute(delete(cls).where(cls.id <= cutoff_id))).rowcount
+        return removed
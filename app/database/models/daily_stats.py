@@ -1,9 +1,10 @@
 from datetime import date
 
-from sqlalchemy import Column, Integer, Date, select
+from sqlalchemy import Column, Integer, Date, select, update
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.database.connector import Base
+from app.database.base import Base
+from app.database.unit_of_work import commit
 
 
 class DailyStats(Base):
@@ -47,5 +48,20 @@ class DailyStats(Base):
         else:
             instance = cls(date_interval=date.today())
             session.add(instance)
-            await session.commit()
+            await commit(session)
             return instance
+
+    @classmethod
+    async def add(cls, session: AsyncSession, **amounts: int) -> None:
+        """
+        Add to today's counters in SQL, so concurrent requests in other workers do not overwrite each other.
+        Does not commit the increment.
+
+        :param amounts: column name -> amount to add
+        """
+        stats = await cls.get_or_create(session=session)
+        await session.execute(
+            update(cls).where(cls.id == stats.id)
+            .values({name: getattr(cls, name) + amount for name, amount in amounts.items()})
+            .execution_options(synchronize_session=False)
+        )
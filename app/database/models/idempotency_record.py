@@ -0,0 +1,53 @@
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import Column, String, Text, DateTime, select, delete
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database.base import Base
+
+
+class IdempotencyRecord(Base):
+    """
+    The result of a billing call made under an ``Idempotency-Key``, returned again when the call is retried.
+
+    ``key_hash`` hashes the operation, the user and the client's key, the key itself is not stored.
+    """
+    __tablename__ = 'idempotency_records'
+
+    key_hash = Column(String(64), nullable=False, unique=True, index=True)
+    operation = Column(String(30), nullable=False)
+    result = Column(Text, nullable=False)
+    """JSON"""
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+    @classmethod
+    async def get_result(cls, session: AsyncSession, key_hash: str, now: datetime = None) -> Optional[str]:
+        """:return: the stored JSON result, None if there is none or it expired"""
+        now = now or datetime.utcnow()
+        return await session.scalar(select(cls.result).where(cls.key_hash == key_hash, cls.expires_at > now))
+
+    @classmethod
+    async def put(
+            cls,
+            session: AsyncSession,
+            key_hash: str,
+            operation: str,
+            result: str,
+            expires_at: datetime
+    ) -> "IdempotencyRecord":
+        """Replaces an expired record for the same key. Does not commit."""
+        await session.execute(delete(cls).where(cls.key_hash == key_hash, cls.expires_at <= datetime.utcnow()))
+        record = cls(key_hash=key_hash, operation=operation, result=result, expires_at=expires_at)
+        session.add(record)
+        return record
+
+    @classmethod
+    async def purge(cls, session: AsyncSession, now: datetime = None) -> int:
+        """
+        Drop expired records. Does not commit.
+
+        :return: number of records removed
+        """
+        now = now or datetime.utcnow()
+        return (await session.execute(delete(cls).where(cls.expires_at <= now))).rowcount
@@ -2,12 +2,12 @@ import random
 import string
 from typing import Union
 
-from sqlalchemy import Column, Integer, String, ForeignKey, select
+from sqlalchemy import Column, Integer, String, ForeignKey, select, exists
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import relationship
 
 from app.database.base import Base
-from app.config import config
+from app.config import hot_config
 
 
 class InviteCode(Base):
@@ -58,7 +58,8 @@ class InviteCode(Base):
             session: AsyncSession,
             id: int = None,
             code: str = None,
-            owner=None
+            owner=None,
+            load: tuple[str, ...] = ()
     ) -> Union["InviteCode", None]:
         """
 
@@ -66,9 +67,10 @@ class InviteCode(Base):
         :param id:
         :param code:
         :param owner:
+        :param load: relationships to load along, e.g. ``("owner",)``
         :return:
         """
-        stmt = select(cls)
+        stmt = select(cls).options(*cls.loader_options(load))
         if id is not None:
             stmt = stmt.filter_by(id=id)
         if code is not None:
@@ -79,9 +81,26 @@ class InviteCode(Base):
         result = await session.execute(stmt)
         return result.scalars().first()
 
+    @classmethod
+    async def generate_codes(cls, session: AsyncSession, count: int, chunk_size: int = 500) -> list[str]:
+        """Unique unused codes, checked against the table with IN queries instead of one query per code"""
+        length = hot_config().invite_code_length
+        codes: set[str] = set()
+        while len(codes) < count:
+            candidates = set()
+            while len(candidates) < count - len(codes):
+                if (code := ''.join(random.choices(string.ascii_letters + string.digits, k=length))) not in codes:
+                    candidates.add(code)
+            ordered = list(candidates)
+            for start in range(0, len(ordered), chunk_size):
+                taken = await session.scalars(select(cls.code).where(cls.code.in_(ordered[start:start + chunk_size])))
+                candidates.difference_update(taken)
+            codes |= candidates
+        return list(codes)
+
     @classmethod
     async def generate_code(cls, session: AsyncSession) -> str:
         while True:
-            code = ''.join(random.choices(string.ascii_letters + string.digits, k=config.referral.invite_code_length))
-            if not await cls.get(session, code=code):
+            code = ''.join(random.choices(string.ascii_letters + string.digits, k=hot_config().invite_code_length))
+            if not await session.scalar(select(exists().where(cls.code == code))):
                 return code
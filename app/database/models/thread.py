@@ -1,7 +1,121 @@
-from sqlalchemy import Column, Integer
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, ForeignKey, select, delete, update
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.database.base import Base
+from app.database.models.thread_message import ThreadMessage
+from app.database.unit_of_work import commit
 
 
 class Thread(Base):
     __tablename__ = 'threads'
+
+    user_id = Column(Integer, ForeignKey('users.id'), index=True)
+    last_active_time = Column(DateTime, default=datetime.utcnow, index=True)
+    message_count = Column(Integer, default=0, server_default="0", nullable=False)
+
+    # --- Archive ---
+    archive_file = Column(String(255))
+    """Snapshot file name under ``[archive] directory``, None while the messages are in ``thread_messages``"""
+    archive_offset = Column(BigInteger)
+    archive_length = Column(Integer)
+
+    @property
+    def archived(self) -> bool:
+        return self.archive_file is not None
+
+    @classmethod
+    async def get(cls, session: AsyncSession, id: int) -> Optional["Thread"]:
+        return await session.get(cls, id)
+
+    async def restore(self, session: AsyncSession) -> None:
+        """Bring an archived thread back into the live tables, a no-op for a live thread"""
+        if self.archived:
+            from app.services.thread_archive import thread_archive
+            await thread_archive.resume(session=session, thread=self)
+
+    async def add_message(self, session: AsyncSession, role: str, content: str) -> ThreadMessage:
+        """Restores the thread first if it is archived"""
+        await self.restore(session=session)
+        message = ThreadMessage(thread_id=self.id, position=self.message_count, role=role, content=content)
+        session.add(message)
+        self.message_count += 1
+        self.last_active_time = datetime.utcnow()
+        await commit(session)
+        return message
+
+    async def get_messages(self, session: AsyncSession) -> list[ThreadMessage]:
+        """Restores the thread first if it is archived"""
+        await self.restore(session=session)
+        result = await session.scalars(
+            select(ThreadMessage).where(ThreadMessage.thread_id == self.id).order_by(ThreadMessage.position)
+        )
+        return list(result)
+
+    @classmethod
+    async def get_idle(cls, session: AsyncSession, before: datetime, limit: int) -> list["Thread"]:
+        """Live threads last active before ``before``, oldest first"""
+        result = await session.scalars(
+            select(cls).where(cls.archive_file.is_(None), cls.last_active_time < before)
+            .order_by(cls.last_active_time).limit(limit)
+        )
+        return list(result)
+
+    async def mark_archived(
+            self,
+            session: AsyncSession,
+            file: str,
+            offset: int,
+            length: int,
+            message_count: int
+    ) -> bool:
+        """
+        Drop the live messages once they are in a snapshot, unless another worker archived the thread or a
+        message was added since the snapshot was taken. Does not commit.
+
+        :param message_count: number of messages in the snapshot
+        :return: whether the thread was archived
+        """
+        result = await session.execute(
+            update(Thread)
+            .where(Thread.id == self.id, Thread.archive_file.is_(None), Thread.message_count == message_count)
+            .values(archive_file=file, archive_offset=offset, archive_length=length)
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount != 1:
+            await session.refresh(self)
+            return False
+        await session.execute(delete(ThreadMessage).where(ThreadMessage.thread_id == self.id))
+        self.archive_file, self.archive_offset, self.archive_length = file, offset, length
+        return True
+
+    async def mark_restored(self, session: AsyncSession, messages: list[tuple[str, str]]) -> bool:
+        """
+        Put the messages back into ``thread_messages``, unless another worker restored the thread first.
+        Does not commit.
+
+        :param messages: (role, content) in order
+        :return: whether the thread was restored
+        """
+        now = datetime.utcnow()
+        result = await session.execute(
+            update(Thread)
+            .where(Thread.id == self.id, Thread.archive_file == self.archive_file,
+                   Thread.archive_offset == self.archive_offset)
+            .values(archive_file=None, archive_offset=None, archive_length=None, message_count=len(messages),
+                    last_active_time=now)
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount != 1:
+            await session.refresh(self)
+            return False
+        session.add_all(
+            ThreadMessage(thread_id=self.id, position=position, role=role, content=content)
+            for position, (role, content) in enumerate(messages)
+        )
+        self.archive_file = self.archive_offset = self.archive_length = None
+        self.message_count = len(messages)
+        self.last_active_time = now
+        return True
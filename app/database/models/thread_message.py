@@ -0,0 +1,15 @@
+from sqlalchemy import Column, Integer, String, Text, ForeignKey, UniqueConstraint
+
+from app.database.base import Base
+
+
+class ThreadMessage(Base):
+    """A message of a live thread, archived threads keep theirs in a snapshot file instead"""
+    __tablename__ = 'thread_messages'
+    __table_args__ = (UniqueConstraint('thread_id', 'position', name='uq_thread_messages_position'),)
+
+    thread_id = Column(Integer, ForeignKey('threads.id'), nullable=False)
+    position = Column(Integer, nullable=False)
+    """0-based order within the thread"""
+    role = Column(String(20), nullable=False)
+    content = Column(Text, nullable=False)
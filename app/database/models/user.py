@@ -1,17 +1,31 @@
 from datetime import datetime, timedelta
 
 import uuid as uuid_module
-from typing import Optional, Union, List
+from collections import defaultdict
+from typing import Optional, Union, List, Iterable, Any
 
 from loguru import logger
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, Interval, ForeignKey, UUID, select
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, Interval, ForeignKey, UUID, select, update, \
+    case, literal, exists, or_, and_
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import relationship, selectinload, Mapped
 
 from app.database.base import Base
+from app.database.unit_of_work import commit, rollback
 from app.database.models.daily_stats import DailyStats
 from app.database.models.invite_code import InviteCode
-from app.config import config
+from app.database.models.usage_rollup import UsageRollup
+from app.services.ban import ban_registry, IDENTIFIERS
+from app.services.user_cache import UserSnapshot, user_snapshots
+from app.services.user_lock import user_locks
+from app.config import config, hot_config
+
+IN_CHUNK_SIZE = 500
+"""Values per IN clause, under SQLite's default limit of 999 bound parameters"""
+
+Identifier = tuple[str, Any]
+"""(name, value), name is 'id' or one of ``IDENTIFIERS``"""
 
 
 class User(Base):
@@ -27,16 +41,16 @@ class User(Base):
     email = Column(String(30), nullable=True, index=True)
 
     # --- Safety ---
-    is_banned = Column(Boolean, default=False, nullable=False)
+    is_banned = Column(Boolean, default=False, nullable=False, index=True)
     current_banned_since = Column(DateTime)
     current_banned_period = Column(Interval)
     banned_count = Column(Integer, default=0, nullable=False)
     violation_count = Column(Integer, default=0, nullable=False)
 
     # --- Billing ---
-    balance_in_cents = Column(Integer, default=config.billing.balance_in_cents, nullable=False)
-    gifted_balance_in_cents = Column(Integer, default=config.billing.balance_in_cents, nullable=False)
-    billing_rate = Column(Integer, default=config.billing.billing_rate, nullable=False)
+    balance_in_cents = Column(Integer, default=lambda: hot_config().default_balance_in_cents, nullable=False)
+    gifted_balance_in_cents = Column(Integer, default=lambda: hot_config().default_balance_in_cents, nullable=False)
+    billing_rate = Column(Integer, default=lambda: hot_config().default_billing_rate, nullable=False)
 
     # --- Invitation ---
     invite_code_id = Column(Integer, ForeignKey('invite_codes.id'))
@@ -80,8 +94,7 @@ class User(Base):
         if not any(kwargs.values()):
             raise ValueError("At least one of required user identifier is required")
         try:
-            user = await cls.get(session=session, **kwargs)
-            if user:
+            if await cls.exists(session=session, **kwargs):
                 raise cls.UserAlreadyExistsError(kwargs)
 
             user = cls(**kwargs, uuid=uuid_module.uuid4())
@@ -89,13 +102,13 @@ class User(Base):
             invite_code = await InviteCode.create(session=session, user=user)
             user.invite_code = invite_code
             user.invite_code_id = invite_code.id
-            await session.commit()
+            await commit(session)
             return user
         except cls.UserAlreadyExistsError:
             raise
         except Exception as e:
             logger.exception(e)
-            await session.rollback()
+            await rollback(session)
             raise cls.UserError
 
     @classmethod
@@ -108,20 +121,90 @@ class User(Base):
             wechat_id: Optional[str] = None,
             phone_number: Optional[str] = None,
             email: Optional[str] = None,
+            load: tuple[str, ...] = (),
     ) -> Optional["User"]:
         """
         Get a User object from database
 
+        :param load: relationships to load along, e.g. ``("invite_code", "invitees.invite_code")``
         :return: User object if found else None
         """
+        conditions = cls._identifier_conditions(id, uuid, qq_number, wechat_id, phone_number, email)
+        if not conditions:
+            return None
+
+        query = select(cls).where(*conditions).options(*cls.loader_options(load))
+
+        result = await session.execute(query)
+        return result.scalars().first()
+
+    @classmethod
+    async def exists(
+            cls,
+            session: AsyncSession,
+            id: Optional[int] = None,
+            uuid: Optional[str | UUID] = None,
+            qq_number: Optional[str] = None,
+            wechat_id: Optional[str] = None,
+            phone_number: Optional[str] = None,
+            email: Optional[str] = None,
+    ) -> bool:
+        conditions = cls._identifier_conditions(id, uuid, qq_number, wechat_id, phone_number, email)
+        if not conditions:
+            return False
+        return bool(await session.scalar(select(exists().where(*conditions))))
+
+    @classmethod
+    async def get_snapshot(
+            cls,
+            session: AsyncSession,
+            id: Optional[int] = None,
+            uuid: Optional[str | UUID] = None,
+            qq_number: Optional[str] = None,
+            wechat_id: Optional[str] = None,
+            phone_number: Optional[str] = None,
+            email: Optional[str] = None,
+    ) -> Optional[UserSnapshot]:
+        """
+        Read the hot columns only and cache them, for requests that do not change the user.
+        Check ``user_snapshots`` first, this always queries.
+
+        :return: UserSnapshot if found else None
+        """
+        conditions = cls._identifier_conditions(id, uuid, qq_number, wechat_id, phone_number, email)
+        if not conditions:
+            return None
+
+        generation = user_snapshots.generation
+        query = select(*[getattr(cls, name) for name in UserSnapshot.__slots__]).where(*conditions)
+        row = (await session.execute(query)).first()
+        if row is None:
+            return None
+        snapshot = UserSnapshot(**row._mapping)
+        user_snapshots.put(snapshot, generation)
+        return snapshot
+
+    @classmethod
+    def _identifier_conditions(
+            cls,
+            id: Optional[int] = None,
+            uuid: Optional[str | UUID] = None,
+            qq_number: Optional[str] = None,
+            wechat_id: Optional[str] = None,
+            phone_number: Optional[str] = None,
+            email: Optional[str] = None,
+    ) -> list:
+        """
+        :return: empty if no identifier is given or one cannot match any user
+        """
         conditions = []
         if id is not None:
             conditions.append(cls.id == id)
         if uuid is not None:
             try:
-                uuid = uuid_module.UUID(uuid)
+                uuid = uuid_module.UUID(str(uuid))
             except ValueError:
-                return None
+                return []
             conditions.append(cls.uuid == uuid)
         if qq_number is not None:
             conditions.append(cls.qq_number == qq_number)
@@ -131,14 +214,113 @@ class User(Base):
             conditions.append(cls.phone_number == phone_number)
         if email is not None:
             conditions.append(cls.email == email)
+        return conditions
 
-        if not conditions:
-            return None
+    @classmethod
+    async def get_many(
+            cls,
+            session: AsyncSession,
+            identifiers: Iterable[Identifier],
+            load: tuple[str, ...] = (),
+            create_missing: bool = False,
+    ) -> dict[Identifier, "User"]:
+        """
+        Resolve mixed identifiers, e.g. every sender of a group message, with one IN query per identifier type
+        and chunk of ``IN_CHUNK_SIZE``
+
+        :param identifiers: e.g. ``[("qq_number", "10001"), ("email", "a@b.com"), ("id", 3)]``
+        :param load: relationships to load along, see :meth:`get`
+        :param create_missing: create users with invite codes for unknown external identifiers, in bulk
+        :return: users by the given identifiers, unknown ones are left out
+        :raises ValueError: if an identifier name is invalid
+        :raises UserError: if creating the missing users failed
+        """
+        identifiers = list(identifiers)
+        users = await cls._match_many(session, identifiers, select(cls).options(*cls.loader_options(load)), True)
+        if not create_missing:
+            return users
+
+        missing: dict[Identifier, list[Identifier]] = defaultdict(list)
+        for given in identifiers:
+            name, value = given
+            if given not in users and name not in ("id", "uuid") and value is not None:
+                missing[(name, str(value))].append(given)
+        if not missing:
+            return users
+
+        try:
+            created = {key: cls(**{key[0]: key[1]}, uuid=uuid_module.uuid4()) for key in missing}
+            session.add_all(created.values())
+            await session.flush()
+            codes = await InviteCode.generate_codes(session=session, count=len(created))
+            for user, code in zip(created.values(), codes):
+                user.invite_code = InviteCode(user=user, code=code)
+            await session.flush()
+            for user in created.values():
+                user.invite_code_id = user.invite_code.id
+            await commit(session)
+        except Exception as e:
+            logger.exception(e)
+            await rollback(session)
+            raise cls.UserError
 
-        query = select(cls).where(*conditions)
+        for key, user in created.items():
+            for given in missing[key]:
+                users[given] = user
+        return users
 
-        result = await session.execute(query)
-        return result.scalars().first()
+    @classmethod
+    async def get_snapshots(
+            cls,
+            session: AsyncSession,
+            identifiers: Iterable[Identifier]
+    ) -> dict[Identifier, UserSnapshot]:
+        """
+        :meth:`get_many` for :class:`UserSnapshot`, which are cached as well
+
+        :raises ValueError: if an identifier name is invalid
+        """
+        generation = user_snapshots.generation
+        query = select(*[getattr(cls, name) for name in UserSnapshot.__slots__])
+        rows = await cls._match_many(session, list(identifiers), query, False)
+        snapshots = {}
+        for given, row in rows.items():
+            snapshots[given] = snapshot = UserSnapshot(**row._mapping)
+            user_snapshots.put(snapshot, generation)
+        return snapshots
+
+    @classmethod
+    async def _match_many(cls, session: AsyncSession, identifiers: list[Identifier], query, scalars: bool) -> dict:
+        """
+        Run ``query`` with an IN clause per identifier type and chunk, matching the results to ``identifiers``
+        by the value of their identifying column
+        """
+        wanted: dict[Identifier, list[Identifier]] = defaultdict(list)
+        for given in identifiers:
+            name, value = given
+            if name != "id" and name not in IDENTIFIERS:
+                raise ValueError(f"Invalid identifier {name!r}")
+            if value is None:
+                continue
+            try:
+                value = int(value) if name == "id" else uuid_module.UUID(str(value)) if name == "uuid" else str(value)
+            except ValueError:
+                continue
+            wanted[(name, value)].append(given)
+
+        values_by_name: dict[str, list] = defaultdict(list)
+        for name, value in wanted:
+            values_by_name[name].append(value)
+
+        found = {}
+        for name, values in values_by_name.items():
+            column = getattr(cls, name)
+            for start in range(0, len(values), IN_CHUNK_SIZE):
+                result = await session.execute(query.where(column.in_(values[start:start + IN_CHUNK_SIZE])))
+                for match in result.scalars() if scalars else result:
+                    for given in wanted.get((name, getattr(match, name)), ()):
+                        found.setdefault(given, match)
+        return found
 
     async def charge(self, session: AsyncSession, amount: int, type: str = "charge", ) -> bool:
         """
@@ -149,6 +331,7 @@ class User(Base):
         :param type: 'charge' | 'bonus'
         :raises TypeError: if amount is not int
         :raises ValueError: if amount < 0
+        :raises TimeoutError: if the user's lock could not be acquired
         """
         if not isinstance(amount, int):
             raise TypeError("Amount must be an integer")
@@ -157,34 +340,61 @@ class User(Base):
         if amount == 0:
             return True
 
-        try:
-            stats = await DailyStats.get_or_create(session=session)
-            self.balance_in_cents += amount
+        cash_back = type == "charge" and hot_config().cash_back_when_invitee_charges
+        async with user_locks.hold(session, self.id, self.inviter_id if cash_back else None):
+            return await self._charge(session=session, amount=amount, type=type)
 
+    async def _charge(self, session: AsyncSession, amount: int, type: str) -> bool:
+        try:
+            await session.flush()
+            await session.refresh(self, attribute_names=["inviter_id"])
+            changes = {"balance_in_cents": User.balance_in_cents + amount}
             if type == "charge":
-                self.total_recharged_amount_in_cents += amount
-                stats.recharged_amount_in_cents += amount
+                changes["total_recharged_amount_in_cents"] = User.total_recharged_amount_in_cents + amount
+                await DailyStats.add(session=session, recharged_amount_in_cents=amount)
+            elif type == "bonus":
+                changes["total_bonus_amount_in_cents"] = User.total_bonus_amount_in_cents + amount
+                await DailyStats.add(session=session, bonus_amount_in_cents=amount)
+            await self._update_balance(session, **changes)
 
-                if config.referral.cash_back_when_invitee_charges and self.inviter_id:
-                    inviter = await User.get(id=self.inviter_id, session=session)
+            if type == "charge":
+                hot = hot_config()
+                if hot.cash_back_when_invitee_charges and self.inviter_id:
+                    # from the identity map when already loaded, e.g. by bind_invite_code
+                    inviter = await session.get(User, self.inviter_id)
                     await inviter.charge(
                         session=session,
-                        amount=config.referral.inviter_cash_back_amount_when_invitee_charges_percent * amount,
+                        amount=int(hot.inviter_cash_back_amount_when_invitee_charges_percent * amount),
                         type="bonus"
                     )
 
-            elif type == "bonus":
-                self.total_bonus_amount_in_cents += amount
-                stats.bonus_amount_in_cents += amount
+            await UsageRollup.record(session=session, user_id=self.id, feature=type, amount_in_cents=amount)
 
-            await session.commit()
+            await commit(session)
+            user_snapshots.invalidate_after(session, self.id)
 
             return True
         except Exception as e:
             logger.exception(e)
-            await session.rollback()
+            await rollback(session)
             raise self.UserError
 
+    async def _update_balance(self, session: AsyncSession, **changes):
+        """
+        Apply balance changes in SQL and load the results, so changes made by other workers at the same time add
+        up instead of overwriting each other. The user locks only serialize this process.
+
+        :param changes: column name -> SQL expression of the new value
+        """
+        await session.flush()
+        row = (await session.execute(
+            update(User).where(User.id == self.id).values(**changes)
+            .returning(*[getattr(User, name) for name in changes])
+            .execution_options(synchronize_session=False)
+        )).one()
+        for name, value in zip(changes, row):
+            set_committed_value(self, name, value)
+
     async def ban(self, session: AsyncSession, duration: timedelta = None, scheme: str = "ban") -> bool:
         """
 
@@ -204,21 +414,148 @@ class User(Base):
 
         self.is_banned = do_ban
         if do_ban:
-            pass
-            # todo: interval and stuff
+            self.current_banned_since = datetime.utcnow()
+            self.current_banned_period = duration
+            self.banned_count += 1
+        else:
+            self.current_banned_since = None
+            self.current_banned_period = None
         try:
-            await session.commit()
-            return True
+            await commit(session)
         except Exception as e:
             logger.exception(e)
-            await session.rollback()
+            await rollback(session)
             return False
+        user_snapshots.invalidate_after(session, self.id)
+
+        if do_ban:
+            ban_registry.add_user(self)
+        else:
+            ban_registry.discard(self.id)
+        return True
+
+    async def record_violation(self, session: AsyncSession) -> bool:
+        """
+        Count a violation, banning the user every ``config.safety.violations_per_ban`` violations for a period
+        escalating with ``banned_count``. Applied as a single UPDATE so concurrent reports cannot lose counts.
+
+        :param session:
+        :return: True if this violation banned the user
+        """
+        cls = type(self)
+        now = datetime.utcnow()
+        periods = [timedelta(hours=hours) for hours in config.safety.ban_periods_in_hours] or [None]
+
+        if config.safety.violations_per_ban > 0:
+            escalate = (cls.violation_count + 1) % config.safety.violations_per_ban == 0
+        else:
+            escalate = literal(False)
+        period = case(
+            *[(cls.banned_count == i, literal(p, Interval)) for i, p in enumerate(periods[:-1])],
+            else_=literal(periods[-1], Interval)
+        )
+
+        stmt = (
+            update(cls)
+            .where(cls.id == self.id)
+            .values(
+                violation_count=cls.violation_count + 1,
+                is_banned=case((escalate, True), else_=cls.is_banned),
+                banned_count=case((escalate, cls.banned_count + 1), else_=cls.banned_count),
+                current_banned_since=case((escalate, literal(now, DateTime)), else_=cls.current_banned_since),
+                current_banned_period=case((escalate, period), else_=cls.current_banned_period),
+            )
+            .returning(cls.violation_count, cls.is_banned, cls.banned_count,
+                       cls.current_banned_since, cls.current_banned_period)
+            .execution_options(synchronize_session=False)
+        )
+        try:
+            row = (await session.execute(stmt)).one()
+            await commit(session)
+        except Exception as e:
+            logger.exception(e)
+            await rollback(session)
+            raise self.UserError
+
+        for key, value in row._mapping.items():
+            set_committed_value(self, key, value)
+        user_snapshots.invalidate_after(session, self.id)
+
+        banned_now = row.current_banned_since == now
+        if banned_now:
+            ban_registry.add_user(self)
+        return banned_now
+
+    @classmethod
+    async def get_banned(cls, session: AsyncSession) -> list:
+        """
+        Banned users with only the columns the ban registry needs
+
+        :return: list of rows
+        """
+        query = select(
+            cls.id, cls.current_banned_since, cls.current_banned_period,
+            cls.uuid, cls.qq_number, cls.wechat_id, cls.phone_number, cls.email
+        ).where(cls.is_banned)
+        result = await session.execute(query)
+        return list(result.all())
+
+    @classmethod
+    async def get_contacts_after(cls, session: AsyncSession, after_id: int, limit: int) -> list:
+        """
+        A keyset page of users that are not banned and can be reached, ordered by id
+
+        :param after_id: the last id of the previous page, 0 for the first
+        :return: list of rows with id, qq_number, wechat_id, email, phone_number
+        """
+        query = select(cls.id, cls.qq_number, cls.wechat_id, cls.email, cls.phone_number).where(
+            cls.id > after_id,
+            cls.is_banned.is_(False),
+            or_(cls.qq_number.isnot(None), cls.wechat_id.isnot(None), cls.email.isnot(None),
+                cls.phone_number.isnot(None)),
+        ).order_by(cls.id).limit(limit)
+        result = await session.execute(query)
+        return list(result.all())
+
+    @classmethod
+    async def lift_bans(cls, session: AsyncSession, ids: list[int], now: Optional[datetime] = None) -> list[int]:
+        """
+        Lift the timed bans among ``ids`` that ran out. A ban extended or applied again since the caller saw it,
+        possibly by another worker, stays: rows are only updated while they still hold the ban that ran out.
+
+        :return: ids of the users whose ban was lifted
+        """
+        if not ids:
+            return []
+        now = now or datetime.utcnow()
+        rows = (await session.execute(
+            select(cls.id, cls.current_banned_since, cls.current_banned_period)
+            .where(cls.id.in_(ids), cls.is_banned, cls.current_banned_period.isnot(None))
+        )).all()
+        expired = [row for row in rows if row.current_banned_since + row.current_banned_period <= now]
+        if not expired:
+            return []
+        lifted = list((await session.scalars(
+            update(cls)
+            .where(cls.is_banned, or_(*(
+                and_(cls.id == row.id, cls.current_banned_since == row.current_banned_since,
+                     cls.current_banned_period == row.current_banned_period)
+                for row in expired
+            )))
+            .values(is_banned=False, current_banned_since=None, current_banned_period=None)
+            .returning(cls.id)
+            .execution_options(synchronize_session=False)
+        )).all())
+        await commit(session)
+        user_snapshots.invalidate_after(session, *lifted)
+        return lifted
 
     async def pay(self, session: AsyncSession, amount: int, ) -> bool:
         """
         :param session:
         :param amount: in cents
         :return True if success
+        :raises TimeoutError: if the user's lock could not be acquired
         """
         if amount < 0:
             raise ValueError("Negative amount not allowed")
@@ -226,30 +563,34 @@ class User(Base):
         if amount == 0:
             return True
 
-        if amount > self.balance_in_cents:
-            logger.warning(
-                f"User ID {self.id} attempted to pay {amount} which is more than the balance {self.balance_in_cents}. "
-            )
-
-        if self.gifted_balance_in_cents >= amount:
-            self.gifted_balance_in_cents -= amount
-            self.balance_in_cents -= amount
-        else:
-            amount_to_pay_from_balance = amount - self.gifted_balance_in_cents
-            self.balance_in_cents -= self.gifted_balance_in_cents
-            self.gifted_balance_in_cents = 0
+        async with user_locks.hold(session, self.id):
+            return await self._pay(session=session, amount=amount)
 
-            self.balance_in_cents -= amount_to_pay_from_balance
+    async def _pay(self, session: AsyncSession, amount: int) -> bool:
         try:
-            stats = await DailyStats.get_or_create(session=session)
-            stats.user_usage_amount_in_cents += amount
+            # gifted balance is spent first, the balance includes it
+            await self._update_balance(
+                session,
+                gifted_balance_in_cents=case(
+                    (User.gifted_balance_in_cents >= amount, User.gifted_balance_in_cents - amount), else_=0
+                ),
+                balance_in_cents=User.balance_in_cents - amount,
+            )
+            if self.balance_in_cents < 0:
+                logger.warning(
+                    f"User ID {self.id} paid {amount} which was more than the balance, now {self.balance_in_cents}."
+                )
+
+            await DailyStats.add(session=session, user_usage_amount_in_cents=amount)
+            await UsageRollup.record(session=session, user_id=self.id, feature="usage", amount_in_cents=amount)
 
-            await session.commit()
+            await commit(session)
+            user_snapshots.invalidate_after(session, self.id)
 
             return True
         except Exception as e:
             logger.exception(e)
-            await session.rollback()
+            await rollback(session)
             raise self.UserError
 
     async def bind_invite_code(self, session: AsyncSession, code: str | InviteCode) -> bool:
@@ -257,42 +598,56 @@ class User(Base):
         :param session:
         :param code:
         :return: True if success
+        :raises TimeoutError: if the users' locks could not be acquired
         """
         if self.inviter_id:
             raise self.RepeatedlyBindInviteCodeError
 
         if isinstance(code, str):
-            invite_code = await InviteCode.get(session=session, code=code)
+            invite_code = await InviteCode.get(session=session, code=code, load=("owner",))
             if not invite_code:
                 raise InviteCode.NoSuchCodeError(code)
         else:
             invite_code = code
 
-        if invite_code.use_count >= config.referral.invite_code_max_usage:
+        # binds to the same code are serialized by the owner's lock
+        async with user_locks.hold(session, self.id, invite_code.owner_id):
+            return await self._bind_invite_code(session=session, invite_code=invite_code)
+
+    async def _bind_invite_code(self, session: AsyncSession, invite_code: InviteCode) -> bool:
+        await session.flush()
+        await session.refresh(self, attribute_names=["inviter_id"])
+        await session.refresh(invite_code, attribute_names=["use_count"])
+        if self.inviter_id:
+            raise self.RepeatedlyBindInviteCodeError
+
+        hot = hot_config()
+        if invite_code.use_count >= hot.invite_code_max_usage:
             raise InviteCode.MaxAllowedBindingCountExceededError
 
         if invite_code.owner_id == self.id:
             raise InviteCode.BindCodeOwnerConflictError
 
-        inviter = invite_code.owner
-
-        if inviter in await self.awaitable_attrs.invitees:
+        is_own_invitee = select(exists().where(User.id == invite_code.owner_id, User.inviter_id == self.id))
+        if await session.scalar(is_own_invitee):
             raise InviteCode.CircularBindingError
 
+        inviter = await invite_code.awaitable_attrs.owner
+
         self.inviter = inviter
         self.inviter_id = invite_code.owner_id
         invite_code.use_count += 1
 
-        if config.referral.cash_back_when_bind:
+        if hot.cash_back_when_bind:
             await inviter.charge(
                 session=session, type="bonus",
-                amount=config.referral.inviter_cash_back_amount_when_bind_in_cents
+                amount=hot.inviter_cash_back_amount_when_bind_in_cents
             )
             await self.charge(
                 session=session, type="bonus",
-                amount=config.referral.invitee_cash_back_amount_when_bind_in_cents
+                amount=hot.invitee_cash_back_amount_when_bind_in_cents
             )
-        stats = await DailyStats.get_or_create(session=session)
-        stats.invite_code_binds += 1
-        await session.commit()
+        await DailyStats.add(session=session, invite_code_binds=1)
+        await UsageRollup.record(session=session, user_id=self.id, feature="invite_code_bind")
+        await commit(session)
         return True
@@ -0,0 +1,78 @@
+import contextlib
+from typing import AsyncIterator, Callable
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+_DEPTH = "unit_of_work_depth"
+_ROLLBACK_ONLY = "unit_of_work_rollback_only"
+_ON_COMMIT = "unit_of_work_on_commit"
+_ON_END = "unit_of_work_on_end"
+
+
+def in_unit_of_work(session: AsyncSession) -> bool:
+    return session.info.get(_DEPTH, 0) > 0
+
+
+@contextlib.asynccontextmanager
+async def unit_of_work(session: AsyncSession) -> AsyncIterator[AsyncSession]:
+    """
+    Run everything on ``session`` as one transaction.
+
+    Model methods commit through :func:`commit`, which only flushes while a unit of work is open, so nested
+    operations such as ``bind_invite_code`` -> ``charge`` -> ``DailyStats.get_or_create`` join the outer
+    transaction. The outermost unit commits once on exit, or rolls back on an exception or after a model
+    method called :func:`rollback`. Nested units are no-ops.
+    """
+    depth = session.info.get(_DEPTH, 0)
+    session.info[_DEPTH] = depth + 1
+    try:
+        yield session
+    except Exception:
+        if depth == 0:
+            await session.rollback()
+        raise
+    else:
+        if depth == 0:
+            if session.info.get(_ROLLBACK_ONLY):
+                await session.rollback()
+            else:
+                await session.commit()
+                for callback in session.info.pop(_ON_COMMIT, []):
+                    callback()
+    finally:
+        session.info[_DEPTH] = depth
+        if depth == 0:
+            session.info.pop(_ROLLBACK_ONLY, None)
+            session.info.pop(_ON_COMMIT, None)
+            for callback in session.info.pop(_ON_END, []):
+                callback()
+
+
+def rollback_only(session: AsyncSession) -> bool:
+    """Whether a model method rolled the open unit of work back"""
+    return bool(session.info.get(_ROLLBACK_ONLY))
+
+
+def on_unit_commit(session: AsyncSession, callback: Callable[[], None]):
+    """Call ``callback`` once the outermost unit of work on ``session`` committed, before the end callbacks"""
+    session.info.setdefault(_ON_COMMIT, []).append(callback)
+
+
+def on_unit_end(session: AsyncSession, callback: Callable[[], None]):
+    """Call ``callback`` once the outermost unit of work on ``session`` committed or rolled back"""
+    session.info.setdefault(_ON_END, []).append(callback)
+
+
+async def commit(session: AsyncSession):
+    """Commit, or flush when inside a unit of work"""
+    if in_unit_of_work(session):
+        await session.flush()
+    else:
+        await session.commit()
+
+
+async def rollback(session: AsyncSession):
+    """Roll back, marking the enclosing unit of work so it does not commit whatever follows"""
+    if in_unit_of_work(session):
+        session.info[_ROLLBACK_ONLY] = True
+    await session.rollback()
@@ -0,0 +1,72 @@
+import math
+
+from typing import Optional
+
+from fastapi import Request, HTTPException, status
+
+from app.services.ban import ban_registry, IDENTIFIERS
+from app.services.idempotency import MAX_KEY_LENGTH
+from app.services.lifecycle import lifecycle
+from app.services.rate_limit import rate_limiter
+from app.services.user_cache import UserSnapshot
+from app.services.user_resolver import resolve_snapshot
+
+
+async def ensure_accepting():
+    """Turn requests away once the worker started draining"""
+    if not lifecycle.accepting:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Shutting down")
+
+
+async def rate_limit(request: Request):
+    """Throttle by user uuid, external identifiers and client IP, before any session is opened"""
+    route = request.scope.get("route")
+    endpoint_class = rate_limiter.endpoint_class(route.path if route else request.url.path)
+
+    identities = [(name, request.query_params.get(name)) for name in IDENTIFIERS]
+    ip = request.client.host if request.client else None
+
+    if retry_after := await rate_limiter.hit(endpoint_class, identities, ip=ip):
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many requests",
+            headers={"Retry-After": str(math.ceil(retry_after))}
+        )
+
+
+async def ensure_not_banned(request: Request):
+    """Reject banned users from the in-memory ban registry, before any session is opened"""
+    identifiers = {name: request.query_params.get(name) for name in IDENTIFIERS}
+    if ban_registry.is_banned(**identifiers):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="User is banned")
+
+
+async def load_user(request: Request):
+    """
+    Put the requesting user's :class:`UserSnapshot` on ``request.state.user``, None for anonymous or unknown users.
+    Cache misses of concurrent requests share one query, endpoints load the ``User`` by id when they change it.
+    """
+    identifiers = {name: request.query_params.get(name) for name in IDENTIFIERS}
+    snapshot = await resolve_snapshot(**identifiers)
+    if snapshot is not None and snapshot.is_banned:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="User is banned")
+    request.state.user = snapshot
+
+
+async def current_user(request: Request) -> UserSnapshot:
+    """For endpoints that need a known user, after :func:`load_user`"""
+    snapshot: Optional[UserSnapshot] = getattr(request.state, "user", None)
+    if snapshot is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Unknown user")
+    return snapshot
+
+
+async def idempotency_key(request: Request) -> Optional[str]:
+    """The ``Idempotency-Key`` header, for endpoints that pass it on to :meth:`Idempotency.run`"""
+    key = request.headers.get("Idempotency-Key")
+    if key is not None and not 0 < len(key) <= MAX_KEY_LENGTH:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Idempotency-Key must be 1 to {MAX_KEY_LENGTH} characters"
+        )
+    return key
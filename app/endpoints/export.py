@@ -0,0 +1,52 @@
+import secrets
+from datetime import date
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from fastapi.responses import StreamingResponse
+
+from app.config import config
+from app.database.connector import sessionmanager
+from app.endpoints.dependencies import ensure_accepting
+from app.services import export
+
+MEDIA_TYPES = {"csv": "text/csv; charset=utf-8", "jsonl": "application/x-ndjson"}
+
+
+async def require_export_token(request: Request):
+    """Off without ``[export] access_token``, otherwise the token must come as a Bearer authorization"""
+    if not (token := config.export.access_token):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    given = request.headers.get("Authorization", "").removeprefix("Bearer ")
+    if not secrets.compare_digest(given.encode(), token.encode()):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid export token")
+
+
+router = APIRouter(dependencies=[Depends(ensure_accepting), Depends(require_export_token)])
+
+
+@router.get("/export/{dataset}")
+async def export_dataset(
+        dataset: str,
+        format: str = "csv",
+        since: Optional[date] = None,
+        until: Optional[date] = None,
+        gzip: bool = False
+):
+    """Streamed as it is read, ``since`` inclusive and ``until`` exclusive"""
+    if dataset not in export.DATASETS:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Unknown dataset")
+    if format not in export.FORMATS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Unknown format")
+
+    async def body():
+        async with sessionmanager.session() as session:
+            async for chunk in export.export(session, dataset, format, since=since, until=until, compress=gzip):
+                yield chunk
+
+    name = export.filename(dataset, format, since=since, until=until, compress=gzip)
+    return StreamingResponse(
+        body(),
+        media_type="application/gzip" if gzip else MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{name}"'}
+    )
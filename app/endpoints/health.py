@@ -0,0 +1,14 @@
+from fastapi import APIRouter, Depends
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database.connector import get_db_session
+from app.endpoints.dependencies import ensure_accepting
+
+router = APIRouter(dependencies=[Depends(ensure_accepting)])
+
+
+@router.get("/health")
+async def health(session: AsyncSession = Depends(get_db_session)):
+    await session.execute(text("SELECT 1"))
+    return {"status": "ok"}
@@ -1,4 +1,20 @@
-from fastapi import APIRouter
+import importlib
 
-router = APIRouter(prefix="/v1")
+from fastapi import APIRouter, Depends
 
+from app.endpoints.dependencies import ensure_accepting, rate_limit, ensure_not_banned, load_user
+
+ENDPOINT_MODULES = ("assistants", "threads", "run", "user")
+
+router = APIRouter(
+    prefix="/v1",
+    dependencies=[Depends(ensure_accepting), Depends(rate_limit), Depends(ensure_not_banned), Depends(load_user)]
+)
+
+
+def include_endpoints():
+    """Import the endpoint modules and mount the ``router`` each of them defines"""
+    for name in ENDPOINT_MODULES:
+        module = importlib.import_module(f"app.endpoints.{name}")
+        if (endpoint_router := getattr(module, "router", None)) is not None:
+            router.include_router(endpoint_router)
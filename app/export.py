@@ -0,0 +1,56 @@
+"""
+Export users, daily stats or the ledger as CSV or JSONL, streamed in chunks so memory stays flat.
+
+Run from ``app/`` like ``main.py``::
+
+    python export.py ledger --format csv --since 2024-05-01 --until 2024-06-01 --gzip -o ledger-2024-05.csv.gz
+"""
+import os
+import sys
+
+if not __package__:
+    # run as a script from app/
+    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import argparse
+import asyncio
+from datetime import date
+
+from app.config import get_config
+from app.database.connector import sessionmanager
+from app.services import export
+
+
+async def run(args: argparse.Namespace):
+    output = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        async with sessionmanager.session() as session:
+            async for chunk in export.export(
+                    session, args.dataset, args.format, since=args.since, until=args.until, compress=args.gzip,
+                    chunk_rows=args.chunk_rows
+            ):
+                output.write(chunk)
+    finally:
+        if output is not sys.stdout.buffer:
+            output.close()
+        else:
+            output.flush()
+        await sessionmanager.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("dataset", choices=sorted(export.DATASETS))
+    parser.add_argument("--format", choices=export.FORMATS, default="csv")
+    parser.add_argument("--since", type=date.fromisoformat, help="inclusive, YYYY-MM-DD")
+    parser.add_argument("--until", type=date.fromisoformat, help="exclusive, YYYY-MM-DD")
+    parser.add_argument("--gzip", action="store_true")
+    parser.add_argument("--chunk-rows", type=int, help="defaults to [export] chunk_rows")
+    parser.add_argument("-o", "--output", help="defaults to stdout")
+    args = parser.parse_args()
+    get_config()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
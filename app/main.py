@@ -1,26 +1,159 @@
+import time
+
+_import_started = time.perf_counter()
+
 import os
 import sys
 
-sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+if not __package__:
+    # run as a script from app/
+    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
+import asyncio
+import signal
 from contextlib import asynccontextmanager
 
 import uvicorn
 from fastapi import FastAPI, APIRouter
 from loguru import logger
 
-from app.endpoints.router import router
-from app.config import config
-from app.database.connector import (sessionmanager, create_tables)
+from app.config import config, get_config, reload_config, watch_config
+from app.database.connector import (sessionmanager, migrate_tables)
+from app.services.ban import ban_registry
+from app.services.lifecycle import lifecycle
+from app.services.metrics import MetricsMiddleware
+from app.services.scheduler import scheduler
+from app.services.startup_profile import startup_profile
+
+# Models and the services built on them are imported where they are first used: the user model while
+# loading bans, the endpoints while mounting routes, the rest by the background tasks once they first run.
+
+startup_profile.record("import", time.perf_counter() - _import_started)
+
+
+async def lift_expired_bans(user_ids: list[int]):
+    from app.database.models.user import User
+    async with lifecycle.track(), sessionmanager.session() as session:
+        # skip users banned again since their entry was popped
+        await User.lift_bans(session=session, ids=[i for i in user_ids if i not in ban_registry])
+
+
+async def refresh_bans():
+    """Reload the banned users every ``[safety] ban_refresh_interval_in_seconds``"""
+    while True:
+        await asyncio.sleep(config.safety.ban_refresh_interval_in_seconds)
+        try:
+            from app.database.models.user import User
+            async with sessionmanager.session() as session:
+                ban_registry.load(await User.get_banned(session=session))
+        except Exception as e:
+            logger.exception(e)
+
+
+async def purge_response_cache():
+    """Drop expired and excess cached responses, every ``[response_cache] purge_interval_in_seconds``"""
+    while True:
+        await asyncio.sleep(config.response_cache.purge_interval_in_seconds)
+        if not config.response_cache.enabled:
+            continue
+        try:
+            from app.services.response_cache import response_cache
+            async with sessionmanager.session() as session:
+                if removed := await response_cache.purge(session=session):
+                    logger.info(f"Purged {removed} cached responses")
+        except Exception as e:
+            logger.exception(e)
+
+
+async def purge_idempotency_records():
+    """Drop expired idempotency records, every ``[billing.idempotency] purge_interval_in_seconds``"""
+    while True:
+        await asyncio.sleep(config.billing.idempotency.purge_interval_in_seconds)
+        try:
+            from app.services.idempotency import idempotency
+            async with sessionmanager.session() as session:
+                if removed := await idempotency.purge(session=session):
+                    logger.info(f"Purged {removed} idempotency records")
+        except Exception as e:
+            logger.exception(e)
 
-root_router = APIRouter()
 
-root_router.include_router(router)
+async def compact_usage_rollups():
+    """Drop hourly usage rollups past their retention, every ``[stats] compact_interval_in_seconds``"""
+    while True:
+        await asyncio.sleep(config.stats.compact_interval_in_seconds)
+        try:
+            from app.database.models.usage_rollup import UsageRollup
+            async with sessionmanager.session() as session:
+                removed = await UsageRollup.compact(session=session)
+                await session.commit()
+            if removed:
+                logger.info(f"Compacted {removed} hourly usage rollups")
+        except Exception as e:
+            logger.exception(e)
+
+
+async def archive_idle_threads():
+    """Move idle threads into snapshot files, every ``[archive] interval_in_seconds``"""
+    while True:
+        await asyncio.sleep(config.archive.interval_in_seconds)
+        if not config.archive.enabled:
+            continue
+        try:
+            from app.services.thread_archive import thread_archive
+            archived = 0
+            async with lifecycle.track(), sessionmanager.session() as session:
+                # in batches, until the backlog is gone or the worker shuts down
+                while lifecycle.accepting and (batch := await thread_archive.archive_idle(session=session)) > 0:
+                    archived += batch
+                    await asyncio.sleep(0)
+            if archived:
+                logger.info(f"Archived {archived} idle threads")
+        except Exception as e:
+            logger.exception(e)
+
+
+async def resume_announcements():
+    """
+    Resume broadcasts interrupted by the last shutdown, then every ``[announcement] lease_in_seconds`` those
+    left behind by a worker that died
+    """
+    while True:
+        try:
+            from app.services.announcement import announcement_fan_out
+            async with lifecycle.track(), sessionmanager.session() as session:
+                await announcement_fan_out.resume(session=session)
+        except Exception as e:
+            logger.exception(e)
+        await asyncio.sleep(config.announcement.lease_in_seconds)
+
+
+def mount_routes(app: FastAPI):
+    if getattr(app.state, "routes_mounted", False):
+        return
+    from app.endpoints import health, metrics, export
+    from app.endpoints.router import router, include_endpoints
+    include_endpoints()
+    root_router = APIRouter()
+    root_router.include_router(health.router)
+    root_router.include_router(metrics.router)
+    root_router.include_router(export.router)
+    root_router.include_router(router)
+    app.include_router(root_router)
+    app.state.routes_mounted = True
 
 
 async def on_startup():
     logger.info("Starting..")
-    await create_tables()
+    with startup_profile.phase("config"):
+        get_config()
+    scheduler.register_metrics()
+    with startup_profile.phase("database"):
+        await migrate_tables()
+        from app.database.models.user import User
+        async with sessionmanager.session() as session:
+            ban_registry.load(await User.get_banned(session=session))
+        logger.info(f"Loaded {len(ban_registry)} banned users")
 
 
 async def on_shutdown():
@@ -32,15 +165,55 @@ async def on_shutdown():
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await on_startup()
+    with startup_profile.phase("routing"):
+        mount_routes(app)
+    startup_profile.log()
+
+    background_tasks = [
+        asyncio.create_task(ban_registry.run_expiry(lift_expired_bans)),
+        asyncio.create_task(refresh_bans()),
+        asyncio.create_task(purge_response_cache()),
+        asyncio.create_task(purge_idempotency_records()),
+        asyncio.create_task(compact_usage_rollups()),
+        asyncio.create_task(archive_idle_threads()),
+        asyncio.create_task(resume_announcements()),
+    ]
+    if config.system.config_watch_interval_in_seconds > 0:
+        background_tasks.append(asyncio.create_task(watch_config(config.system.config_watch_interval_in_seconds)))
+    if hasattr(signal, "SIGHUP"):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, reload_config)
     yield
+
+    lifecycle.stop_accepting()
+    await lifecycle.drain(timeout=config.system.graceful_shutdown_timeout_in_seconds)
+    for task in background_tasks:
+        task.cancel()
     await on_shutdown()
 
 
 app = FastAPI(lifespan=lifespan)
-app.include_router(root_router)
+app.add_middleware(MetricsMiddleware)
+
+
+async def migrate_once():
+    """Migrate before forking workers so they do not race on a fresh database"""
+    await migrate_tables()
+    await sessionmanager.close()
+
 
 if __name__ == "__main__":
+    with startup_profile.phase("config"):
+        get_config()
+    if config.system.workers > 1:
+        asyncio.run(migrate_once())
     try:
-        uvicorn.run(app, host=config.system.host, port=config.system.port)
+        uvicorn.run(
+            # workers are separate processes, they import the app themselves
+            app if config.system.workers <= 1 else "app.main:app",
+            host=config.system.host,
+            port=config.system.port,
+            workers=config.system.workers,
+            timeout_graceful_shutdown=config.system.graceful_shutdown_timeout_in_seconds,
+        )
     except KeyboardInterrupt:
         exit(0)
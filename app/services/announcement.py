@@ -0,0 +1,329 @@
+import asyncio
+from collections import Counter, deque
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+from loguru import logger
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import config
+from app.database.models.broadcast import Broadcast
+from app.database.models.user import User
+from app.services.lifecycle import lifecycle
+from app.services.rate_limit import RateLimitBackend, LocalRateLimitBackend
+
+USER_CHANNELS = (("qq_number", "qq"), ("wechat_id", "wechat"), ("email", "email"), ("phone_number", "sms"))
+"""User identifier -> channel, a user is reached on the first one they have"""
+
+Target = tuple[str, str]
+"""(channel, destination)"""
+
+
+def target_of(contact) -> Optional[Target]:
+    """:param contact: a row of :meth:`User.get_contacts_after`"""
+    for identifier, channel in USER_CHANNELS:
+        if (value := getattr(contact, identifier)) is not None:
+            return channel, value
+    return None
+
+
+class DeliveryError(Exception):
+    def __init__(self, msg: str = None, retryable: bool = True):
+        super().__init__("Delivery failed" if not msg else msg)
+        self.retryable = retryable
+
+
+class NoDeliverySinkError(Exception):
+    def __init__(self):
+        super().__init__("No delivery sink is set, the bot platform's client is not connected")
+
+
+class DeliverySink:
+    """Sends one announcement to one destination, implemented by the bot platform's client"""
+
+    async def send(self, channel: str, destination: str, message: str) -> None:
+        """
+        :param channel: 'qq_group' | 'qq' | 'wechat' | 'email' | 'sms'
+        :raises DeliveryError:
+        """
+        raise NotImplementedError
+
+
+class FakeDeliverySink(DeliverySink):
+    """Keeps deliveries in memory, for tests and dry runs"""
+
+    def __init__(self, delay: float = 0., failures: dict[str, int] = None, rejected: set[str] = None):
+        """
+        :param failures: destination -> number of attempts that fail before one succeeds
+        :param rejected: destinations that fail for good
+        """
+        self.delay = delay
+        self.failures = dict(failures or {})
+        self.rejected = set(rejected or ())
+        self.sent: list[tuple[str, str, str]] = []
+        self.attempts: Counter[str] = Counter()
+        self.inflight = 0
+        self.max_inflight = 0
+
+    async def send(self, channel: str, destination: str, message: str) -> None:
+        self.attempts[destination] += 1
+        self.inflight += 1
+        self.max_inflight = max(self.max_inflight, self.inflight)
+        try:
+            await asyncio.sleep(self.delay)
+            if destination in self.rejected:
+                raise DeliveryError(f"{destination} rejected the message", retryable=False)
+            if self.failures.get(destination, 0) > 0:
+                self.failures[destination] -= 1
+                raise DeliveryError(f"{destination} timed out")
+            self.sent.append((channel, destination, message))
+        finally:
+            self.inflight -= 1
+
+
+class _Page:
+    __slots__ = ("marker", "remaining", "delivered", "failed")
+
+    def __init__(self, marker, remaining: int):
+        self.marker = marker
+        self.remaining = remaining
+        self.delivered = 0
+        self.failed = 0
+
+
+class AnnouncementFanOut:
+    """
+    Sends a :class:`Broadcast` to ``[system] announcement_qq_group`` and every reachable user.
+
+    Users are read in keyset pages while ``[announcement] workers`` deliveries run concurrently, each channel
+    throttled by its ``channel_rate_limits`` bucket and failed deliveries retried with exponential backoff.
+    Groups go out in pages of the same size. Progress is checkpointed once a page is fully delivered, in page
+    order, so an interrupted broadcast resumes after the last complete page; recipients of the page in flight may
+    get the message twice. A worker shutting down stops between pages and leaves the broadcast to :meth:`resume`
+    on the next start. The claim is renewed every third of ``[announcement] lease_in_seconds``, a run that lost
+    it to another worker stops without writing progress.
+    """
+
+    def __init__(
+            self,
+            sink: Optional[DeliverySink],
+            rate_limits: Optional[RateLimitBackend] = None,
+            sleep: Callable[[float], Awaitable] = asyncio.sleep
+    ):
+        self.sink = sink
+        if rate_limits is None:
+            rate_limits = LocalRateLimitBackend(idle_timeout_in_seconds=3600, max_keys=1000)
+        self.rate_limits = rate_limits
+        self._sleep = sleep
+
+    async def start(self, session: AsyncSession, message: str, groups: Optional[list[str]] = None) -> Broadcast:
+        """
+        :param groups: defaults to ``[system] announcement_qq_group``
+        :raises NoDeliverySinkError: before anything is recorded
+        """
+        if self.sink is None:
+            raise NoDeliverySinkError()
+        if groups is None:
+            groups = list(config.system.announcement_qq_group or [])
+        broadcast = await Broadcast.create(session=session, message=message, groups=groups)
+        return await self.run(session=session, broadcast=broadcast)
+
+    async def resume(self, session: AsyncSession) -> list[Broadcast]:
+        """
+        Finish broadcasts interrupted by a shutdown or a crash that no other worker holds, left for later while
+        no sink is set
+        """
+        unfinished = await Broadcast.get_unfinished(session=session)
+        if unfinished and self.sink is None:
+            logger.warning(f"{len(unfinished)} unfinished broadcasts, no delivery sink to resume them with")
+            return []
+        return [await self.run(session=session, broadcast=broadcast)
+                for broadcast in unfinished if await broadcast.claim(session=session)]
+
+    async def run(self, session: AsyncSession, broadcast: Broadcast) -> Broadcast:
+        """Run a broadcast this worker claimed, released again when it pauses or fails"""
+        token = broadcast.claim_token
+        try:
+            return await self._run(session=session, broadcast=broadcast, token=token)
+        except Exception:
+            try:
+                await session.rollback()
+                await session.refresh(broadcast)
+                await broadcast.release(session=session, token=token)
+            except Exception as e:
+                logger.exception(e)
+            raise
+
+    async def _run(self, session: AsyncSession, broadcast: Broadcast, token: str) -> Broadcast:
+        settings = config.announcement
+        # the page readers, the checkpoints and the heartbeat share the session
+        session_lock = asyncio.Lock()
+        claim_lost = asyncio.Event()
+
+        async def write(progress: Callable[[], Awaitable[None]]):
+            try:
+                await progress()
+            except Broadcast.ClaimLostError as e:
+                logger.warning(f"{e}, stopping")
+                claim_lost.set()
+            except Exception as e:
+                # the page went out regardless, the next checkpoint moves past it
+                logger.exception(e)
+                await session.rollback()
+                await session.refresh(broadcast)
+
+        def checkpoint(page: _Page, **progress):
+            return write(lambda: broadcast.checkpoint(session, token, page.delivered, page.failed, **progress))
+
+        async def heartbeat():
+            # a page may take longer than the lease, e.g. groups at 20 a minute
+            while not claim_lost.is_set():
+                await asyncio.sleep(settings.lease_in_seconds / 3)
+                async with session_lock:
+                    await write(lambda: broadcast.renew(session, token))
+
+        groups = broadcast.group_list
+        groups_exhausted = broadcast.groups_done
+        users_exhausted = False
+
+        async def group_pages():
+            nonlocal groups_exhausted
+            for start in range(broadcast.groups_sent, len(groups), settings.page_size):
+                if not lifecycle.accepting:
+                    return
+                end = min(start + settings.page_size, len(groups))
+                yield end, [("qq_group", group) for group in groups[start:end]]
+            groups_exhausted = True
+
+        async def user_pages():
+            nonlocal users_exhausted
+            after = broadcast.last_user_id
+            while lifecycle.accepting:
+                async with session_lock:
+                    contacts = await User.get_contacts_after(session=session, after_id=after, limit=settings.page_size)
+                if not contacts:
+                    users_exhausted = True
+                    return
+                after = contacts[-1].id
+                yield after, [target for contact in contacts if (target := target_of(contact)) is not None]
+
+        renewing = asyncio.create_task(heartbeat())
+        try:
+            if not groups_exhausted:
+                await self._fan_out(
+                    group_pages(), broadcast.message, session_lock, claim_lost,
+                    lambda page: checkpoint(page, groups_sent=page.marker, groups_done=page.marker == len(groups))
+                )
+            if groups_exhausted and not claim_lost.is_set():
+                await self._fan_out(
+                    user_pages(), broadcast.message, session_lock, claim_lost,
+                    lambda page: checkpoint(page, groups_sent=len(groups), groups_done=True,
+                                            last_user_id=page.marker)
+                )
+        finally:
+            renewing.cancel()
+            await asyncio.gather(renewing, return_exceptions=True)
+
+        if claim_lost.is_set():
+            return broadcast
+        if not users_exhausted:
+            logger.info(f"Broadcast {broadcast.id} paused after group {broadcast.groups_sent}, "
+                        f"user {broadcast.last_user_id} for shutdown")
+            await broadcast.release(session=session, token=token)
+            return broadcast
+        try:
+            await broadcast.checkpoint(session, token, 0, 0, groups_sent=len(groups), groups_done=True, finished=True)
+        except Broadcast.ClaimLostError as e:
+            logger.warning(f"{e}, stopping")
+            return broadcast
+        logger.info(f"Broadcast {broadcast.id} done, {broadcast.delivered} delivered, {broadcast.failed} failed")
+        return broadcast
+
+    async def _fan_out(
+            self,
+            pages: AsyncIterator[tuple[object, list[Target]]],
+            message: str,
+            session_lock: asyncio.Lock,
+            stop: asyncio.Event,
+            checkpoint: Callable[[_Page], Awaitable[None]]
+    ):
+        """
+        Deliver page by page through a bounded queue, checkpointing completed pages in order. Once ``stop`` is
+        set no more pages are read and queued targets are skipped.
+        """
+        workers = max(1, config.announcement.workers)
+        queue: asyncio.Queue[tuple[_Page, Target]] = asyncio.Queue(maxsize=workers)
+        pending: deque[_Page] = deque()
+
+        async def advance():
+            while pending and pending[0].remaining == 0 and not stop.is_set():
+                page = pending.popleft()
+                # the lock is FIFO, checkpoints are written in page order
+                async with session_lock:
+                    await checkpoint(page)
+
+        async def work():
+            while True:
+                page, (channel, destination) = await queue.get()
+                try:
+                    delivered = not stop.is_set() and await self.deliver(channel, destination, message)
+                except Exception as e:
+                    logger.exception(e)
+                    delivered = False
+                if delivered:
+                    page.delivered += 1
+                else:
+                    page.failed += 1
+                page.remaining -= 1
+                try:
+                    await advance()
+                except Exception as e:
+                    # a worker that died here would stall every later page
+                    logger.exception(e)
+                finally:
+                    queue.task_done()
+
+        tasks = [asyncio.create_task(work()) for _ in range(workers)]
+        try:
+            async for marker, targets in pages:
+                page = _Page(marker, len(targets))
+                pending.append(page)
+                for target in targets:
+                    await queue.put((page, target))
+                await advance()
+                if stop.is_set():
+                    break
+            await queue.join()
+            await advance()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def deliver(self, channel: str, destination: str, message: str) -> bool:
+        """
+        :return: whether the message got through within ``[announcement] max_attempts``
+        """
+        settings = config.announcement
+        rule = settings.channel_rate_limits.get(channel)
+        for attempt in range(settings.max_attempts):
+            if rule is not None:
+                while retry_after := await self.rate_limits.acquire(
+                        [f"announcement:{channel}"], rule.requests_per_minute / 60, rule.burst
+                ):
+                    await self._sleep(retry_after)
+            try:
+                await self.sink.send(channel, destination, message)
+                return True
+            except DeliveryError as e:
+                if not e.retryable or attempt == settings.max_attempts - 1:
+                    logger.warning(f"Announcement to {channel} {destination} failed: {e}")
+                    return False
+            except Exception as e:
+                logger.exception(e)
+                return False
+            await self._sleep(settings.retry_base_delay_in_seconds * 2 ** attempt)
+        return False
+
+
+announcement_fan_out = AnnouncementFanOut(sink=None)
+"""The bot platform's client sets ``sink`` once it is connected"""
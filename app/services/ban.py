@@ -0,0 +1,139 @@
+import asyncio
+import heapq
+from datetime import datetime, timedelta
+from typing import Optional, Callable, Awaitable, Iterable
+
+from loguru import logger
+
+IDENTIFIERS = ("uuid", "qq_number", "wechat_id", "phone_number", "email")
+
+
+class BanRegistry:
+    """
+    In-memory view of the banned users, so a request can be rejected before any database work.
+
+    Users are keyed by id, with their external identifiers mapped onto the id. Timed bans are kept in a
+    min-heap ordered by ``current_banned_since + current_banned_period``; :meth:`run_expiry` sleeps until
+    the earliest one and hands the due ids to a callback instead of polling the database.
+    """
+
+    def __init__(self):
+        self._expires_at: dict[int, Optional[datetime]] = {}
+        self._identifiers: dict[int, list[tuple[str, str]]] = {}
+        self._by_identifier: dict[tuple[str, str], int] = {}
+        self._heap: list[tuple[datetime, int]] = []
+        self._wakeup = asyncio.Event()
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._expires_at
+
+    def __len__(self) -> int:
+        return len(self._expires_at)
+
+    def clear(self):
+        self._expires_at.clear()
+        self._identifiers.clear()
+        self._by_identifier.clear()
+        self._heap.clear()
+
+    def add(
+            self,
+            user_id: int,
+            banned_since: Optional[datetime] = None,
+            banned_period: Optional[timedelta] = None,
+            **identifiers
+    ):
+        """
+        :param user_id:
+        :param banned_since:
+        :param banned_period: None for a permanent ban
+        :param identifiers: uuid, qq_number, wechat_id, phone_number, email
+        """
+        self.discard(user_id)
+
+        expires_at = None
+        if banned_period is not None:
+            expires_at = (banned_since or datetime.utcnow()) + banned_period
+            if not self._heap or expires_at < self._heap[0][0]:
+                self._wakeup.set()
+            heapq.heappush(self._heap, (expires_at, user_id))
+        self._expires_at[user_id] = expires_at
+
+        keys = [(name, str(value)) for name, value in identifiers.items() if value is not None and name in IDENTIFIERS]
+        self._identifiers[user_id] = keys
+        for key in keys:
+            self._by_identifier[key] = user_id
+
+    def add_user(self, user):
+        self.add(
+            user.id, user.current_banned_since, user.current_banned_period,
+            **{name: getattr(user, name) for name in IDENTIFIERS}
+        )
+
+    def discard(self, user_id: int):
+        """Stale heap entries are skipped lazily in :meth:`pop_expired`"""
+        self._expires_at.pop(user_id, None)
+        for key in self._identifiers.pop(user_id, ()):
+            self._by_identifier.pop(key, None)
+
+    def is_banned(self, id: Optional[int] = None, now: Optional[datetime] = None, **identifiers) -> bool:
+        """
+        Check by id or by any of the external identifiers. Bans whose period already ran out count as lifted.
+        """
+        if id is None:
+            for name, value in identifiers.items():
+                if value is not None and (id := self._by_identifier.get((name, str(value)))) is not None:
+                    break
+            else:
+                return False
+
+        if id not in self._expires_at:
+            return False
+        expires_at = self._expires_at[id]
+        return expires_at is None or expires_at > (now or datetime.utcnow())
+
+    def next_expiry(self) -> Optional[datetime]:
+        return self._heap[0][0] if self._heap else None
+
+    def pop_expired(self, now: Optional[datetime] = None) -> list[int]:
+        now = now or datetime.utcnow()
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            expires_at, user_id = heapq.heappop(self._heap)
+            if self._expires_at.get(user_id, False) == expires_at:
+                self.discard(user_id)
+                expired.append(user_id)
+        return expired
+
+    def load(self, users: Iterable):
+        """Replace the registry content with the given banned users"""
+        self.clear()
+        for user in users:
+            self.add_user(user)
+        logger.debug(f"Loaded {len(self)} banned users")
+
+    async def run_expiry(self, on_expired: Callable[[list[int]], Awaitable]):
+        """
+        Lift timed bans as they run out. Meant to run as a background task for the app lifetime.
+
+        :param on_expired: persists the lifted bans, receives the user ids
+        """
+        while True:
+            self._wakeup.clear()
+            if (expires_at := self.next_expiry()) is not None:
+                timeout = max((expires_at - datetime.utcnow()).total_seconds(), 0)
+            else:
+                timeout = None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+            if expired := self.pop_expired():
+                try:
+                    await on_expired(expired)
+                except Exception as e:
+                    logger.exception(e)
+
+
+ban_registry = BanRegistry()
@@ -0,0 +1,56 @@
+import asyncio
+from typing import Awaitable, Callable, Generic, Hashable, Mapping, Optional, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class BatchLoader(Generic[K, V]):
+    """
+    Coalesce single lookups into batches, in the spirit of DataLoader.
+
+    :meth:`load` calls made while the event loop runs one round of ready callbacks are collected and handed
+    to ``batch`` in one call on the next round, so concurrent requests resolving a user each cost a share of
+    one query. Keys requested several times in a round are fetched once.
+    """
+
+    def __init__(self, batch: Callable[[list[K]], Awaitable[Mapping[K, V]]], max_batch_size: int = 1000):
+        """
+        :param batch: returns the found values by key, missing keys resolve to None
+        :param max_batch_size: larger rounds are split into several batches
+        """
+        self._batch = batch
+        self._max_batch_size = max_batch_size
+        self._pending: dict[K, list[asyncio.Future]] = {}
+        self._dispatch_scheduled = False
+
+    async def load(self, key: K) -> Optional[V]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.setdefault(key, []).append(future)
+        if not self._dispatch_scheduled:
+            self._dispatch_scheduled = True
+            loop.call_soon(self._dispatch)
+        return await future
+
+    def _dispatch(self):
+        pending, self._pending = self._pending, {}
+        self._dispatch_scheduled = False
+        keys = list(pending)
+        for start in range(0, len(keys), self._max_batch_size):
+            batch = {key: pending[key] for key in keys[start:start + self._max_batch_size]}
+            asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, pending: dict[K, list[asyncio.Future]]):
+        try:
+            found = await self._batch(list(pending))
+        except Exception as e:
+            for futures in pending.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+        for key, futures in pending.items():
+            for future in futures:
+                if not future.done():
+                    future.set_result(found.get(key))
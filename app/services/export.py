@@ -0,0 +1,159 @@
+import csv
+import io
+import json
+import uuid
+import zlib
+from dataclasses import dataclass
+from datetime import date, datetime, time
+from typing import Any, AsyncIterator, Optional, Sequence
+
+from sqlalchemy import DateTime, Row, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import config
+from app.database.models.daily_stats import DailyStats
+from app.database.models.usage_rollup import UsageRollup
+from app.database.models.user import User
+
+FORMATS = ("csv", "jsonl")
+
+
+@dataclass(frozen=True)
+class Dataset:
+    columns: tuple
+    moment: Any
+    """Column ``since`` and ``until`` filter on"""
+    order_by: tuple
+    where: tuple = ()
+
+    @property
+    def names(self) -> list[str]:
+        return [column.key for column in self.columns]
+
+
+DATASETS = {
+    "users": Dataset(
+        columns=(
+            User.id, User.uuid, User.qq_number, User.wechat_id, User.phone_number, User.email, User.is_banned,
+            User.balance_in_cents, User.gifted_balance_in_cents, User.billing_rate, User.total_token_usage,
+            User.total_recharged_amount_in_cents, User.total_bonus_amount_in_cents, User.inviter_id,
+            User.created_time,
+        ),
+        moment=User.created_time,
+        order_by=(User.id,),
+    ),
+    "stats": Dataset(
+        columns=(
+            DailyStats.date_interval, DailyStats.api_calls, DailyStats.frontend_types, DailyStats.images_ocred,
+            DailyStats.sd_images_generated, DailyStats.invite_code_binds, DailyStats.recharged_amount_in_cents,
+            DailyStats.user_usage_amount_in_cents, DailyStats.bonus_amount_in_cents,
+        ),
+        moment=DailyStats.date_interval,
+        order_by=(DailyStats.date_interval, DailyStats.id),
+    ),
+    "ledger": Dataset(
+        columns=(
+            UsageRollup.bucket_start, UsageRollup.user_id, UsageRollup.feature, UsageRollup.events,
+            UsageRollup.amount_in_cents, UsageRollup.token_usage,
+        ),
+        moment=UsageRollup.bucket_start,
+        order_by=(UsageRollup.bucket_start, UsageRollup.id),
+        where=(UsageRollup.granularity == UsageRollup.DAY,),
+    ),
+}
+"""``ledger`` is the daily per-user rollup of charges, bonuses and usage"""
+
+
+def _bound(dataset: Dataset, value: date):
+    if isinstance(dataset.moment.type, DateTime) and not isinstance(value, datetime):
+        return datetime.combine(value, time())
+    return value
+
+
+def _text(value) -> Any:
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    return value
+
+
+async def stream_rows(
+        session: AsyncSession,
+        dataset: str,
+        since: Optional[date] = None,
+        until: Optional[date] = None,
+        chunk_rows: Optional[int] = None
+) -> AsyncIterator[Sequence[Row]]:
+    """
+    Rows of a dataset, ``chunk_rows`` at a time from a server side cursor
+
+    :param since: inclusive
+    :param until: exclusive
+    :raises ValueError: for an unknown dataset
+    """
+    if (spec := DATASETS.get(dataset)) is None:
+        raise ValueError(f"Unknown dataset {dataset!r}")
+    query = select(*spec.columns).where(*spec.where).order_by(*spec.order_by)
+    if since is not None:
+        query = query.where(spec.moment >= _bound(spec, since))
+    if until is not None:
+        query = query.where(spec.moment < _bound(spec, until))
+
+    result = await session.stream(query.execution_options(yield_per=chunk_rows or config.export.chunk_rows))
+    async for rows in result.partitions():
+        yield rows
+
+
+async def export(
+        session: AsyncSession,
+        dataset: str,
+        format: str = "csv",
+        since: Optional[date] = None,
+        until: Optional[date] = None,
+        compress: bool = False,
+        chunk_rows: Optional[int] = None
+) -> AsyncIterator[bytes]:
+    """
+    A dataset serialized chunk by chunk, only one chunk of rows is held at a time
+
+    :param format: 'csv' with a header row, or 'jsonl' with one object per row
+    :param compress: gzip on the fly
+    :raises ValueError: for an unknown dataset or format
+    """
+    if format not in FORMATS:
+        raise ValueError(f"Unknown format {format!r}")
+    if dataset not in DATASETS:
+        raise ValueError(f"Unknown dataset {dataset!r}")
+    names = DATASETS[dataset].names
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16) if compress else None
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+
+    def drain() -> bytes:
+        data = buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+        return compressor.compress(data) if compressor else data
+
+    if format == "csv":
+        writer.writerow(names)
+    async for rows in stream_rows(session, dataset, since=since, until=until, chunk_rows=chunk_rows):
+        if format == "csv":
+            writer.writerows([_text(value) for value in row] for row in rows)
+        else:
+            buffer.writelines(
+                json.dumps(dict(zip(names, map(_text, row))), ensure_ascii=False) + "\n" for row in rows
+            )
+        if data := drain():
+            yield data
+    if data := drain():
+        yield data
+    if compressor:
+        yield compressor.flush()
+
+
+def filename(dataset: str, format: str, since: Optional[date] = None, until: Optional[date] = None,
+             compress: bool = False) -> str:
+    period = "".join(f"-{moment.isoformat()}" for moment in (since, until) if moment is not None)
+    return f"{dataset}{period}.{format}" + (".gz" if compress else "")
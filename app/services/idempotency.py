@@ -0,0 +1,158 @@
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Optional, TypeVar
+
+from sqlalchemy import exc
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import config
+from app.database.models.idempotency_record import IdempotencyRecord
+from app.database.unit_of_work import (
+    commit, in_unit_of_work, on_unit_commit, on_unit_end, rollback, rollback_only, unit_of_work
+)
+
+MAX_KEY_LENGTH = 255
+
+T = TypeVar("T")
+
+
+def key_hash(operation: str, user_id: int, key: str) -> str:
+    return hashlib.sha256(f"{operation}\x00{user_id}\x00{key}".encode()).hexdigest()
+
+
+class Idempotency:
+    """
+    Billing calls made at most once per ``Idempotency-Key``, so a gateway retrying on a timeout does not charge,
+    pay or bind twice.
+
+    The result is stored in ``idempotency_records`` in the same transaction as the call, with recent results
+    kept in memory in front of the table. A retry is answered from either without running the call or reading
+    the user. Concurrent retries in this process wait for the first attempt until its transaction ends, a retry
+    racing it in another worker loses on the unique key, is rolled back and answered with the stored result.
+    """
+
+    def __init__(self, max_cached_entries: Optional[int] = None, clock: Callable[[], float] = time.monotonic):
+        """Limits left to None follow ``[billing.idempotency]`` in the current config"""
+        self._max_cached_entries = max_cached_entries
+        self._clock = clock
+        self._cache: OrderedDict[str, tuple[Any, float]] = OrderedDict()
+        """key digest -> (result, expires at), oldest first"""
+        self._inflight: dict[str, tuple[AsyncSession, asyncio.Future]] = {}
+        """key digest -> (session making the call, resolved once its transaction ended)"""
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def clear(self):
+        self._cache.clear()
+
+    def _cached(self, digest: str) -> tuple[bool, Any]:
+        if (entry := self._cache.get(digest)) is None:
+            return False, None
+        result, expires_at = entry
+        if expires_at <= self._clock():
+            del self._cache[digest]
+            return False, None
+        return True, result
+
+    def _remember(self, digest: str, result: Any):
+        settings = config.billing.idempotency
+        max_entries = self._max_cached_entries if self._max_cached_entries is not None else \
+            settings.max_cached_entries
+        self._cache[digest] = (result, self._clock() + settings.ttl_in_seconds)
+        self._cache.move_to_end(digest)
+        while len(self._cache) > max_entries:
+            self._cache.popitem(last=False)
+
+    async def run(
+            self,
+            session: AsyncSession,
+            key: Optional[str],
+            operation: str,
+            user_id: int,
+            call: Callable[[], Awaitable[T]]
+    ) -> T:
+        """
+        :param key: the client's ``Idempotency-Key``, None to just run ``call``
+        :param operation: e.g. 'charge', 'pay', 'bind_invite_code'
+        :param user_id: the user the call bills, keys are per user and operation
+        :param call: the billing call, its result must be JSON serializable. A call that raises or rolls back
+            is not recorded, the next retry runs it again.
+        """
+        if key is None:
+            return await call()
+        digest = key_hash(operation, user_id, key)
+
+        while (pending := self._inflight.get(digest)) is not None:
+            holder, done = pending
+            if holder is session:
+                # retried within the transaction that made the call, its record is already flushed
+                return await self._run(session, digest, operation, call)
+            await asyncio.wait([done])
+        found, result = self._cached(digest)
+        if found:
+            return result
+
+        done = asyncio.get_running_loop().create_future()
+        self._inflight[digest] = (session, done)
+
+        def release():
+            del self._inflight[digest]
+            done.set_result(None)
+
+        if in_unit_of_work(session):
+            # the record is only visible to other sessions once the outer unit of work commits
+            on_unit_end(session, release)
+            return await self._run(session, digest, operation, call)
+        try:
+            return await self._run(session, digest, operation, call)
+        finally:
+            release()
+
+    async def _run(self, session: AsyncSession, digest: str, operation: str, call: Callable[[], Awaitable[T]]) -> T:
+        if (stored := await IdempotencyRecord.get_result(session=session, key_hash=digest)) is not None:
+            result = json.loads(stored)
+            self._remember(digest, result)
+            return result
+
+        owner = not in_unit_of_work(session)
+        try:
+            async with unit_of_work(session):
+                result = await call()
+                if rollback_only(session):
+                    return result
+                await IdempotencyRecord.put(
+                    session=session, key_hash=digest, operation=operation, result=json.dumps(result),
+                    expires_at=datetime.utcnow() + timedelta(seconds=config.billing.idempotency.ttl_in_seconds)
+                )
+                await commit(session)
+        except exc.IntegrityError:
+            # another worker recorded the same key first, this attempt is rolled back along with the outer unit
+            if not owner:
+                await rollback(session)
+            if (stored := await IdempotencyRecord.get_result(session=session, key_hash=digest)) is None:
+                raise
+            result = json.loads(stored)
+            self._remember(digest, result)
+            return result
+
+        if owner:
+            self._remember(digest, result)
+        else:
+            on_unit_commit(session, lambda: self._remember(digest, result))
+        return result
+
+    async def purge(self, session: AsyncSession) -> int:
+        """
+        :return: number of expired records removed
+        """
+        removed = await IdempotencyRecord.purge(session=session)
+        await commit(session)
+        return removed
+
+
+idempotency = Idempotency()
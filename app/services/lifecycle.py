@@ -0,0 +1,54 @@
+import asyncio
+import contextlib
+from typing import AsyncIterator
+
+from loguru import logger
+
+
+class Lifecycle:
+    """
+    Worker shutdown bookkeeping.
+
+    Streaming runs and background jobs that write, such as archiving threads or lifting bans, register
+    themselves with :meth:`track` so shutdown waits for them before the engine is disposed.
+    """
+
+    def __init__(self):
+        self.accepting = True
+        self._inflight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    @property
+    def inflight(self) -> int:
+        return self._inflight
+
+    @contextlib.asynccontextmanager
+    async def track(self) -> AsyncIterator[None]:
+        self._inflight += 1
+        self._idle.clear()
+        try:
+            yield
+        finally:
+            self._inflight -= 1
+            if self._inflight == 0:
+                self._idle.set()
+
+    def stop_accepting(self):
+        self.accepting = False
+
+    async def drain(self, timeout: float) -> bool:
+        """
+        :return: False if runs were still in flight when the timeout ran out
+        """
+        if self._inflight:
+            logger.info(f"Draining {self._inflight} in-flight runs and jobs..")
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            logger.warning(f"{self._inflight} runs still in flight after {timeout}s")
+            return False
+
+
+lifecycle = Lifecycle()
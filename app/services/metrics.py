@@ -0,0 +1,216 @@
+import bisect
+import contextlib
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Callable, Iterable, Iterator, Optional
+
+from loguru import logger
+from sqlalchemy import Engine, event
+
+from app.config import hot_config
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+STATEMENT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+MAX_BREAKDOWN_STATEMENTS = 500
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class HistogramFamily:
+    """One :class:`Histogram` per label values, rendered in the Prometheus text format"""
+
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...], buckets: tuple[float, ...]):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = buckets
+        self.children: dict[tuple[str, ...], Histogram] = {}
+
+    def labels(self, *values: str) -> Histogram:
+        if (histogram := self.children.get(values)) is None:
+            histogram = self.children[values] = Histogram(self.buckets)
+        return histogram
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for values, histogram in self.children.items():
+            labels = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(self.label_names, values))
+            prefix = labels + "," if labels else ""
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), histogram.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                lines.append(f'{self.name}_bucket{{{prefix}le="{le}"}} {cumulative}')
+            suffix = f"{{{labels}}}" if labels else ""
+            lines.append(f"{self.name}_sum{suffix} {histogram.sum}")
+            lines.append(f"{self.name}_count{suffix} {histogram.count}")
+        return lines
+
+
+class SampleFamily:
+    """Gauges or counters read from their source when rendered"""
+
+    def __init__(
+            self,
+            name: str,
+            help: str,
+            label_names: tuple[str, ...],
+            collect: Callable[[], Iterable[tuple[tuple[str, ...], float]]],
+            type: str = "gauge"
+    ):
+        """
+        :param collect: returns (label values, value) pairs
+        :param type: 'gauge' or 'counter'
+        """
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.collect = collect
+        self.type = type
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for values, value in self.collect():
+            labels = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(self.label_names, values))
+            lines.append(f"{self.name}{{{labels}}} {value}" if labels else f"{self.name} {value}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+@dataclass
+class RequestStats:
+    statements: int = 0
+    statement_seconds: float = 0.
+    breakdown: Optional[list[tuple[str, float]]] = field(default=None)
+    """(statement, seconds), only collected when the slow request log is on"""
+
+
+_request_stats: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+
+class Metrics:
+    """
+    Per-process instrumentation: request latency per route, database statements per request and upstream
+    call timings. Each worker exposes its own numbers on ``/metrics``.
+    """
+
+    def __init__(self):
+        self.request_duration = HistogramFamily(
+            "http_request_duration_seconds", "HTTP request latency", ("method", "route", "status"), LATENCY_BUCKETS
+        )
+        self.request_statements = HistogramFamily(
+            "http_request_db_statements", "Database statements per HTTP request", ("route",), COUNT_BUCKETS
+        )
+        self.statement_duration = HistogramFamily(
+            "db_statement_duration_seconds", "Database statement latency", (), STATEMENT_BUCKETS
+        )
+        self.upstream_duration = HistogramFamily(
+            "upstream_request_duration_seconds", "Upstream call latency", ("upstream", "outcome"), LATENCY_BUCKETS
+        )
+        self.families = [self.request_duration, self.request_statements, self.statement_duration,
+                         self.upstream_duration]
+
+    def add_family(self, family) -> "HistogramFamily":
+        """Register another metric family, anything with ``render() -> list[str]``"""
+        self.families.append(family)
+        return family
+
+    def render(self) -> str:
+        return "\n".join(line for family in self.families for line in family.render()) + "\n"
+
+    def instrument_engine(self, engine: Engine):
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info.pop("query_started", time.perf_counter())
+        self.statement_duration.labels().observe(elapsed)
+        if (stats := _request_stats.get()) is not None:
+            stats.statements += 1
+            stats.statement_seconds += elapsed
+            if stats.breakdown is not None and len(stats.breakdown) < MAX_BREAKDOWN_STATEMENTS:
+                stats.breakdown.append((statement, elapsed))
+
+    @contextlib.contextmanager
+    def time_upstream(self, upstream: str) -> Iterator[None]:
+        """Time a call to an upstream service, e.g. ``with metrics.time_upstream("openai"):``"""
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            yield
+            outcome = "ok"
+        finally:
+            self.upstream_duration.labels(upstream, outcome).observe(time.perf_counter() - started)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info["query_started"] = time.perf_counter()
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware, records latency and statement counts per route template"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        hot = hot_config()
+        if scope["type"] != "http" or not hot.metrics_enabled:
+            return await self.app(scope, receive, send)
+
+        slow_threshold = hot.slow_request_threshold_in_seconds
+        stats = RequestStats(breakdown=[] if slow_threshold > 0 else None)
+        token = _request_stats.set(stats)
+        status_code = 500
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            _request_stats.reset(token)
+            route = scope.get("route")
+            route_path = route.path if route is not None else "unmatched"
+            metrics.request_duration.labels(scope["method"], route_path, str(status_code)).observe(elapsed)
+            metrics.request_statements.labels(route_path).observe(stats.statements)
+            if 0 < slow_threshold <= elapsed:
+                _log_slow_request(
+                    scope["method"], route_path, status_code, elapsed, stats, hot.slow_request_statements
+                )
+
+
+def _log_slow_request(method: str, route: str, status_code: int, elapsed: float, stats: RequestStats, limit: int):
+    slowest = sorted(stats.breakdown, key=lambda item: item[1], reverse=True)[:limit]
+    lines = [f"  {seconds * 1000:8.2f} ms  {' '.join(statement.split())[:200]}" for statement, seconds in slowest]
+    logger.warning(
+        f"Slow request {method} {route} {status_code} took {elapsed * 1000:.1f} ms, "
+        f"{stats.statements} statements in {stats.statement_seconds * 1000:.1f} ms"
+        + ("\n" + "\n".join(lines) if lines else "")
+    )
+
+
+metrics = Metrics()
@@ -0,0 +1,137 @@
+import time
+from collections import OrderedDict
+from typing import Callable, Iterable, Optional
+
+from app.config import hot_config
+
+
+class RateLimitBackend:
+    """Stores the token buckets. Swap in a shared implementation to limit across processes."""
+
+    async def acquire(self, keys: list[str], rate: float, burst: int, cost: float = 1) -> float:
+        """
+        Take ``cost`` tokens from every bucket in ``keys``, or from none of them.
+
+        :param keys:
+        :param rate: tokens refilled per second
+        :param burst: bucket capacity
+        :param cost:
+        :return: 0 if allowed, else seconds until the request would be allowed
+        """
+        return await self.acquire_buckets([(key, rate, burst) for key in keys], cost=cost)
+
+    async def acquire_buckets(self, buckets: list[tuple[str, float, int]], cost: float = 1) -> float:
+        """
+        :meth:`acquire` with a rule per bucket
+
+        :param buckets: (key, tokens refilled per second, capacity)
+        """
+        raise NotImplementedError
+
+
+class LocalRateLimitBackend(RateLimitBackend):
+    """
+    Per-process token buckets, one ``(tokens, updated_at)`` tuple per active key.
+
+    Keys are kept in least-recently-used order, so idle keys are evicted from the front in O(1) per key.
+    """
+
+    def __init__(
+            self,
+            idle_timeout_in_seconds: Optional[float] = None,
+            max_keys: Optional[int] = None,
+            clock: Callable[[], float] = time.monotonic
+    ):
+        """Limits left to None follow ``[rate_limit]`` in the current config"""
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+        self._idle_timeout = idle_timeout_in_seconds
+        self._max_keys = max_keys
+        self._clock = clock
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    async def acquire_buckets(self, buckets: list[tuple[str, float, int]], cost: float = 1) -> float:
+        now = self._clock()
+        self._evict(now)
+
+        levels = []
+        retry_after = 0.
+        for key, rate, burst in buckets:
+            tokens, updated_at = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+            if tokens < cost:
+                retry_after = max(retry_after, (cost - tokens) / rate)
+            levels.append((key, tokens))
+
+        for key, tokens in levels:
+            self._buckets[key] = (tokens if retry_after else tokens - cost, now)
+            self._buckets.move_to_end(key)
+        return retry_after
+
+    def _evict(self, now: float):
+        idle_timeout, max_keys = self._idle_timeout, self._max_keys
+        if idle_timeout is None or max_keys is None:
+            hot = hot_config()
+            idle_timeout = hot.rate_limit_idle_timeout_in_seconds if idle_timeout is None else idle_timeout
+            max_keys = hot.rate_limit_max_keys if max_keys is None else max_keys
+
+        while self._buckets:
+            key, (_, updated_at) = next(iter(self._buckets.items()))
+            if now - updated_at < idle_timeout and len(self._buckets) < max_keys:
+                break
+            del self._buckets[key]
+
+
+class RateLimiter:
+    def __init__(self, backend: RateLimitBackend):
+        self.backend = backend
+        self._endpoint_class_cache: dict[str, str] = {}
+        self._cached_for = None
+
+    def endpoint_class(self, path: str) -> str:
+        """
+        Resolve a route path to its endpoint class by the longest prefix in ``config.rate_limit.endpoint_classes``
+        """
+        hot = hot_config()
+        if self._cached_for is not hot:
+            self._endpoint_class_cache = {}
+            self._cached_for = hot
+
+        if (endpoint_class := self._endpoint_class_cache.get(path)) is None:
+            endpoint_class = next(
+                (name for prefix, name in hot.rate_limit_endpoint_classes if path.startswith(prefix)), "default"
+            )
+            self._endpoint_class_cache[path] = endpoint_class
+        return endpoint_class
+
+    async def hit(
+            self,
+            endpoint_class: str,
+            identities: Iterable[tuple[str, str]],
+            ip: Optional[str] = None
+    ) -> float:
+        """
+        :param endpoint_class: 'default' | 'chat' | 'image' | 'ocr' | 'tts'
+        :param identities: (kind, value) pairs such as ("uuid", ...), ("qq_number", ...)
+        :param ip: the client IP, limited by ``[rate_limit.ip]`` and by the endpoint class when there are no
+            identities
+        :return: 0 if allowed, else seconds to wait
+        """
+        hot = hot_config()
+        if not hot.rate_limit_enabled:
+            return 0.
+        rate, burst = hot.rate_limits[endpoint_class]
+        keys = [f"{endpoint_class}:{kind}:{value}" for kind, value in identities if value]
+        if not keys and ip:
+            keys.append(f"{endpoint_class}:ip:{ip}")
+        buckets = [(key, rate, burst) for key in keys]
+        if ip:
+            ip_rate, ip_burst = hot.rate_limit_ip
+            buckets.append((f"ip:{ip}", ip_rate, ip_burst))
+        if not buckets:
+            return 0.
+        return await self.backend.acquire_buckets(buckets)
+
+
+rate_limiter = RateLimiter(LocalRateLimitBackend())
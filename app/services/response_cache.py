@@ -0,0 +1,138 @@
+import asyncio
+import hashlib
+import math
+import re
+import unicodedata
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import config
+from app.database.models.cached_response import CachedResponse
+from app.database.unit_of_work import commit
+
+SHINGLE_CHARS = 3
+"""Character shingles, so messages without spaces between words hash as well"""
+
+_whitespace = re.compile(r"\s+")
+
+
+def normalize(text: str) -> str:
+    """Fold width, case, punctuation and whitespace differences that do not change what is asked"""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    text = "".join(" " if unicodedata.category(char).startswith("P") else char for char in text)
+    return _whitespace.sub(" ", text).strip()
+
+
+def simhash(text: str) -> int:
+    """64 bit SimHash of the character shingles of a normalized text"""
+    if len(text) <= SHINGLE_CHARS:
+        shingles = [text]
+    else:
+        shingles = [text[i:i + SHINGLE_CHARS] for i in range(len(text) - SHINGLE_CHARS + 1)]
+
+    weights = [0] * 64
+    for shingle in shingles:
+        value = int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest(), "big")
+        for bit in range(64):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    return sum(1 << bit for bit, weight in enumerate(weights) if weight > 0)
+
+
+def _sha256(*parts: str) -> str:
+    return hashlib.sha256("\x00".join(parts).encode()).hexdigest()
+
+
+class ResponseCache:
+    """
+    Completions of low temperature requests, reused for the same or a nearly identical message under the same
+    system prompt, model and temperature. Opt in with ``[response_cache] enabled`` and per assistant.
+    """
+
+    @staticmethod
+    def cacheable(assistant_enabled: bool, temperature: float) -> bool:
+        settings = config.response_cache
+        return settings.enabled and assistant_enabled and temperature <= settings.max_temperature
+
+    @staticmethod
+    def _keys(system_prompt: str, message: str, model: str, temperature: float) -> tuple[str, str, int]:
+        """:return: (key, scope, simhash)"""
+        scope = _sha256(normalize(system_prompt), model, f"{temperature:.2f}")
+        normalized = normalize(message)
+        return _sha256(scope, normalized), scope, simhash(normalized)
+
+    async def lookup(
+            self,
+            session: AsyncSession,
+            system_prompt: str,
+            message: str,
+            model: str,
+            temperature: float
+    ) -> Optional[CachedResponse]:
+        """
+        :return: the cached response, with the hit counted, None on a miss
+        """
+        settings = config.response_cache
+        key, scope, message_hash = self._keys(system_prompt, message, model, temperature)
+        near_duplicates = len(message) >= settings.near_duplicate_min_chars
+        entry = await CachedResponse.find(
+            session=session, key=key, scope=scope, simhash=message_hash,
+            max_distance=settings.near_duplicate_max_distance if near_duplicates else 0
+        )
+        if entry is not None:
+            await CachedResponse.record_hit(session=session, id=entry.id)
+            await commit(session)
+        return entry
+
+    async def store(
+            self,
+            session: AsyncSession,
+            system_prompt: str,
+            message: str,
+            model: str,
+            temperature: float,
+            response: str,
+            token_usage: int = 0,
+            amount_in_cents: int = 0,
+    ) -> Optional[CachedResponse]:
+        """
+        :param amount_in_cents: what the completion was billed, hits are billed a share of it
+        :return: None if the response is larger than ``max_entry_bytes``
+        """
+        settings = config.response_cache
+        if len(response.encode()) > settings.max_entry_bytes:
+            return None
+        key, scope, message_hash = self._keys(system_prompt, message, model, temperature)
+        entry = await CachedResponse.put(
+            session=session, key=key, scope=scope, simhash=message_hash, model=model, temperature=temperature,
+            response=response, token_usage=token_usage, amount_in_cents=amount_in_cents,
+            expires_at=datetime.utcnow() + timedelta(seconds=settings.ttl_in_seconds),
+        )
+        await commit(session)
+        return entry
+
+    @staticmethod
+    def hit_price(entry: CachedResponse) -> int:
+        """In cents, rounded up so a hit of a billed response is never free"""
+        return math.ceil(entry.amount_in_cents * config.response_cache.hit_billing_rate_percent / 100)
+
+    @staticmethod
+    async def stream(entry: CachedResponse) -> AsyncIterator[str]:
+        """The cached response in deltas, like an upstream stream"""
+        size = max(1, config.response_cache.stream_chunk_chars)
+        response = entry.response
+        for start in range(0, len(response), size):
+            yield response[start:start + size]
+            await asyncio.sleep(0)
+
+    async def purge(self, session: AsyncSession) -> int:
+        """
+        :return: number of entries removed
+        """
+        removed = await CachedResponse.purge(session=session, max_total_bytes=config.response_cache.max_total_bytes)
+        await commit(session)
+        return removed
+
+
+response_cache = ResponseCache()
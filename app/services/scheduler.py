@@ -0,0 +1,213 @@
+import asyncio
+import contextlib
+import time
+from collections import deque
+from typing import AsyncIterator, Callable, Optional
+
+from app.config import Config, SchedulerTier, get_config
+from app.services.metrics import metrics, HistogramFamily, SampleFamily, LATENCY_BUCKETS
+from app.services.user_cache import UserSnapshot
+
+TIERS = ("paid", "free")
+HOLD_TIME_SMOOTHING = 0.2
+"""Weight of the latest call in the moving average of how long a tier holds a slot"""
+
+
+def tier_of(user: UserSnapshot) -> str:
+    """Paid while the user has recharged balance left, gifted balance alone is free"""
+    return "paid" if user.balance_in_cents > user.gifted_balance_in_cents else "free"
+
+
+class Overloaded(Exception):
+    """The request was shed, it would not reach upstream within its tier's queue time SLO"""
+
+    def __init__(self, tier: str, reason: str):
+        super().__init__(f"Upstream capacity for {tier} requests is saturated ({reason})")
+        self.tier = tier
+        self.reason = reason
+
+
+class Tier:
+    def __init__(self, name: str, settings: SchedulerTier):
+        self.name = name
+        self.settings = settings
+        self.queue: deque[tuple[float, asyncio.Future]] = deque()
+        """(enqueued at, future), oldest first"""
+        self.inflight = 0
+        self.finish = 0.
+        """Virtual time this tier's next request is charged from"""
+        self.hold_time: Optional[float] = None
+        self.shed: dict[str, int] = {"estimate": 0, "timeout": 0}
+
+    def head(self) -> Optional[asyncio.Future]:
+        while self.queue and self.queue[0][1].done():
+            self.queue.popleft()
+        return self.queue[0][1] if self.queue else None
+
+    @property
+    def queued(self) -> int:
+        return sum(1 for _, future in self.queue if not future.done())
+
+
+class Slot:
+    """Permission for one upstream call, release it once the call is over"""
+
+    def __init__(self, scheduler: "Scheduler", tier: Tier, now: float):
+        self.scheduler = scheduler
+        self.tier = tier
+        self.started = now
+        self.released = False
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        self.scheduler._release(self)
+
+
+class Scheduler:
+    """
+    Admission for upstream AI calls, so gifted-balance traffic cannot starve paying users.
+
+    Requests take one of ``[scheduler] max_concurrency`` slots. Each tier is capped at its own
+    ``max_concurrency``, and while tiers queue, freed slots go to them in proportion to their ``weight``
+    (start time fair queuing: a tier is charged ``1 / weight`` of virtual time per slot, the tier charged the
+    least goes next, and a tier coming back from idle starts at the current virtual time instead of cashing in
+    the time it was away). A request is shed with :class:`Overloaded` when its tier's queue, drained at the
+    tier's recent pace, would keep it longer than ``max_queue_time_in_seconds``, or when it did wait that long.
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic):
+        self.clock = clock
+        self.tiers: dict[str, Tier] = {}
+        self.inflight = 0
+        self.virtual_time = 0.
+        self._synced_with: Optional[Config] = None
+        self._metrics_registered = False
+
+        self.queue_wait = HistogramFamily(
+            "scheduler_queue_wait_seconds", "Time upstream AI calls waited for a slot", ("tier",), LATENCY_BUCKETS
+        )
+
+    @property
+    def settings(self):
+        current = get_config()
+        if current is not self._synced_with:
+            settings = current.scheduler
+            for name in TIERS:
+                if (tier := self.tiers.get(name)) is None:
+                    self.tiers[name] = Tier(name, getattr(settings, name))
+                else:
+                    tier.settings = getattr(settings, name)
+            self._synced_with = current
+        return current.scheduler
+
+    def register_metrics(self):
+        """Expose the scheduler on ``/metrics``, once"""
+        if self._metrics_registered:
+            return
+        self._metrics_registered = True
+        # creates the tiers, so they are scraped as 0 before the first call
+        self.settings
+        metrics.add_family(self.queue_wait)
+        metrics.add_family(SampleFamily(
+            "scheduler_queue_depth", "Upstream AI calls waiting for a slot", ("tier",),
+            lambda: [((tier.name,), tier.queued) for tier in self.tiers.values()]
+        ))
+        metrics.add_family(SampleFamily(
+            "scheduler_inflight", "Upstream AI calls holding a slot", ("tier",),
+            lambda: [((tier.name,), tier.inflight) for tier in self.tiers.values()]
+        ))
+        metrics.add_family(SampleFamily(
+            "scheduler_shed_total", "Upstream AI calls shed", ("tier", "reason"),
+            lambda: [((tier.name, reason), count) for tier in self.tiers.values() for reason, count in
+                     tier.shed.items()],
+            type="counter"
+        ))
+
+    # --- Admission ---
+    def _has_room(self, tier: Tier) -> bool:
+        settings = self.settings
+        if not settings.enabled:
+            return True
+        return self.inflight < settings.max_concurrency and tier.inflight < tier.settings.max_concurrency
+
+    def _grant(self, tier: Tier, enqueued_at: float) -> Slot:
+        start = max(tier.finish, self.virtual_time)
+        self.virtual_time = start
+        tier.finish = start + 1 / max(tier.settings.weight, 1e-9)
+        tier.inflight += 1
+        self.inflight += 1
+        now = self.clock()
+        self.queue_wait.labels(tier.name).observe(now - enqueued_at)
+        return Slot(self, tier, now)
+
+    def _expected_wait(self, tier: Tier) -> float:
+        if tier.hold_time is None:
+            return 0.
+        slots = min(tier.settings.max_concurrency, self.settings.max_concurrency)
+        return (tier.queued + 1) * tier.hold_time / max(slots, 1)
+
+    async def acquire(self, tier: str) -> Slot:
+        """
+        :param tier: see :func:`tier_of`
+        :raises Overloaded:
+        """
+        self.settings  # sync tiers with the config
+        state = self.tiers[tier]
+        now = self.clock()
+        if state.head() is None and self._has_room(state):
+            return self._grant(state, now)
+
+        max_wait = state.settings.max_queue_time_in_seconds
+        if self._expected_wait(state) > max_wait:
+            state.shed["estimate"] += 1
+            raise Overloaded(tier, "estimate")
+
+        future = asyncio.get_running_loop().create_future()
+        state.queue.append((now, future))
+        try:
+            async with asyncio.timeout(max_wait):
+                return await future
+        except TimeoutError:
+            if future.done() and not future.cancelled():
+                return future.result()
+            future.cancel()
+            state.shed["timeout"] += 1
+            raise Overloaded(tier, "timeout")
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                future.result().release()
+            future.cancel()
+            raise
+
+    @contextlib.asynccontextmanager
+    async def slot(self, user: UserSnapshot) -> AsyncIterator[Slot]:
+        """:raises Overloaded:"""
+        slot = await self.acquire(tier_of(user))
+        try:
+            yield slot
+        finally:
+            slot.release()
+
+    def _release(self, slot: Slot):
+        tier = slot.tier
+        tier.inflight -= 1
+        self.inflight -= 1
+        held = self.clock() - slot.started
+        tier.hold_time = held if tier.hold_time is None else \
+            tier.hold_time + HOLD_TIME_SMOOTHING * (held - tier.hold_time)
+        self._dispatch()
+
+    def _dispatch(self):
+        """Hand free slots to queued requests, the tier charged the least virtual time first"""
+        while True:
+            ready = [tier for tier in self.tiers.values() if tier.head() is not None and self._has_room(tier)]
+            if not ready:
+                return
+            tier = min(ready, key=lambda tier: max(tier.finish, self.virtual_time))
+            enqueued_at, future = tier.queue.popleft()
+            future.set_result(self._grant(tier, enqueued_at))
+
+
+scheduler = Scheduler()
@@ -0,0 +1,35 @@
+import contextlib
+import time
+from typing import Iterator
+
+from loguru import logger
+
+
+class StartupProfile:
+    """Wall time spent per boot phase ('import' | 'config' | 'database' | 'routing' | ...)"""
+
+    def __init__(self):
+        self.phases: dict[str, float] = {}
+
+    def record(self, name: str, seconds: float):
+        self.phases[name] = self.phases.get(name, 0.) + seconds
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def report(self) -> str:
+        total = sum(self.phases.values()) or 1.
+        lines = [f"{name:<10}{seconds * 1000:>10.1f} ms{seconds / total:>8.1%}" for name, seconds in self.phases.items()]
+        lines.append(f"{'total':<10}{sum(self.phases.values()) * 1000:>10.1f} ms")
+        return "\n".join(lines)
+
+    def log(self):
+        logger.info("Startup profile:\n" + self.report())
+
+
+startup_profile = StartupProfile()
@@ -0,0 +1,207 @@
+import asyncio
+import mmap
+import os
+import re
+import struct
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Optional
+
+from loguru import logger
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import config
+from app.database.models.thread import Thread
+from app.database.unit_of_work import commit
+
+FILE_MAGIC = b"UAAT\x01"
+"""Start of every snapshot file, the last byte is the format version"""
+MAX_OPEN_MAPS = 16
+
+_u32 = struct.Struct("<I")
+_segment_name = re.compile(r"threads-(\d{6})\.bin")
+
+
+class ArchiveError(Exception):
+    def __init__(self, msg: str = None):
+        super().__init__("Thread archive is corrupt" if not msg else msg)
+
+
+def encode(messages: list[tuple[str, str]], level: int = 6) -> bytes:
+    """
+    One thread as a snapshot record::
+
+        u32 message count
+        u32 offset of each message from the record start
+        per message: u32 length, zlib(role NUL content)
+        u32 CRC32 of everything before it
+
+    Messages are compressed one by one so a single message is read without inflating the rest.
+    """
+    blobs = [zlib.compress(role.encode() + b"\x00" + content.encode(), level) for role, content in messages]
+    offset = _u32.size * (1 + len(blobs))
+    index, body = [_u32.pack(len(blobs))], []
+    for blob in blobs:
+        index.append(_u32.pack(offset))
+        body.append(_u32.pack(len(blob)) + blob)
+        offset += _u32.size + len(blob)
+    record = b"".join(index + body)
+    return record + _u32.pack(zlib.crc32(record))
+
+
+def _decode_message(blob: bytes) -> tuple[str, str]:
+    role, _, content = zlib.decompress(blob).partition(b"\x00")
+    return role.decode(), content.decode()
+
+
+class ThreadArchive:
+    """
+    Moves threads idle for ``[archive] idle_days`` out of ``thread_messages`` into append-only snapshot files,
+    keeping the live tables small. The thread row keeps the file, offset and length of its record, a single
+    message is read through a memory map of the file and :meth:`resume` puts the messages back when the user
+    comes back to the thread.
+
+    Records of restored threads stay in their file, files are append-only and safe to back up as they are.
+    """
+
+    def __init__(self, directory: Optional[str] = None):
+        """``directory`` defaults to ``[archive] directory``"""
+        self._directory = directory
+        self._maps: OrderedDict[str, mmap.mmap] = OrderedDict()
+
+    @property
+    def directory(self) -> str:
+        return self._directory or config.archive.directory
+
+    # --- Files ---
+    def _segment(self) -> str:
+        """The file new records are appended to"""
+        os.makedirs(self.directory, exist_ok=True)
+        numbers = [int(match.group(1)) for name in os.listdir(self.directory)
+                   if (match := _segment_name.fullmatch(name))]
+        number = max(numbers, default=0)
+        path = os.path.join(self.directory, f"threads-{number:06d}.bin")
+        if os.path.exists(path) and os.path.getsize(path) >= config.archive.max_file_bytes:
+            number += 1
+        name = f"threads-{number:06d}.bin"
+        try:
+            with open(os.path.join(self.directory, name), "xb") as f:
+                f.write(FILE_MAGIC)
+        except FileExistsError:
+            pass
+        return name
+
+    def write(self, record: bytes) -> tuple[str, int]:
+        """
+        Append and fsync a record, safe with other processes appending to the same file
+
+        :return: (file name, offset)
+        """
+        name = self._segment()
+        fd = os.open(os.path.join(self.directory, name), os.O_WRONLY | os.O_APPEND)
+        try:
+            written = os.write(fd, record)
+            if written != len(record):
+                raise ArchiveError(f"Short write to {name}")
+            offset = os.lseek(fd, 0, os.SEEK_CUR) - len(record)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        return name, offset
+
+    def _map(self, name: str, end: int) -> mmap.mmap:
+        mapped = self._maps.get(name)
+        if mapped is None or len(mapped) < end:
+            # not mapped yet, or mapped before the record was appended
+            if mapped is not None:
+                mapped.close()
+            with open(os.path.join(self.directory, name), "rb") as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if mapped[:len(FILE_MAGIC)] != FILE_MAGIC or len(mapped) < end:
+                mapped.close()
+                raise ArchiveError(f"{name} is not a thread snapshot file or is truncated")
+            self._maps[name] = mapped
+        self._maps.move_to_end(name)
+        while len(self._maps) > MAX_OPEN_MAPS:
+            self._maps.popitem(last=False)[1].close()
+        return mapped
+
+    def close(self):
+        while self._maps:
+            self._maps.popitem()[1].close()
+
+    # --- Reading ---
+    def read_message(self, thread: Thread, position: int) -> tuple[str, str]:
+        """
+        One message of an archived thread, touching only its index entry and its bytes
+
+        :return: (role, content)
+        :raises IndexError:
+        :raises ArchiveError:
+        """
+        start = thread.archive_offset
+        mapped = self._map(thread.archive_file, start + thread.archive_length)
+        count = _u32.unpack_from(mapped, start)[0]
+        if not 0 <= position < count:
+            raise IndexError(position)
+        offset = start + _u32.unpack_from(mapped, start + _u32.size * (1 + position))[0]
+        length = _u32.unpack_from(mapped, offset)[0]
+        return _decode_message(mapped[offset + _u32.size:offset + _u32.size + length])
+
+    def read_messages(self, thread: Thread) -> list[tuple[str, str]]:
+        """
+        :raises ArchiveError: if the record does not match its checksum
+        """
+        start, length = thread.archive_offset, thread.archive_length
+        mapped = self._map(thread.archive_file, start + length)
+        record = mapped[start:start + length - _u32.size]
+        if zlib.crc32(record) != _u32.unpack_from(mapped, start + length - _u32.size)[0]:
+            raise ArchiveError(f"Checksum mismatch for thread {thread.id} in {thread.archive_file}")
+        count = _u32.unpack_from(record, 0)[0]
+        messages = []
+        for position in range(count):
+            offset = _u32.unpack_from(record, _u32.size * (1 + position))[0]
+            size = _u32.unpack_from(record, offset)[0]
+            messages.append(_decode_message(record[offset + _u32.size:offset + _u32.size + size]))
+        return messages
+
+    # --- Moving threads ---
+    async def archive(self, session: AsyncSession, thread: Thread) -> bool:
+        """
+        :return: whether the thread was archived, False if another worker archived it or a message was added
+            meanwhile. The record written for nothing stays in its file.
+        """
+        messages = [(message.role, message.content) for message in await thread.get_messages(session=session)]
+        record = encode(messages, config.archive.compression_level)
+        name, offset = await asyncio.to_thread(self.write, record)
+        archived = await thread.mark_archived(
+            session=session, file=name, offset=offset, length=len(record), message_count=len(messages)
+        )
+        await commit(session)
+        return archived
+
+    async def archive_idle(self, session: AsyncSession, idle_days: Optional[int] = None,
+                           limit: Optional[int] = None) -> int:
+        """
+        :return: number of threads archived
+        """
+        settings = config.archive
+        before = datetime.utcnow() - timedelta(days=settings.idle_days if idle_days is None else idle_days)
+        threads = await Thread.get_idle(session=session, before=before, limit=limit or settings.batch_threads)
+        return sum([await self.archive(session=session, thread=thread) for thread in threads])
+
+    async def resume(self, session: AsyncSession, thread: Thread) -> Thread:
+        """
+        Restore an archived thread into the live tables, a live thread is returned as is.
+        :meth:`Thread.get_messages` and :meth:`Thread.add_message` call this on their own.
+        """
+        if thread.archived:
+            messages = self.read_messages(thread)
+            if await thread.mark_restored(session=session, messages=messages):
+                logger.debug(f"Restored thread {thread.id} with {len(messages)} messages")
+            await commit(session)
+        return thread
+
+
+thread_archive = ThreadArchive()
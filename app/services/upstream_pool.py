@@ -0,0 +1,337 @@
+import asyncio
+import contextlib
+import heapq
+import itertools
+import re
+import time
+from typing import AsyncIterator, Callable, Mapping, Optional
+
+from loguru import logger
+
+from app.config import Config, get_config
+
+_DURATION = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_UNITS = {"ms": .001, "s": 1, "m": 60, "h": 3600}
+MAX_COOLDOWN_DOUBLINGS = 10
+DEFAULT_RETRY_AFTER_IN_SECONDS = 1.
+"""For a 429 that says neither when to retry nor when the limits reset"""
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """Seconds from a rate limit header, e.g. ``"20ms"``, ``"6m0s"`` or ``"1.5"``"""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    if not (parts := _DURATION.findall(value)):
+        return None
+    return sum(float(number) * _UNITS[unit] for number, unit in parts)
+
+
+def _parse_int(value: Optional[str]) -> Optional[int]:
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class UpstreamKey:
+    """Rate limit headroom and circuit breaker state of one api key and endpoint"""
+
+    def __init__(self, api_key: str, api_endpoint: str):
+        self.api_key = api_key
+        self.api_endpoint = api_endpoint
+
+        # from the x-ratelimit-* headers of the latest response
+        self.limit_requests: Optional[int] = None
+        self.remaining_requests: Optional[int] = None
+        self.requests_reset_at = 0.
+        self.limit_tokens: Optional[int] = None
+        self.remaining_tokens: Optional[int] = None
+        self.tokens_reset_at = 0.
+
+        self.inflight = 0
+        self.reserved_tokens = 0
+
+        self.failures = 0
+        """Consecutive failures since the last success"""
+        self.trips = 0
+        """Cooldowns since the last success"""
+        self.unavailable_until = 0.
+        """End of a cooldown or of a 429's Retry-After"""
+
+    @property
+    def name(self) -> str:
+        return f"{self.api_endpoint} ...{self.api_key[-4:]}"
+
+    @property
+    def half_open(self) -> bool:
+        """Back from a cooldown, one request decides whether the key is healthy"""
+        return self.trips > 0
+
+    def headroom(self, tokens: int, now: float) -> Optional[float]:
+        """
+        :param tokens: estimated tokens of the request
+        :return: share of the key's limits left after the request, None if the key cannot take it now
+        """
+        if now < self.unavailable_until or (self.half_open and self.inflight):
+            return None
+
+        shares = [1.]
+        requests = self.remaining_requests if now < self.requests_reset_at else self.limit_requests
+        if requests is not None:
+            left = requests - self.inflight
+            if left <= 0:
+                return None
+            shares.append(left / max(self.limit_requests or requests, 1))
+        token_budget = self.remaining_tokens if now < self.tokens_reset_at else self.limit_tokens
+        if token_budget is not None:
+            left = token_budget - self.reserved_tokens - tokens
+            if left < 0:
+                return None
+            shares.append(left / max(self.limit_tokens or token_budget, 1))
+        return min(shares)
+
+    def next_change(self, now: float) -> Optional[float]:
+        """When the key may become available without a response coming back"""
+        moments = [moment for moment in (self.unavailable_until, self.requests_reset_at, self.tokens_reset_at)
+                   if moment > now]
+        return min(moments) if moments else None
+
+    def update_limits(self, headers: Mapping[str, str], now: float):
+        headers = {name.lower(): value for name, value in headers.items()}
+        if (limit := _parse_int(headers.get("x-ratelimit-limit-requests"))) is not None:
+            self.limit_requests = limit
+        if (remaining := _parse_int(headers.get("x-ratelimit-remaining-requests"))) is not None:
+            self.remaining_requests = remaining
+            self.requests_reset_at = now + (parse_duration(headers.get("x-ratelimit-reset-requests")) or 0)
+        if (limit := _parse_int(headers.get("x-ratelimit-limit-tokens"))) is not None:
+            self.limit_tokens = limit
+        if (remaining := _parse_int(headers.get("x-ratelimit-remaining-tokens"))) is not None:
+            self.remaining_tokens = remaining
+            self.tokens_reset_at = now + (parse_duration(headers.get("x-ratelimit-reset-tokens")) or 0)
+
+    def report(
+            self,
+            status: Optional[int],
+            headers: Mapping[str, str],
+            now: float,
+            failure_threshold: int,
+            cooldown: float
+    ):
+        """
+        :param status: HTTP status, None if no response came back
+        """
+        self.update_limits(headers, now)
+        if status == 429:
+            lower = {name.lower(): value for name, value in headers.items()}
+            wait = parse_duration(lower.get("retry-after"))
+            if wait is None:
+                wait = max(self.requests_reset_at, self.tokens_reset_at) - now
+            if wait <= 0:
+                wait = DEFAULT_RETRY_AFTER_IN_SECONDS
+            self.unavailable_until = max(self.unavailable_until, now + wait)
+        elif status in (401, 403):
+            # revoked or invalid, retrying it right away only fails again
+            self._trip(now, cooldown, f"rejected with {status}")
+        elif status is None or status >= 500:
+            self.failures += 1
+            if self.half_open or self.failures >= failure_threshold:
+                self._trip(now, cooldown, "failing")
+        else:
+            self.failures = 0
+            self.trips = 0
+
+    def _trip(self, now: float, cooldown: float, reason: str):
+        self.unavailable_until = now + cooldown * 2 ** min(self.trips, MAX_COOLDOWN_DOUBLINGS)
+        self.trips += 1
+        self.failures = 0
+        logger.warning(f"OpenAI key {self.name} {reason}, cooling down for {self.unavailable_until - now:.0f}s")
+
+
+class Lease:
+    """One request's claim on a key, report the outcome with :meth:`report` before releasing"""
+
+    def __init__(self, pool: "UpstreamPool", key: UpstreamKey, tokens: int):
+        self.pool = pool
+        self.key = key
+        self.tokens = tokens
+        self.reported = False
+        self.released = False
+
+    @property
+    def api_key(self) -> str:
+        return self.key.api_key
+
+    @property
+    def api_endpoint(self) -> str:
+        return self.key.api_endpoint
+
+    def report(self, status: Optional[int], headers: Mapping[str, str] = None):
+        """
+        :param status: HTTP status, None if no response came back
+        :param headers: response headers, for the x-ratelimit-* and Retry-After headers
+        """
+        self.reported = True
+        self.key.report(
+            status, headers or {}, self.pool.clock(), self.pool.failure_threshold, self.pool.cooldown_in_seconds
+        )
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        self.key.inflight -= 1
+        self.key.reserved_tokens -= self.tokens
+        self.pool.dispatch()
+
+
+class UpstreamPool:
+    """
+    Spread requests over several OpenAI keys and endpoints.
+
+    Each request goes to the key with the largest share of its request and token limits left, as reported by
+    the ``x-ratelimit-*`` headers of its latest response, minus what is in flight. A key failing
+    ``key_failure_threshold`` times in a row, or failing its first request after a cooldown, cools down for an
+    exponentially growing period, as does a key rejected with 401 or 403 at once; a 429 benches the key for
+    its ``Retry-After``. When no key can take a request it waits in a priority queue, lower ``priority`` values
+    first, until a response, a reset or the end of a cooldown frees one.
+    """
+
+    def __init__(
+            self,
+            keys: Optional[list[tuple[str, str]]] = None,
+            failure_threshold: Optional[int] = None,
+            cooldown_in_seconds: Optional[float] = None,
+            queue_timeout_in_seconds: Optional[float] = None,
+            clock: Callable[[], float] = time.monotonic
+    ):
+        """Keys and limits left to None follow ``[openai]`` in the current config"""
+        self._fixed_keys = keys
+        self._fixed_failure_threshold = failure_threshold
+        self._fixed_cooldown = cooldown_in_seconds
+        self._fixed_queue_timeout = queue_timeout_in_seconds
+        self.clock = clock
+
+        self._keys: dict[tuple[str, str], UpstreamKey] = {}
+        self._synced_with: Optional[Config] = None
+        self._waiters: list[tuple[int, int, int, asyncio.Future]] = []
+        self._sequence = itertools.count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        if keys is not None:
+            self._sync(keys)
+
+    # --- Config ---
+    @property
+    def failure_threshold(self) -> int:
+        if self._fixed_failure_threshold is not None:
+            return self._fixed_failure_threshold
+        return get_config().openai.key_failure_threshold
+
+    @property
+    def cooldown_in_seconds(self) -> float:
+        if self._fixed_cooldown is not None:
+            return self._fixed_cooldown
+        return get_config().openai.key_cooldown_in_seconds
+
+    @property
+    def keys(self) -> list[UpstreamKey]:
+        if self._fixed_keys is None and (current := get_config()) is not self._synced_with:
+            openai = current.openai
+            pairs = [(key.api_key, key.api_endpoint) for key in openai.keys]
+            if openai.api_key:
+                pairs.insert(0, (openai.api_key, openai.api_endpoint))
+            self._sync(pairs)
+            self._synced_with = current
+        return list(self._keys.values())
+
+    def _sync(self, pairs: list[tuple[str, str]]):
+        """Keep the state of keys still configured"""
+        self._keys = {pair: self._keys.get(pair) or UpstreamKey(*pair) for pair in dict.fromkeys(pairs)}
+
+    # --- Scheduling ---
+    def _pick(self, tokens: int, now: float) -> Optional[UpstreamKey]:
+        best, best_score = None, None
+        for key in self.keys:
+            if (headroom := key.headroom(tokens, now)) is None:
+                continue
+            if best_score is None or (headroom, -key.inflight) > best_score:
+                best, best_score = key, (headroom, -key.inflight)
+        return best
+
+    def _lease(self, key: UpstreamKey, tokens: int) -> Lease:
+        key.inflight += 1
+        key.reserved_tokens += tokens
+        return Lease(self, key, tokens)
+
+    @property
+    def queued(self) -> int:
+        return sum(1 for *_, future in self._waiters if not future.done())
+
+    async def acquire(self, priority: int = 0, tokens: int = 0, timeout: Optional[float] = None) -> Lease:
+        """
+        :param priority: lower is served first when requests queue
+        :param tokens: estimated prompt and completion tokens, held against the key's token budget
+        :param timeout: defaults to ``[openai] queue_timeout_in_seconds``
+        :raises TimeoutError: if no key freed up in time
+        :raises RuntimeError: if no key is configured
+        """
+        if not self.keys:
+            raise RuntimeError("No OpenAI key configured")
+        if not self._waiters and (key := self._pick(tokens, self.clock())) is not None:
+            return self._lease(key, tokens)
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), tokens, future))
+        self.dispatch()
+        if timeout is None:
+            timeout = self._fixed_queue_timeout or get_config().openai.queue_timeout_in_seconds
+        try:
+            async with asyncio.timeout(timeout):
+                return await future
+        except (TimeoutError, asyncio.CancelledError):
+            if future.done() and not future.cancelled():
+                future.result().release()
+            future.cancel()
+            raise
+
+    @contextlib.asynccontextmanager
+    async def lease(self, priority: int = 0, tokens: int = 0, timeout: Optional[float] = None
+                    ) -> AsyncIterator[Lease]:
+        """:meth:`acquire` and release, an exception before :meth:`Lease.report` counts as a failed request"""
+        lease = await self.acquire(priority=priority, tokens=tokens, timeout=timeout)
+        try:
+            yield lease
+        except Exception:
+            if not lease.reported:
+                lease.report(None)
+            raise
+        finally:
+            lease.release()
+
+    def dispatch(self):
+        """Hand freed keys to queued requests, in priority order"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        now = self.clock()
+        while self._waiters:
+            _, _, tokens, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            if (key := self._pick(tokens, now)) is None:
+                break
+            heapq.heappop(self._waiters)
+            future.set_result(self._lease(key, tokens))
+
+        if self._waiters:
+            changes = [moment for key in self.keys if (moment := key.next_change(now)) is not None]
+            if changes:
+                self._timer = asyncio.get_running_loop().call_later(max(min(changes) - now, 0), self.dispatch)
+
+
+upstream_pool = UpstreamPool()
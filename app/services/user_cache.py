@@ -0,0 +1,154 @@
+import time
+import uuid as uuid_module
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import hot_config
+from app.database.unit_of_work import in_unit_of_work, on_unit_end
+
+
+@dataclass(frozen=True, slots=True)
+class UserSnapshot:
+    """The columns a request needs before it decides to do anything, read without the ORM"""
+    id: int
+    uuid: uuid_module.UUID
+    qq_number: Optional[str]
+    wechat_id: Optional[str]
+    phone_number: Optional[str]
+    email: Optional[str]
+    is_banned: bool
+    balance_in_cents: int
+    gifted_balance_in_cents: int
+    billing_rate: int
+
+    def identifiers(self) -> list[tuple[str, str]]:
+        return [
+            (name, str(value)) for name, value in (
+                ("uuid", self.uuid), ("qq_number", self.qq_number), ("wechat_id", self.wechat_id),
+                ("phone_number", self.phone_number), ("email", self.email),
+            ) if value is not None
+        ]
+
+    def matches(self, **identifiers: Optional[str]) -> bool:
+        """
+        :param identifiers: uuid, qq_number, wechat_id, phone_number, email, all given ones must match
+        """
+        given = _normalize(identifiers)
+        return given is not None and set(given) <= set(self.identifiers())
+
+
+def _normalize(identifiers: dict[str, Optional[str]]) -> Optional[list[tuple[str, str]]]:
+    """:return: None if an identifier cannot match any user"""
+    given = []
+    for name, value in identifiers.items():
+        if value is None:
+            continue
+        if name == "uuid":
+            try:
+                value = uuid_module.UUID(str(value))
+            except ValueError:
+                return None
+        given.append((name, str(value)))
+    return given
+
+
+class UserSnapshotCache:
+    """
+    Per-process :class:`UserSnapshot` by user id, with external identifiers mapped onto the id.
+
+    Entries expire after ``[cache] user_snapshot_ttl_in_seconds`` and the least recently used are evicted past
+    ``user_snapshot_max_entries``. Balance and ban changes call :meth:`invalidate_after`. A snapshot read before
+    its user was invalidated is not stored, so a request racing a change cannot put the old state back. Reads
+    of other users are unaffected: every invalidation is stamped per user id, the most recent
+    ``user_snapshot_max_entries`` stamps are kept and older ones count as the oldest kept.
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic):
+        self._entries: OrderedDict[int, tuple[UserSnapshot, float]] = OrderedDict()
+        self._by_identifier: dict[tuple[str, str], int] = {}
+        self._generation = 0
+        self._invalidated_at: OrderedDict[int, int] = OrderedDict()
+        """User id -> generation of its last invalidation"""
+        self._invalidated_floor = 0
+        """Generation of the latest invalidation whose stamp was dropped"""
+        self._clock = clock
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def generation(self) -> int:
+        """Pass to :meth:`put` along with a snapshot read after taking it"""
+        return self._generation
+
+    def clear(self):
+        self._entries.clear()
+        self._by_identifier.clear()
+        self._invalidated_at.clear()
+        self._generation += 1
+        self._invalidated_floor = self._generation
+
+    def get(self, id: Optional[int] = None, **identifiers: Optional[str]) -> Optional[UserSnapshot]:
+        """
+        :param id:
+        :param identifiers: uuid, qq_number, wechat_id, phone_number, email, all given ones must match
+        :return: None on a miss
+        """
+        if (given := _normalize(identifiers)) is None:
+            return None
+        if id is None:
+            if not given:
+                return None
+            id = self._by_identifier.get(given[0])
+        if (entry := self._entries.get(id)) is None:
+            return None
+
+        snapshot, expires_at = entry
+        if expires_at <= self._clock():
+            self._remove(id)
+            return None
+        if given and not set(given) <= set(snapshot.identifiers()):
+            return None
+        self._entries.move_to_end(id)
+        return snapshot
+
+    def put(self, snapshot: UserSnapshot, generation: int):
+        """:param generation: :attr:`generation` taken before the snapshot was read"""
+        if generation < self._invalidated_at.get(snapshot.id, self._invalidated_floor):
+            return
+        hot = hot_config()
+        self._remove(snapshot.id)
+        self._entries[snapshot.id] = (snapshot, self._clock() + hot.user_snapshot_ttl_in_seconds)
+        for key in snapshot.identifiers():
+            self._by_identifier[key] = snapshot.id
+        while len(self._entries) > hot.user_snapshot_max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def invalidate(self, *ids: int):
+        self._generation += 1
+        for id in ids:
+            self._remove(id)
+            self._invalidated_at.pop(id, None)
+            self._invalidated_at[id] = self._generation
+        max_stamps = hot_config().user_snapshot_max_entries
+        while len(self._invalidated_at) > max_stamps:
+            _, self._invalidated_floor = self._invalidated_at.popitem(last=False)
+
+    def invalidate_after(self, session: AsyncSession, *ids: int):
+        """Invalidate now, and again once the enclosing unit of work has committed"""
+        self.invalidate(*ids)
+        if in_unit_of_work(session):
+            on_unit_end(session, lambda: self.invalidate(*ids))
+
+    def _remove(self, id: int):
+        if (entry := self._entries.pop(id, None)) is None:
+            return
+        for key in entry[0].identifiers():
+            if self._by_identifier.get(key) == id:
+                del self._by_identifier[key]
+
+
+user_snapshots = UserSnapshotCache()
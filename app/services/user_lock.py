@@ -0,0 +1,76 @@
+import asyncio
+import contextlib
+from typing import AsyncIterator, Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import config
+from app.database.unit_of_work import in_unit_of_work, on_unit_end
+
+_HELD = "user_lock_stripes"
+
+
+class UserLocks:
+    """
+    Striped per-user locks serializing balance changes in this process.
+
+    A user id maps to one of ``config.billing.user_lock_stripes`` :class:`asyncio.Lock`, so memory is fixed and
+    users on different stripes never wait for each other. ``asyncio.Lock`` wakes waiters first come, first
+    served. Locks are held until the change is committed: when the session is inside a unit of work they are
+    released once the unit ends, otherwise when :meth:`hold` exits.
+
+    Stripes already held by the session are not acquired again, so ``bind_invite_code`` -> ``charge`` does not
+    deadlock on itself. Operations touching several users pass them all to one :meth:`hold`, which acquires the
+    stripes in index order.
+    """
+
+    def __init__(self, stripes: Optional[int] = None):
+        self._stripes = stripes
+        self._locks: list[asyncio.Lock] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _ensure_locks(self) -> list[asyncio.Lock]:
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # asyncio locks bind to the loop they first wait on
+            self._loop = loop
+            self._locks = [asyncio.Lock() for _ in range(self._stripes or config.billing.user_lock_stripes)]
+        return self._locks
+
+    def stripe(self, user_id: int) -> int:
+        return hash(user_id) % len(self._ensure_locks())
+
+    def locked(self, user_id: int) -> bool:
+        return self._ensure_locks()[self.stripe(user_id)].locked()
+
+    @contextlib.asynccontextmanager
+    async def hold(self, session: AsyncSession, *user_ids: Optional[int]) -> AsyncIterator[None]:
+        """
+        :param session: the session the balance changes are committed with
+        :param user_ids: ``None`` is skipped, e.g. a user without an inviter
+        :raises TimeoutError: if a stripe was not acquired within ``config.billing.user_lock_timeout_in_seconds``
+        """
+        locks = self._ensure_locks()
+        held: set[int] = session.info.setdefault(_HELD, set())
+        stripes = sorted({self.stripe(user_id) for user_id in user_ids if user_id is not None} - held)
+        acquired = []
+
+        def release():
+            for stripe in acquired:
+                held.discard(stripe)
+                locks[stripe].release()
+
+        try:
+            for stripe in stripes:
+                await asyncio.wait_for(locks[stripe].acquire(), config.billing.user_lock_timeout_in_seconds)
+                acquired.append(stripe)
+                held.add(stripe)
+            yield
+        finally:
+            if acquired and in_unit_of_work(session):
+                on_unit_end(session, release)
+            else:
+                release()
+
+
+user_locks = UserLocks()
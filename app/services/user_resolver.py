@@ -0,0 +1,30 @@
+from typing import Optional
+
+from app.database.connector import sessionmanager
+from app.database.models.user import User, Identifier
+from app.services.batch_loader import BatchLoader
+from app.services.user_cache import UserSnapshot, user_snapshots
+
+
+async def _load_snapshots(identifiers: list[Identifier]) -> dict[Identifier, UserSnapshot]:
+    async with sessionmanager.session() as session:
+        return await User.get_snapshots(session=session, identifiers=identifiers)
+
+
+user_loader: BatchLoader[Identifier, UserSnapshot] = BatchLoader(_load_snapshots)
+"""Resolves concurrent lookups with one session and an IN query per identifier type"""
+
+
+async def resolve_snapshot(**identifiers: Optional[str]) -> Optional[UserSnapshot]:
+    """
+    The user matching all given identifiers, from the cache or else through :data:`user_loader`
+
+    :param identifiers: uuid, qq_number, wechat_id, phone_number, email
+    """
+    given = [(name, value) for name, value in identifiers.items() if value is not None]
+    if not given:
+        return None
+    if (snapshot := user_snapshots.get(**identifiers)) is not None:
+        return snapshot
+    snapshot = await user_loader.load(given[0])
+    return snapshot if snapshot is not None and snapshot.matches(**identifiers) else None
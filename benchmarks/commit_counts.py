@@ -0,0 +1,94 @@
+"""
+Commits issued per model operation, standalone and inside a unit of work.
+
+Run from ``app/`` like ``main.py``::
+
+    python ../benchmarks/commit_counts.py
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from sqlalchemy import event
+
+from app.database.base import Base
+from app.database.connector import DatabaseSessionManager
+from app.database.models.user import User
+from app.database.unit_of_work import unit_of_work
+
+ROUNDS = 50
+
+
+async def create(session, n):
+    return await User.create_with_invite_code(session=session, email=f"{n}@bench.com")
+
+
+async def charge(session, n):
+    user = await User.get(session=session, email=f"{n}@bench.com")
+    await user.charge(session=session, amount=1000)
+
+
+async def pay(session, n):
+    user = await User.get(session=session, email=f"{n}@bench.com")
+    await user.pay(session=session, amount=100)
+
+
+async def bind(session, n):
+    user = await User.get(session=session, email=f"{n}@bench.com")
+    inviter = await User.get(session=session, email=f"inviter-{n % 10}@bench.com", load=("invite_code",))
+    await user.bind_invite_code(session=session, code=inviter.invite_code.code)
+
+
+OPERATIONS = [("create_with_invite_code", create), ("bind_invite_code", bind), ("charge", charge), ("pay", pay)]
+
+
+async def measure(use_unit_of_work: bool) -> dict[str, tuple[float, float]]:
+    with tempfile.TemporaryDirectory() as tmp:
+        manager = DatabaseSessionManager(host=f"sqlite+aiosqlite:///{os.path.join(tmp, 'bench.db')}")
+        async with manager.connect() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+
+        commits = 0
+
+        def count_commit(_):
+            nonlocal commits
+            commits += 1
+
+        event.listen(manager.engine.sync_engine, "commit", count_commit)
+
+        async with manager.session() as session:
+            for n in range(10):
+                await User.create_with_invite_code(session=session, email=f"inviter-{n}@bench.com")
+
+        results = {}
+        for name, operation in OPERATIONS:
+            commits = 0
+            start = time.perf_counter()
+            for n in range(ROUNDS):
+                async with manager.session() as session:
+                    if use_unit_of_work:
+                        async with unit_of_work(session):
+                            await operation(session, n)
+                    else:
+                        await operation(session, n)
+            results[name] = (commits / ROUNDS, (time.perf_counter() - start) / ROUNDS * 1000)
+
+        await manager.close()
+        return results
+
+
+async def main():
+    before = await measure(use_unit_of_work=False)
+    after = await measure(use_unit_of_work=True)
+
+    print(f"{'operation':<26}{'commits before':>16}{'commits after':>16}{'ms before':>12}{'ms after':>12}")
+    for name, _ in OPERATIONS:
+        print(f"{name:<26}{before[name][0]:>16.1f}{after[name][0]:>16.1f}{before[name][1]:>12.2f}{after[name][1]:>12.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,113 @@
+"""
+Requests per second against ``/health`` for an increasing number of workers, on a SQLite WAL database.
+
+Run from ``app/`` like ``main.py``::
+
+    python ../benchmarks/load_test.py --workers 1 2 4 --duration 10 --concurrency 64
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import toml
+
+APP_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'app'))
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def get(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, port: int) -> int:
+    writer.write(f"GET /health HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\n\r\n".encode())
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while (line := await reader.readline()) not in (b"\r\n", b""):
+        name, _, value = line.decode().partition(":")
+        if name.lower() == "content-length":
+            length = int(value)
+    await reader.readexactly(length)
+    return status
+
+
+async def wait_ready(port: int, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            status = await get(reader, writer, port)
+            writer.close()
+            if status == 200:
+                return
+        except (OSError, asyncio.IncompleteReadError, IndexError):
+            pass
+        await asyncio.sleep(0.2)
+    raise TimeoutError("Server did not start")
+
+
+async def load(port: int, duration: float, concurrency: int) -> tuple[int, int]:
+    deadline = time.monotonic() + duration
+    ok = failed = 0
+
+    async def client():
+        nonlocal ok, failed
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        while time.monotonic() < deadline:
+            if await get(reader, writer, port) == 200:
+                ok += 1
+            else:
+                failed += 1
+        writer.close()
+
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    return ok, failed
+
+
+def run(workers: int, duration: float, concurrency: int, tmp: str) -> float:
+    port = free_port()
+    config_path = os.path.join(tmp, f"config-{workers}.toml")
+    with open(config_path, "w") as f:
+        toml.dump({
+            "system": {"host": "127.0.0.1", "port": port, "workers": workers, "config_watch_interval_in_seconds": 0},
+            "db": {"url": f"sqlite+aiosqlite:///{os.path.join(tmp, 'load.db')}", "sqlite_journal_mode": "WAL"},
+        }, f)
+
+    server = subprocess.Popen(
+        [sys.executable, "main.py"], cwd=APP_DIR, env={**os.environ, "CONFIG_PATH": config_path},
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        asyncio.run(wait_ready(port))
+        ok, failed = asyncio.run(load(port, duration, concurrency))
+    finally:
+        server.terminate()
+        server.wait(timeout=60)
+    rps = ok / duration
+    print(f"{workers:>8}{rps:>14.1f}{failed:>10}")
+    return rps
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--concurrency", type=int, default=64)
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} CPUs")
+    print(f"{'workers':>8}{'requests/s':>14}{'failed':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for workers in args.workers:
+            run(workers, args.duration, args.concurrency, tmp)
+
+
+if __name__ == "__main__":
+    main()
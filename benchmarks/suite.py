@@ -0,0 +1,286 @@
+"""
+Model layer and HTTP benchmarks on a seeded temporary SQLite database.
+
+Run from ``app/`` like ``main.py``::
+
+    python ../benchmarks/suite.py                      # compare against benchmarks/baseline.json
+    python ../benchmarks/suite.py --update-baseline    # accept the current numbers
+    python ../benchmarks/suite.py --users 10000 --concurrency 32 --output results.json
+
+Exits with 1 when an operation's p50 latency or throughput regressed by more than ``--tolerance``, or its share
+of failed iterations grew by more than ``--error-tolerance``. The latter catches an operation that got "faster" by
+failing early; a little slack is left because concurrent SQLite writers occasionally fail with "database is locked".
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import string
+import sys
+import tempfile
+import time
+import uuid
+from dataclasses import dataclass, asdict
+from typing import Awaitable, Callable
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from loguru import logger
+
+from app.config import Config, use_config
+from app.database.connector import sessionmanager, migrate_tables
+from app.database.models.invite_code import InviteCode
+from app.database.models.thread import Thread
+from app.database.models.user import User
+from app.database.unit_of_work import unit_of_work
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+
+@dataclass
+class Dataset:
+    users: int = 2000
+    referral_chains: int = 50
+    referral_chain_length: int = 10
+    threads: int = 2000
+
+
+@dataclass
+class Result:
+    iterations: int
+    errors: int
+    throughput: float
+    p50_ms: float
+    p99_ms: float
+
+
+def percentile(values: list[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * p), len(ordered) - 1)]
+
+
+async def seed(dataset: Dataset, batch_size: int = 1000):
+    """Bulk insert users with their invite codes, referral chains and threads"""
+    codes = set()
+    for start in range(0, dataset.users, batch_size):
+        async with sessionmanager.session() as session:
+            users = [
+                User(uuid=uuid.uuid4(), qq_number=str(10_000_000 + n), email=f"{n}@bench.com")
+                for n in range(start, min(start + batch_size, dataset.users))
+            ]
+            session.add_all(users)
+            await session.flush()
+            for user in users:
+                while (code := ''.join(random.choices(string.ascii_letters + string.digits, k=8))) in codes:
+                    pass
+                codes.add(code)
+                user.invite_code = InviteCode(user=user, code=code)
+            await session.commit()
+
+    async with sessionmanager.session() as session:
+        n = 0
+        for _ in range(dataset.referral_chains):
+            inviter = None
+            for _ in range(dataset.referral_chain_length):
+                if n >= dataset.users:
+                    break
+                user = await User.get(session=session, qq_number=str(10_000_000 + n))
+                if inviter is not None:
+                    user.inviter_id = inviter.id
+                inviter = user
+                n += 1
+        session.add_all([Thread() for _ in range(dataset.threads)])
+        await session.commit()
+
+
+async def measure(
+        operation: Callable[[int], Awaitable],
+        iterations: int,
+        concurrency: int
+) -> Result:
+    latencies: list[float] = []
+    errors = 0
+    counter = iter(range(iterations))
+
+    async def worker():
+        nonlocal errors
+        for n in counter:
+            started = time.perf_counter()
+            try:
+                await operation(n)
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    return Result(
+        iterations=iterations,
+        errors=errors,
+        throughput=iterations / elapsed,
+        p50_ms=percentile(latencies, .5) * 1000,
+        p99_ms=percentile(latencies, .99) * 1000,
+    )
+
+
+def operations(dataset: Dataset, app) -> dict[str, Callable[[int], Awaitable]]:
+    def random_qq_number() -> str:
+        return str(10_000_000 + random.randrange(dataset.users))
+
+    async def create_with_invite_code(n):
+        async with sessionmanager.session() as session, unit_of_work(session):
+            await User.create_with_invite_code(session=session, email=f"new-{n}@bench.com")
+
+    async def get(n):
+        async with sessionmanager.session() as session:
+            await User.get(session=session, qq_number=random_qq_number())
+
+    async def charge(n):
+        async with sessionmanager.session() as session, unit_of_work(session):
+            user = await User.get(session=session, qq_number=random_qq_number())
+            await user.charge(session=session, amount=100)
+
+    async def pay(n):
+        async with sessionmanager.session() as session, unit_of_work(session):
+            user = await User.get(session=session, qq_number=random_qq_number())
+            await user.pay(session=session, amount=10)
+
+    async def bind_invite_code(n):
+        async with sessionmanager.session() as session, unit_of_work(session):
+            # users created by create_with_invite_code above have no inviter yet
+            user = await User.get(session=session, email=f"new-{n}@bench.com")
+            inviter = await User.get(session=session, qq_number=random_qq_number(), load=("invite_code",))
+            await user.bind_invite_code(session=session, code=inviter.invite_code.code)
+
+    async def http_health(n):
+        status = await asgi_get(app, "/health")
+        if status != 200:
+            raise RuntimeError(status)
+
+    return {
+        "create_with_invite_code": create_with_invite_code,
+        "User.get": get,
+        "charge": charge,
+        "pay": pay,
+        "bind_invite_code": bind_invite_code,
+        "GET /health": http_health,
+    }
+
+
+async def asgi_get(app, path: str) -> int:
+    status = 0
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app({
+        "type": "http", "method": "GET", "path": path, "raw_path": path.encode(), "query_string": b"",
+        "headers": [], "client": ("127.0.0.1", 50000), "server": ("bench", 80), "scheme": "http",
+        "root_path": "", "http_version": "1.1",
+    }, receive, send)
+    return status
+
+
+async def run(dataset: Dataset, iterations: int, concurrency: int) -> dict[str, Result]:
+    with tempfile.TemporaryDirectory() as tmp:
+        use_config(Config.validate({
+            "db": {"url": f"sqlite+aiosqlite:///{os.path.join(tmp, 'bench.db')}"},
+            "rate_limit": {"enabled": False},
+            "metrics": {"slow_request_threshold_in_ms": 0},
+        }))
+        from app.main import app, mount_routes
+        mount_routes(app)
+
+        await migrate_tables()
+        started = time.perf_counter()
+        await seed(dataset)
+        print(f"Seeded {asdict(dataset)} in {time.perf_counter() - started:.1f}s")
+
+        results = {}
+        for name, operation in operations(dataset, app).items():
+            results[name] = await measure(operation, iterations, concurrency)
+            result = results[name]
+            print(f"{name:<26}{result.throughput:>10.1f}/s{result.p50_ms:>10.2f}ms{result.p99_ms:>10.2f}ms"
+                  f"{result.errors:>8}")
+        await sessionmanager.close()
+        return results
+
+
+def compare(results: dict[str, Result], baseline: dict, tolerance: float, error_tolerance: float) -> list[str]:
+    """
+    :param tolerance: relative slack on p50 latency and throughput
+    :param error_tolerance: slack on the share of failed iterations, in absolute terms
+    """
+    regressions = []
+    for name, base in baseline["results"].items():
+        if (result := results.get(name)) is None:
+            continue
+        error_rate, base_error_rate = result.errors / result.iterations, base["errors"] / base["iterations"]
+        if error_rate > base_error_rate + error_tolerance:
+            regressions.append(f"{name}: {error_rate:.1%} errors > baseline {base_error_rate:.1%}")
+        if result.p50_ms > base["p50_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p50 {result.p50_ms:.2f}ms > baseline {base['p50_ms']:.2f}ms")
+        if result.throughput < base["throughput"] / (1 + tolerance):
+            regressions.append(f"{name}: {result.throughput:.1f}/s < baseline {base['throughput']:.1f}/s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=Dataset.users)
+    parser.add_argument("--referral-chains", type=int, default=Dataset.referral_chains)
+    parser.add_argument("--referral-chain-length", type=int, default=Dataset.referral_chain_length)
+    parser.add_argument("--threads", type=int, default=Dataset.threads)
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--tolerance", type=float, default=.25)
+    parser.add_argument("--error-tolerance", type=float, default=.02)
+    parser.add_argument("--output", help="write results as JSON")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args()
+
+    logger.remove()  # failed operations are counted, not logged
+    dataset = Dataset(args.users, args.referral_chains, args.referral_chain_length, args.threads)
+    print(f"{'operation':<26}{'throughput':>12}{'p50':>12}{'p99':>12}{'errors':>8}")
+    results = asyncio.run(run(dataset, args.iterations, args.concurrency))
+
+    report = {
+        "meta": {
+            "dataset": asdict(dataset), "iterations": args.iterations, "concurrency": args.concurrency,
+            "python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count(),
+        },
+        "results": {name: asdict(result) for name, result in results.items()},
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline written to {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        print("No baseline to compare against, run with --update-baseline")
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline["meta"]["dataset"] != report["meta"]["dataset"]:
+        print("Warning: baseline was recorded with a different dataset")
+    if regressions := compare(results, baseline, args.tolerance, args.error_tolerance):
+        print("Regressions:\n  " + "\n  ".join(regressions))
+        sys.exit(1)
+    print("No regressions")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+from tests.clean_db import test_database  # noqa: F401, session wide test database
@@ -1,11 +1,63 @@
+import asyncio
+import os
+import tempfile
+
 import pytest
-from app.database.connector import drop_tables
-from app.main import on_startup
+from sqlalchemy import event
+
+from app.config import Config, CONFIG_PATH, use_config
+from app.database.connector import DatabaseSessionManager, sessionmanager
+from app.database.migrations import migrate
+from app.services.idempotency import idempotency
+from app.services.user_cache import user_snapshots
+
+
+def _test_database_url() -> str:
+    """A file per xdist worker, on tmpfs when available"""
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    worker = os.environ.get("PYTEST_XDIST_WORKER", "main")
+    return f"sqlite+aiosqlite:///{os.path.join(directory, f'universalaiassistant-test-{worker}-{os.getpid()}.db')}"
+
+
+def _enable_sqlite_savepoints(engine):
+    # pysqlite starts transactions lazily and breaks SAVEPOINT, let SQLAlchemy emit BEGIN itself
+    @event.listens_for(engine, "connect")
+    def do_connect(dbapi_connection, _):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, "begin")
+    def do_begin(connection):
+        connection.exec_driver_sql("BEGIN")
+
+
+async def _create_schema(url: str):
+    manager = DatabaseSessionManager(host=url)
+    await migrate(manager.engine)
+    await manager.close()
+
+
+@pytest.fixture(scope="session", autouse=True)
+def test_database():
+    """Point the app at a throwaway database and create the schema once for the whole run"""
+    base_config = Config.read(CONFIG_PATH) if os.path.exists(CONFIG_PATH) else Config()
+    url = _test_database_url()
+    use_config(base_config.copy(update={"db": base_config.db.copy(update={"url": url})}))
+    asyncio.run(_create_schema(url))
+    _enable_sqlite_savepoints(sessionmanager.engine.sync_engine)
+    yield
+    asyncio.run(sessionmanager.close())
+    os.remove(url.removeprefix("sqlite+aiosqlite:///"))
 
 
 @pytest.fixture()
 async def clean_db():
-    await drop_tables()
-    await on_startup()
-    yield
-    await drop_tables()
+    """Run the test inside a transaction that is rolled back afterwards, session commits become SAVEPOINTs"""
+    async with sessionmanager.engine.connect() as connection:
+        transaction = await connection.begin()
+        with sessionmanager.bind_to(connection):
+            try:
+                yield
+            finally:
+                await transaction.rollback()
+                user_snapshots.clear()
+                idempotency.clear()
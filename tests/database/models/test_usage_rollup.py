@@ -0,0 +1,104 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from tests.clean_db import clean_db
+from app.database.models.usage_rollup import UsageRollup
+from app.database.models.user import User
+from app.database.connector import sessionmanager
+
+
+async def test_record_hourly_and_daily(clean_db):
+    async with sessionmanager.session() as session:
+        user = await User.create_with_invite_code(email="rollup@user.com", session=session)
+        at = datetime(2024, 4, 9, 13, 25)
+
+        await UsageRollup.record(session, user_id=user.id, feature="usage", amount_in_cents=30, at=at)
+        await UsageRollup.record(session, user_id=user.id, feature="usage", amount_in_cents=20,
+                                 at=at + timedelta(minutes=40))
+        await session.commit()
+
+        hourly = await UsageRollup.series(session, start=datetime(2024, 4, 9), end=datetime(2024, 4, 10),
+                                          user_id=user.id, feature="usage", granularity=UsageRollup.HOUR)
+        assert [(r.bucket_start.hour, r.events, r.amount_in_cents) for r in hourly] == [(13, 1, 30), (14, 1, 20)]
+
+        daily = await UsageRollup.series(session, start=datetime(2024, 4, 9), end=datetime(2024, 4, 10),
+                                         user_id=user.id, feature="usage")
+        assert len(daily) == 1
+        assert daily[0].events == 2
+        assert daily[0].amount_in_cents == 50
+
+
+async def test_concurrent_events_in_one_bucket(clean_db):
+    async with sessionmanager.session() as session:
+        user_id = (await User.create_with_invite_code(email="rollup@user.com", session=session)).id
+    at = datetime(2024, 4, 9, 13, 25)
+
+    async with sessionmanager.session() as first:
+        await UsageRollup.record(first, user_id=user_id, feature="usage", amount_in_cents=30, at=at)
+        async with sessionmanager.session() as second:
+            await UsageRollup.record(second, user_id=user_id, feature="usage", amount_in_cents=20, at=at)
+            await second.commit()
+        await first.commit()
+
+        daily = await UsageRollup.series(first, start=datetime(2024, 4, 9), end=datetime(2024, 4, 10),
+                                         user_id=user_id, feature="usage")
+        assert [(r.events, r.amount_in_cents) for r in daily] == [(2, 50)]
+
+
+async def test_charge_and_pay_are_rolled_up(clean_db):
+    async with sessionmanager.session() as session:
+        user = await User.create_with_invite_code(email="rollup@user.com", session=session)
+        await user.charge(session, 1000, type="charge")
+        await user.pay(session, 300)
+        await user.pay(session, 200)
+
+        today = UsageRollup.bucket_of(datetime.utcnow(), UsageRollup.DAY)
+        usage = await UsageRollup.series(session, start=today, end=today + timedelta(days=1),
+                                         user_id=user.id, feature="usage")
+        charge = await UsageRollup.series(session, start=today, end=today + timedelta(days=1),
+                                          user_id=user.id, feature="charge")
+        assert usage[0].amount_in_cents == 500
+        assert usage[0].events == 2
+        assert charge[0].amount_in_cents == 1000
+
+
+async def test_top(clean_db):
+    async with sessionmanager.session() as session:
+        users = [await User.create_with_invite_code(email=f"{i}@user.com", session=session) for i in range(3)]
+        start = datetime(2024, 4, 1)
+        for day, (user, amount) in enumerate([(users[0], 100), (users[1], 300), (users[2], 200), (users[0], 250)]):
+            await UsageRollup.record(session, user_id=user.id, feature="usage", amount_in_cents=amount,
+                                     at=start + timedelta(days=day))
+        await UsageRollup.record(session, user_id=users[2].id, feature="charge", amount_in_cents=9999, at=start)
+        await session.commit()
+
+        top = await UsageRollup.top(session, feature="usage", start=start, end=start + timedelta(days=7), limit=2)
+        assert top == [(users[0].id, 350), (users[1].id, 300)]
+
+        # range excludes the last day
+        top = await UsageRollup.top(session, feature="usage", start=start, end=start + timedelta(days=3))
+        assert top == [(users[1].id, 300), (users[2].id, 200), (users[0].id, 100)]
+
+        with pytest.raises(ValueError):
+            await UsageRollup.top(session, feature="usage", start=start, end=start, by="balance_in_cents")
+
+
+async def test_compact(clean_db):
+    async with sessionmanager.session() as session:
+        user = await User.create_with_invite_code(email="rollup@user.com", session=session)
+        now = datetime.utcnow()
+        await UsageRollup.record(session, user_id=user.id, feature="usage", amount_in_cents=10,
+                                 at=now - timedelta(days=30))
+        await UsageRollup.record(session, user_id=user.id, feature="usage", amount_in_cents=20, at=now)
+        await session.commit()
+
+        assert await UsageRollup.compact(session, retention_days=7) == 1
+        await session.commit()
+
+        hourly = await UsageRollup.series(session, start=now - timedelta(days=60), end=now + timedelta(days=1),
+                                          user_id=user.id, granularity=UsageRollup.HOUR)
+        daily = await UsageRollup.series(session, start=now - timedelta(days=60), end=now + timedelta(days=1),
+                                         user_id=user.id)
+        assert len(hourly) == 1
+        assert [r.amount_in_cents for r in daily] == [10, 20]
@@ -1,8 +1,19 @@
+import asyncio
+import multiprocessing
+import os
+import tempfile
+
+from sqlalchemy import select, func
+
 from app.database.models.invite_code import InviteCode
+from app.database.models.usage_rollup import UsageRollup
 from app.database.models.user import User
-from app.config import config
-from app.database.connector import sessionmanager
+from app.config import config, Config, use_config
+from app.database.connector import DatabaseSessionManager, sessionmanager
+from app.database.migrations import migrate
+from app.services.ban import ban_registry
 import pytest
+from datetime import timedelta
 from tests.clean_db import clean_db
 
 
@@ -124,6 +135,68 @@ async def test_ban(clean_db):
         assert reloaded_user.is_banned is False
 
 
+async def test_timed_ban(clean_db):
+    async with sessionmanager.session() as session:
+        user = await User.create_with_invite_code(qq_number="10001", session=session)
+
+        assert await user.ban(session=session, duration=timedelta(hours=1))
+        assert user.banned_count == 1
+        assert user.current_banned_period == timedelta(hours=1)
+        assert ban_registry.is_banned(qq_number="10001")
+        assert ban_registry.next_expiry() == user.current_banned_since + timedelta(hours=1)
+
+        expires_at = user.current_banned_since + timedelta(hours=1)
+        lifted = await User.lift_bans(session=session, ids=ban_registry.pop_expired(expires_at), now=expires_at)
+        assert lifted == [user.id]
+        assert not ban_registry.is_banned(qq_number="10001")
+        await session.refresh(user)
+        assert user.is_banned is False
+        assert user.current_banned_since is None
+
+        assert [row.id for row in await User.get_banned(session=session)] == []
+
+
+async def test_lift_bans_keeps_renewed_bans(clean_db):
+    async with sessionmanager.session() as session:
+        user = await User.create_with_invite_code(qq_number="10003", session=session)
+        await user.ban(session=session, duration=timedelta(hours=1))
+        expires_at = user.current_banned_since + timedelta(hours=1)
+
+        # not run out yet
+        assert await User.lift_bans(session=session, ids=[user.id]) == []
+        # another worker banned the user again before this one's expiry came up
+        await user.ban(session=session, duration=timedelta(days=1))
+        assert await User.lift_bans(session=session, ids=[user.id], now=expires_at) == []
+        await session.refresh(user)
+        assert user.is_banned is True and user.current_banned_period == timedelta(days=1)
+
+
+async def test_record_violation(clean_db):
+    async with sessionmanager.session() as session:
+        user = await User.create_with_invite_code(qq_number="10002", session=session)
+        periods = [timedelta(hours=hours) for hours in config.safety.ban_periods_in_hours]
+
+        for _ in range(config.safety.violations_per_ban - 1):
+            assert await user.record_violation(session=session) is False
+        assert user.is_banned is False
+
+        assert await user.record_violation(session=session) is True
+        assert user.is_banned is True
+        assert user.banned_count == 1
+        assert user.violation_count == config.safety.violations_per_ban
+        assert user.current_banned_period == periods[0]
+        assert ban_registry.is_banned(qq_number="10002")
+
+        for _ in range(config.safety.violations_per_ban):
+            await user.record_violation(session=session)
+        reloaded_user = await User.get(qq_number="10002", session=session)
+        await session.refresh(reloaded_user)
+        assert reloaded_user.banned_count == 2
+        assert reloaded_user.current_banned_period == periods[1]
+
+        ban_registry.discard(user.id)
+
+
 async def test_pay(clean_db):
     async with sessionmanager.session() as session:
         # Setup: Create a user with a specific balance
@@ -208,3 +281,80 @@ async def test_bind_invite_code(clean_db):
         # 验证邀请码使用次数增加
         reloaded_invite_code = await InviteCode.get(session=session, code=invite_code.code)
         assert reloaded_invite_code.use_count == 2  # user, invitee
+
+
+async def test_get_many(clean_db, monkeypatch):
+    monkeypatch.setattr("app.database.models.user.IN_CHUNK_SIZE", 2)
+    async with sessionmanager.session() as session:
+        users = [await User.create_with_invite_code(qq_number=str(10000 + n), session=session) for n in range(5)]
+        by_email = await User.create_with_invite_code(email="many@test.com", session=session)
+
+        identifiers = [("qq_number", str(10000 + n)) for n in range(5)] + [
+            ("qq_number", "99999"), ("email", "many@test.com"), ("id", users[0].id), ("uuid", str(by_email.uuid)),
+            ("uuid", "not-a-uuid"),
+        ]
+        found = await User.get_many(session=session, identifiers=identifiers, load=("invite_code",))
+        assert [found[("qq_number", str(10000 + n))] for n in range(5)] == users
+        assert found[("email", "many@test.com")] is by_email
+        assert found[("id", users[0].id)] is users[0]
+        assert found[("uuid", str(by_email.uuid))] is by_email
+        assert ("qq_number", "99999") not in found and ("uuid", "not-a-uuid") not in found
+
+        with pytest.raises(ValueError):
+            await User.get_many(session=session, identifiers=[("nickname", "x")])
+
+        created = await User.get_many(
+            session=session, identifiers=[("qq_number", "10000"), ("qq_number", "20000"), ("wechat_id", "wx")],
+            create_missing=True
+        )
+        assert created[("qq_number", "10000")] is users[0]
+        new_user = await User.get(qq_number="20000", session=session, load=("invite_code",))
+        assert new_user is created[("qq_number", "20000")]
+        assert new_user.invite_code.code and new_user.invite_code_id == new_user.invite_code.id
+        assert await User.exists(wechat_id="wx", session=session)
+
+        snapshots = await User.get_snapshots(session=session, identifiers=[("qq_number", "20000")])
+        assert snapshots[("qq_number", "20000")].id == new_user.id
+
+
+def charge_in_worker(url: str, user_id: int, times: int):
+    """A separate worker process charging one cent at a time, retrying charges that hit a locked database"""
+    async def charge_all():
+        use_config(Config.validate({"db": {"url": url}}))
+        for _ in range(times):
+            while True:
+                try:
+                    async with sessionmanager.session() as session:
+                        user = await User.get(session=session, id=user_id)
+                        await user.charge(session=session, amount=1)
+                    break
+                except User.UserError:
+                    pass
+        await sessionmanager.close()
+
+    asyncio.run(charge_all())
+
+
+async def test_charges_from_several_workers():
+    with tempfile.TemporaryDirectory() as tmp:
+        url = f"sqlite+aiosqlite:///{os.path.join(tmp, 'workers.db')}"
+        manager = DatabaseSessionManager(host=url)
+        await migrate(manager.engine)
+        async with manager.session() as session:
+            user = await User.create_with_invite_code(qq_number="3579135", session=session)
+            before = user.balance_in_cents
+
+        context = multiprocessing.get_context("spawn")
+        workers = [context.Process(target=charge_in_worker, args=(url, user.id, 100)) for _ in range(2)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            await asyncio.to_thread(worker.join)
+        assert [worker.exitcode for worker in workers] == [0, 0]
+
+        async with manager.session() as session:
+            assert await session.scalar(select(User.balance_in_cents).where(User.id == user.id)) == before + 200
+            assert await session.scalar(select(func.sum(UsageRollup.events)).where(
+                UsageRollup.user_id == user.id, UsageRollup.feature == "charge", UsageRollup.granularity == "day"
+            )) == 200
+        await manager.close()
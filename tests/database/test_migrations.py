@@ -0,0 +1,98 @@
+import os
+import tempfile
+
+import pytest
+from sqlalchemy import event, inspect, insert, text
+
+from app.database.base import Base
+from app.database.connector import DatabaseSessionManager
+from app.database.migrations import migrate, current_version, load_models, schema_version, LATEST_VERSION
+
+
+@pytest.fixture()
+async def manager():
+    with tempfile.TemporaryDirectory() as tmp:
+        manager = DatabaseSessionManager(host=f"sqlite+aiosqlite:///{os.path.join(tmp, 'migrations.db')}")
+        yield manager
+        await manager.close()
+
+
+async def table_names(manager) -> set[str]:
+    async with manager.connect() as conn:
+        return set(await conn.run_sync(lambda sync_conn: inspect(sync_conn).get_table_names()))
+
+
+async def test_fresh_database(manager):
+    assert await current_version(manager.engine) is None
+    assert await migrate(manager.engine) == LATEST_VERSION
+    assert await current_version(manager.engine) == LATEST_VERSION
+    assert {"users", "invite_codes", "usage_rollups", "schema_version"} <= await table_names(manager)
+
+
+async def test_unversioned_database(manager):
+    # created by create_all before usage rollups and versioning existed
+    load_models()
+    async with manager.connect() as conn:
+        await conn.run_sync(Base.metadata.create_all, tables=[
+            Base.metadata.tables[name] for name in ("users", "invite_codes", "stats", "assistants", "threads")
+        ])
+    assert "usage_rollups" not in await table_names(manager)
+
+    assert await migrate(manager.engine) == LATEST_VERSION
+    assert "usage_rollups" in await table_names(manager)
+
+
+async def test_up_to_date_is_one_statement(manager):
+    await migrate(manager.engine)
+
+    statements = []
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(manager.engine.sync_engine, "before_cursor_execute", listener)
+    assert await migrate(manager.engine) == LATEST_VERSION
+    event.remove(manager.engine.sync_engine, "before_cursor_execute", listener)
+
+    assert len(statements) == 1
+    assert "schema_version" in statements[0]
+
+
+async def test_add_column(manager):
+    # assistants as created before the response cache flag existed
+    load_models()
+    async with manager.connect() as conn:
+        await conn.run_sync(Base.metadata.create_all, tables=[
+            Base.metadata.tables[name] for name in ("users", "invite_codes", "stats", "threads", "usage_rollups")
+        ])
+        await conn.execute(text("CREATE TABLE assistants (id INTEGER PRIMARY KEY, created_time DATETIME, "
+                                "updated_time DATETIME)"))
+        await conn.execute(text("INSERT INTO assistants (id) VALUES (1)"))
+        await conn.run_sync(schema_version.create)
+        await conn.execute(insert(schema_version).values(version=2))
+
+    assert await migrate(manager.engine) == LATEST_VERSION
+    assert "cached_responses" in await table_names(manager)
+    async with manager.connect() as conn:
+        assert (await conn.execute(text("SELECT response_cache_enabled FROM assistants"))).scalar() == 0
+
+
+async def test_thread_archive_columns(manager):
+    # threads as created before thread messages and archival existed
+    load_models()
+    async with manager.connect() as conn:
+        await conn.run_sync(Base.metadata.create_all, tables=[
+            Base.metadata.tables[name] for name in (
+                "users", "invite_codes", "stats", "assistants", "usage_rollups", "cached_responses",
+                "idempotency_records",
+            )
+        ])
+        await conn.execute(text("CREATE TABLE threads (id INTEGER PRIMARY KEY, created_time DATETIME, "
+                                "updated_time DATETIME)"))
+        await conn.execute(text("INSERT INTO threads (id) VALUES (1)"))
+        await conn.run_sync(schema_version.create)
+        await conn.execute(insert(schema_version).values(version=4))
+
+    assert await migrate(manager.engine) == LATEST_VERSION
+    assert "thread_messages" in await table_names(manager)
+    async with manager.connect() as conn:
+        assert (await conn.execute(text("SELECT message_count, archive_file FROM threads"))).one() == (0, None)
+        indexes = await conn.run_sync(lambda sync_conn: inspect(sync_conn).get_indexes("threads"))
+    assert {"ix_threads_user_id", "ix_threads_last_active_time"} <= {index["name"] for index in indexes}
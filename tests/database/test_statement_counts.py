@@ -0,0 +1,75 @@
+import pytest
+from sqlalchemy import event
+
+from tests.clean_db import clean_db
+from app.database.connector import sessionmanager
+from app.database.models.invite_code import InviteCode
+from app.database.models.user import User
+
+
+@pytest.fixture()
+def selects():
+    """SELECT statements issued while the test runs"""
+    statements = []
+
+    def listener(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append(statement)
+
+    engine = sessionmanager.engine.sync_engine
+    event.listen(engine, "before_cursor_execute", listener)
+    yield statements
+    event.remove(engine, "before_cursor_execute", listener)
+
+
+async def create_inviter(session, invitees: int) -> User:
+    inviter = await User.create_with_invite_code(session=session, email=f"inviter-{invitees}@test.com")
+    for n in range(invitees):
+        invitee = await User.create_with_invite_code(session=session, email=f"{invitees}-{n}@test.com")
+        invitee.inviter_id = inviter.id
+    await session.commit()
+    return inviter
+
+
+@pytest.mark.parametrize("invitees", [1, 10])
+async def test_get_with_loader_options(clean_db, selects, invitees):
+    async with sessionmanager.session() as session:
+        inviter = await create_inviter(session, invitees)
+        inviter_id = inviter.id
+
+    async with sessionmanager.session() as session:
+        selects.clear()
+        inviter = await User.get(session=session, id=inviter_id, load=("invite_code", "invitees.invite_code"))
+        codes = {invitee.invite_code.code for invitee in inviter.invitees}
+        assert len(codes) == invitees
+        assert inviter.invite_code.owner_id == inviter_id
+        # the user joined with its invite code, then the invitees joined with theirs, whatever their number
+        assert len(selects) == 2
+
+    async with sessionmanager.session() as session:
+        selects.clear()
+        invite_code = await InviteCode.get(session=session, code=codes.pop(), load=("owner.inviter",))
+        assert invite_code.owner.inviter.id == inviter_id
+        assert len(selects) == 1
+
+
+def test_unknown_relationship():
+    with pytest.raises(ValueError):
+        User.loader_options(["invite_code.nothing"])
+
+
+async def test_bind_does_not_load_invitees(clean_db, selects):
+    counts = []
+    for invitees in (0, 10):
+        async with sessionmanager.session() as session:
+            # the binding user already invited others, the circular binding check must not load them
+            user = await create_inviter(session, invitees)
+            inviter = await User.create_with_invite_code(session=session, email=f"code-owner-{invitees}@test.com")
+            code = inviter.invite_code.code
+            selects.clear()
+
+            await user.bind_invite_code(session=session, code=code)
+            assert not any("users.inviter_id" in statement.split("WHERE")[-1] and "EXISTS" not in statement
+                           for statement in selects)
+            counts.append(len(selects))
+    assert counts[0] == counts[1]
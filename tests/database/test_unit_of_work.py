@@ -0,0 +1,62 @@
+import pytest
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from tests.clean_db import clean_db
+from app.database.connector import sessionmanager
+from app.database.models.user import User
+from app.database.unit_of_work import unit_of_work, in_unit_of_work
+from app.config import config
+
+
+@pytest.fixture()
+def commits():
+    counter = []
+    listener = lambda _: counter.append(1)
+    event.listen(Session, "after_commit", listener)
+    yield counter
+    event.remove(Session, "after_commit", listener)
+
+
+async def test_bind_commits_once(clean_db, commits):
+    async with sessionmanager.session() as session:
+        user = await User.create_with_invite_code(email="user@test.com", session=session)
+        inviter = await User.create_with_invite_code(email="inviter@test.com", session=session)
+        commits.clear()
+
+        async with unit_of_work(session):
+            assert in_unit_of_work(session)
+            await user.bind_invite_code(session=session, code=inviter.invite_code.code)
+            assert commits == []
+        assert not in_unit_of_work(session)
+        assert len(commits) == 1
+
+        reloaded_inviter = await User.get(id=inviter.id, session=session)
+        await session.refresh(reloaded_inviter)
+        assert reloaded_inviter.total_bonus_amount_in_cents == config.referral.inviter_cash_back_amount_when_bind_in_cents
+
+
+async def test_nested_units_commit_once(clean_db, commits):
+    async with sessionmanager.session() as session:
+        async with unit_of_work(session):
+            user = await User.create_with_invite_code(email="user@test.com", session=session)
+            async with unit_of_work(session):
+                await user.charge(session, 1000)
+            await user.pay(session=session, amount=100)
+        assert len(commits) == 1
+
+
+async def test_rollback_on_error(clean_db):
+    async with sessionmanager.session() as session:
+        user = await User.create_with_invite_code(email="user@test.com", session=session)
+        user_id = user.id
+
+        with pytest.raises(RuntimeError):
+            async with unit_of_work(session):
+                await user.charge(session, 1000)
+                raise RuntimeError
+
+        reloaded_user = await User.get(id=user_id, session=session)
+        await session.refresh(reloaded_user)
+        assert reloaded_user.balance_in_cents == config.billing.balance_in_cents
+        assert reloaded_user.total_recharged_amount_in_cents == 0
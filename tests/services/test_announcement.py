@@ -0,0 +1,234 @@
+import asyncio
+
+import pytest
+from sqlalchemy import update
+
+from app.config import get_config, use_config, RateLimitRule
+from app.database.connector import sessionmanager
+from app.database.models.broadcast import Broadcast
+from app.database.models.user import User
+from app.services.announcement import AnnouncementFanOut, FakeDeliverySink, NoDeliverySinkError
+from app.services.lifecycle import lifecycle
+from app.services.rate_limit import LocalRateLimitBackend
+from tests.clean_db import clean_db
+
+GROUPS = ["100001", "100002"]
+
+
+@pytest.fixture()
+def settings():
+    original_config = get_config()
+    use_config(original_config.copy(update={"announcement": original_config.announcement.copy(update={
+        "page_size": 3, "workers": 4, "max_attempts": 3, "retry_base_delay_in_seconds": 0,
+        "channel_rate_limits": {"qq_group": RateLimitRule(requests_per_minute=60_000, burst=100)},
+    })}))
+    yield
+    use_config(original_config)
+
+
+@pytest.fixture()
+async def qq_numbers(clean_db) -> list[str]:
+    async with sessionmanager.session() as session:
+        numbers = [str(700_000 + n) for n in range(8)]
+        for number in numbers:
+            await User.create_with_invite_code(session=session, qq_number=number)
+        banned = await User.create_with_invite_code(session=session, qq_number="799999")
+        banned.is_banned = True
+        await User.create_with_invite_code(session=session, email="someone@example.com")
+        await session.commit()
+        return numbers
+
+
+async def test_fan_out(settings, qq_numbers):
+    sink = FakeDeliverySink(delay=0.001, failures={qq_numbers[1]: 2}, rejected={qq_numbers[2]})
+    async with sessionmanager.session() as session:
+        broadcast = await AnnouncementFanOut(sink).start(session=session, message="维护通知", groups=GROUPS)
+
+    assert broadcast.status == Broadcast.DONE
+    assert (broadcast.delivered, broadcast.failed) == (10, 1)
+    assert sorted(destination for _, destination, _ in sink.sent) == sorted(
+        GROUPS + [number for number in qq_numbers if number != qq_numbers[2]] + ["someone@example.com"]
+    )
+    assert ("email", "someone@example.com", "维护通知") in sink.sent
+    assert "799999" not in sink.attempts
+    assert sink.attempts[qq_numbers[1]] == 3
+    assert sink.attempts[qq_numbers[2]] == 1
+    assert 1 < sink.max_inflight <= 4
+
+
+async def test_resume_after_interruption(settings, qq_numbers, monkeypatch):
+    get_contacts_after = User.get_contacts_after
+    pages = 0
+
+    async def crashing(*args, **kwargs):
+        nonlocal pages
+        if (pages := pages + 1) == 3:
+            raise ConnectionError("database went away")
+        return await get_contacts_after(*args, **kwargs)
+
+    monkeypatch.setattr(User, "get_contacts_after", crashing)
+    first = FakeDeliverySink(delay=0.001)
+    with pytest.raises(ConnectionError):
+        async with sessionmanager.session() as session:
+            await AnnouncementFanOut(first).start(session=session, message="hello", groups=GROUPS)
+    monkeypatch.setattr(User, "get_contacts_after", get_contacts_after)
+
+    async with sessionmanager.session() as session:
+        [broadcast] = await Broadcast.get_unfinished(session=session)
+        assert broadcast.groups_done
+        checkpoint = broadcast.last_user_id
+
+        second = FakeDeliverySink()
+        [finished] = await AnnouncementFanOut(second).resume(session=session)
+        assert finished.status == Broadcast.DONE
+        assert await Broadcast.get_unfinished(session=session) == []
+        remaining = await User.get_contacts_after(session=session, after_id=checkpoint, limit=100)
+
+    # everything after the checkpoint again, nothing before it
+    assert sorted(destination for _, destination, _ in second.sent) == \
+        sorted(contact.qq_number or contact.email for contact in remaining)
+    assert {destination for _, destination, _ in first.sent + second.sent} == \
+        set(GROUPS + qq_numbers + ["someone@example.com"])
+
+
+async def test_failed_checkpoint(settings, qq_numbers, monkeypatch):
+    checkpoint = Broadcast.checkpoint
+    calls = 0
+
+    async def failing_once(self, session, *args, **kwargs):
+        nonlocal calls
+        if (calls := calls + 1) == 2:
+            raise ConnectionError("database went away")
+        return await checkpoint(self, session, *args, **kwargs)
+
+    monkeypatch.setattr(Broadcast, "checkpoint", failing_once)
+    sink = FakeDeliverySink()
+    async with sessionmanager.session() as session:
+        broadcast = await AnnouncementFanOut(sink).start(session=session, message="hello", groups=GROUPS)
+
+    # the rest of the broadcast went out, only the failed checkpoint's counts are missing
+    assert broadcast.status == Broadcast.DONE
+    assert len(sink.sent) == len(GROUPS) + len(qq_numbers) + 1
+    assert broadcast.delivered == len(sink.sent) - 3
+
+
+async def test_pause_on_shutdown(settings, qq_numbers, monkeypatch):
+    get_contacts_after = User.get_contacts_after
+
+    async def shutting_down(*args, **kwargs):
+        monkeypatch.setattr(lifecycle, "accepting", False)
+        return await get_contacts_after(*args, **kwargs)
+
+    monkeypatch.setattr(User, "get_contacts_after", shutting_down)
+    first = FakeDeliverySink()
+    async with sessionmanager.session() as session:
+        paused = await AnnouncementFanOut(first).start(session=session, message="hello", groups=GROUPS)
+    assert paused.status == Broadcast.RUNNING
+    assert paused.last_user_id > 0 and paused.claimed_until is None
+    monkeypatch.undo()
+
+    async with sessionmanager.session() as session:
+        assert await AnnouncementFanOut(None).resume(session=session) == []
+        second = FakeDeliverySink()
+        [finished] = await AnnouncementFanOut(second).resume(session=session)
+    assert finished.status == Broadcast.DONE
+    assert len(first.sent) + len(second.sent) == len(GROUPS) + len(qq_numbers) + 1
+
+
+async def test_groups_in_pages(settings, qq_numbers, monkeypatch):
+    use_config(get_config().copy(update={"announcement": get_config().announcement.copy(update={"workers": 1})}))
+    groups = [str(100_000 + n) for n in range(7)]
+
+    class ShuttingDownSink(FakeDeliverySink):
+        async def send(self, *args):
+            monkeypatch.setattr(lifecycle, "accepting", False)
+            await super().send(*args)
+
+    first = ShuttingDownSink()
+    async with sessionmanager.session() as session:
+        paused = await AnnouncementFanOut(first).start(session=session, message="hello", groups=groups)
+    assert (paused.groups_sent, paused.groups_done, paused.last_user_id) == (3, False, 0)
+    assert [destination for _, destination, _ in first.sent] == groups[:3]
+    monkeypatch.undo()
+
+    async with sessionmanager.session() as session:
+        second = FakeDeliverySink()
+        [finished] = await AnnouncementFanOut(second).resume(session=session)
+    assert finished.status == Broadcast.DONE and finished.groups_sent == len(groups)
+    assert sorted(destination for channel, destination, _ in second.sent if channel == "qq_group") == groups[3:]
+
+
+async def test_stop_when_claim_lost(settings, qq_numbers, monkeypatch):
+    checkpoint = Broadcast.checkpoint
+
+    async def taken_over(self, session, *args, **kwargs):
+        if kwargs.get("last_user_id"):
+            # another worker claimed it after the lease ran out
+            await session.execute(update(Broadcast).where(Broadcast.id == self.id).values(claim_token="another"))
+        return await checkpoint(self, session, *args, **kwargs)
+
+    monkeypatch.setattr(Broadcast, "checkpoint", taken_over)
+    sink = FakeDeliverySink()
+    async with sessionmanager.session() as session:
+        broadcast = await AnnouncementFanOut(sink).start(session=session, message="hello", groups=GROUPS)
+        await session.refresh(broadcast)
+
+    # the first user page went out, its progress belongs to the new holder
+    assert broadcast.status == Broadcast.RUNNING
+    assert (broadcast.claim_token, broadcast.delivered, broadcast.last_user_id) == ("another", len(GROUPS), 0)
+    assert len(sink.sent) < len(GROUPS) + len(qq_numbers) + 1
+
+
+async def test_lease_renewed_while_sending(settings, clean_db, monkeypatch):
+    use_config(get_config().copy(update={"announcement": get_config().announcement.copy(update={
+        "page_size": 100, "workers": 1, "lease_in_seconds": 0.06,
+    })}))
+    renew = Broadcast.renew
+    renewals = 0
+
+    async def counting(*args, **kwargs):
+        nonlocal renewals
+        renewals += 1
+        return await renew(*args, **kwargs)
+
+    monkeypatch.setattr(Broadcast, "renew", counting)
+    async with sessionmanager.session() as session:
+        # one page taking several leases
+        broadcast = await AnnouncementFanOut(FakeDeliverySink(delay=0.02)).start(
+            session=session, message="hello", groups=[str(n) for n in range(8)]
+        )
+    assert broadcast.status == Broadcast.DONE and broadcast.delivered == 8
+    assert renewals >= 3
+
+
+async def test_start_without_sink(settings, clean_db):
+    async with sessionmanager.session() as session:
+        with pytest.raises(NoDeliverySinkError):
+            await AnnouncementFanOut(None).start(session=session, message="hello", groups=GROUPS)
+        assert await Broadcast.get_unfinished(session=session) == []
+
+
+async def test_claimed_broadcast_not_resumed(settings, clean_db):
+    async with sessionmanager.session() as session:
+        # another worker is running it
+        await Broadcast.create(session=session, message="hello", groups=GROUPS)
+        sink = FakeDeliverySink()
+        assert await AnnouncementFanOut(sink).resume(session=session) == []
+        assert sink.sent == []
+
+
+async def test_channel_rate_limit(settings, qq_numbers):
+    use_config(get_config().copy(update={"announcement": get_config().announcement.copy(update={"workers": 1})}))
+    now = 0.
+
+    async def sleep(seconds: float):
+        # a nanosecond more so float rounding cannot stall the bucket
+        nonlocal now
+        now += seconds + 1e-9
+
+    rate_limits = LocalRateLimitBackend(idle_timeout_in_seconds=3600, max_keys=100, clock=lambda: now)
+    fan_out = AnnouncementFanOut(FakeDeliverySink(), rate_limits=rate_limits, sleep=sleep)
+    async with sessionmanager.session() as session:
+        await fan_out.start(session=session, message="hello", groups=[str(n) for n in range(150)])
+    # a burst of 100, then 1000 a second
+    assert now == pytest.approx(0.05, abs=0.002)
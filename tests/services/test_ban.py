@@ -0,0 +1,61 @@
+import asyncio
+import contextlib
+from datetime import datetime, timedelta
+
+from app.services.ban import BanRegistry
+
+
+def test_is_banned_by_identifier():
+    registry = BanRegistry()
+    registry.add(1, qq_number="12345", email="1@1.com")
+
+    assert registry.is_banned(id=1)
+    assert registry.is_banned(qq_number="12345")
+    assert registry.is_banned(email="1@1.com", qq_number=None)
+    assert not registry.is_banned(qq_number="54321")
+    assert not registry.is_banned()
+
+    registry.discard(1)
+    assert not registry.is_banned(id=1)
+    assert not registry.is_banned(qq_number="12345")
+
+
+def test_pop_expired():
+    registry = BanRegistry()
+    now = datetime(2024, 4, 9, 12)
+    registry.add(1, banned_since=now, banned_period=timedelta(hours=1))
+    registry.add(2, banned_since=now, banned_period=timedelta(hours=2))
+    registry.add(3, banned_since=now)  # permanent
+
+    assert registry.next_expiry() == now + timedelta(hours=1)
+    assert not registry.is_banned(id=1, now=now + timedelta(hours=1))
+    assert registry.pop_expired(now + timedelta(minutes=30)) == []
+    assert registry.pop_expired(now + timedelta(hours=1)) == [1]
+    assert 1 not in registry
+
+    # re-banning leaves a stale heap entry behind, which must not lift the new ban
+    registry.add(2, banned_since=now, banned_period=timedelta(days=1))
+    assert registry.pop_expired(now + timedelta(hours=3)) == []
+    assert 2 in registry
+    assert registry.pop_expired(now + timedelta(days=2)) == [2]
+    assert registry.is_banned(id=3, now=now + timedelta(days=365))
+
+
+async def test_run_expiry():
+    registry = BanRegistry()
+    lifted = []
+
+    async def on_expired(ids):
+        lifted.extend(ids)
+
+    task = asyncio.create_task(registry.run_expiry(on_expired))
+    await asyncio.sleep(0)
+    registry.add(1, banned_period=timedelta(hours=1))
+    registry.add(2, banned_period=timedelta(milliseconds=50))
+    await asyncio.sleep(0.2)
+    task.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await task
+
+    assert lifted == [2]
+    assert 1 in registry
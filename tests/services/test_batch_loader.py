@@ -0,0 +1,48 @@
+import asyncio
+
+import pytest
+
+from app.services.batch_loader import BatchLoader
+
+
+async def test_coalesces_one_tick():
+    batches = []
+
+    async def batch(keys):
+        batches.append(keys)
+        return {key: key * 10 for key in keys if key != 3}
+
+    loader = BatchLoader(batch, max_batch_size=2)
+    results = await asyncio.gather(*[loader.load(key) for key in (1, 2, 1, 3)])
+    assert results == [10, 20, 10, None]
+    assert batches == [[1, 2], [3]]
+
+    assert await loader.load(4) == 40
+    assert batches[-1] == [4]
+
+
+async def test_errors_reach_every_caller():
+    async def batch(keys):
+        raise RuntimeError("database is gone")
+
+    loader = BatchLoader(batch)
+    results = await asyncio.gather(loader.load(1), loader.load(2), return_exceptions=True)
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+async def test_cancelled_caller():
+    release = asyncio.Event()
+
+    async def batch(keys):
+        await release.wait()
+        return {key: key for key in keys}
+
+    loader = BatchLoader(batch)
+    cancelled = asyncio.create_task(loader.load(1))
+    waiting = asyncio.create_task(loader.load(1))
+    await asyncio.sleep(0)
+    cancelled.cancel()
+    release.set()
+    assert await waiting == 1
+    with pytest.raises(asyncio.CancelledError):
+        await cancelled
@@ -0,0 +1,97 @@
+import csv
+import gzip
+import io
+import json
+from datetime import date, datetime
+
+import pytest
+from fastapi import HTTPException, Request
+
+from app.config import get_config, use_config
+from app.database.connector import sessionmanager
+from app.database.models.usage_rollup import UsageRollup
+from app.database.models.user import User
+from app.endpoints.export import export_dataset, require_export_token
+from app.services.export import export, stream_rows
+from tests.clean_db import clean_db
+
+
+async def collect(**kwargs) -> tuple[list[bytes], bytes]:
+    async with sessionmanager.session() as session:
+        chunks = [chunk async for chunk in export(session, **kwargs)]
+    return chunks, b"".join(chunks)
+
+
+@pytest.fixture()
+async def users(clean_db):
+    async with sessionmanager.session() as session:
+        users = [await User.create_with_invite_code(session=session, qq_number=str(100_000 + n)) for n in range(5)]
+        for day, user in zip((1, 15, 31), users):
+            await UsageRollup.record(
+                session=session, user_id=user.id, feature="charge", amount_in_cents=day, at=datetime(2024, 5, day, 12)
+            )
+        await session.commit()
+        return [user.id for user in users]
+
+
+async def test_chunks(users):
+    async with sessionmanager.session() as session:
+        sizes = [len(rows) async for rows in stream_rows(session, "users", chunk_rows=2)]
+    assert sizes == [2, 2, 1]
+
+    chunks, body = await collect(dataset="users", format="csv", chunk_rows=2)
+    assert len(chunks) == 3  # one per two rows, the header goes out with the first
+    rows = list(csv.DictReader(io.StringIO(body.decode())))
+    assert [int(row["id"]) for row in rows] == users
+    assert rows[0]["qq_number"] == "100000"
+    assert rows[0]["balance_in_cents"] == str(get_config().billing.balance_in_cents)
+
+
+async def test_jsonl_gzip_and_period(users):
+    _, body = await collect(
+        dataset="ledger", format="jsonl", since=date(2024, 5, 10), until=date(2024, 5, 31), compress=True
+    )
+    lines = gzip.decompress(body).decode().splitlines()
+    assert [json.loads(line) for line in lines] == [{
+        "bucket_start": "2024-05-15T00:00:00", "user_id": users[1], "feature": "charge", "events": 1,
+        "amount_in_cents": 15, "token_usage": 0,
+    }]
+
+    _, body = await collect(dataset="stats", format="csv", since=date(2000, 1, 1), until=date(2000, 1, 2))
+    assert body.decode().startswith("date_interval,api_calls,")
+
+    with pytest.raises(ValueError):
+        await collect(dataset="orders")
+    with pytest.raises(ValueError):
+        await collect(dataset="users", format="xml")
+
+
+def make_request(authorization: str = None) -> Request:
+    headers = [(b"authorization", authorization.encode())] if authorization else []
+    return Request({"type": "http", "method": "GET", "path": "/export/users", "query_string": b"",
+                    "headers": headers})
+
+
+async def test_endpoint(users):
+    original_config = get_config()
+    with pytest.raises(HTTPException) as e:
+        await require_export_token(make_request("Bearer anything"))
+    assert e.value.status_code == 404
+
+    use_config(original_config.copy(update={"export": original_config.export.copy(update={"access_token": "s3cret"})}))
+    try:
+        with pytest.raises(HTTPException) as e:
+            await require_export_token(make_request("Bearer guess"))
+        assert e.value.status_code == 401
+        await require_export_token(make_request("Bearer s3cret"))
+
+        response = await export_dataset("users", format="csv", gzip=True)
+        assert response.headers["content-disposition"] == 'attachment; filename="users.csv.gz"'
+        body = b"".join([chunk async for chunk in response.body_iterator])
+        assert len(gzip.decompress(body).decode().splitlines()) == len(users) + 1
+
+        with pytest.raises(HTTPException) as e:
+            await export_dataset("orders")
+        assert e.value.status_code == 404
+    finally:
+        use_config(original_config)
@@ -0,0 +1,168 @@
+import asyncio
+import contextlib
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException, Request
+from sqlalchemy import event, select
+
+from app.database.connector import get_db_session, sessionmanager
+from app.database.models.idempotency_record import IdempotencyRecord
+from app.database.models.user import User
+from app.endpoints.dependencies import idempotency_key
+from app.services.idempotency import idempotency, key_hash
+from tests.clean_db import clean_db
+
+
+class StatementLog:
+    def __init__(self):
+        self.statements = []
+
+    def __call__(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(sessionmanager.engine.sync_engine, "before_cursor_execute", self)
+        return self.statements
+
+    def __exit__(self, *exc_info):
+        event.remove(sessionmanager.engine.sync_engine, "before_cursor_execute", self)
+
+
+async def charge(user_id: int, key: str, amount: int = 100) -> bool:
+    async with sessionmanager.session() as session:
+        async def call():
+            user = await User.get(session=session, id=user_id)
+            return await user.charge(session=session, amount=amount)
+
+        return await idempotency.run(session, key, "charge", user_id, call)
+
+
+async def charge_in_request(user_id: int, key: str, amount: int = 100) -> bool:
+    """As an endpoint does, inside the request's unit of work"""
+    async with contextlib.asynccontextmanager(get_db_session)() as session:
+        async def call():
+            user = await User.get(session=session, id=user_id)
+            return await user.charge(session=session, amount=amount)
+
+        return await idempotency.run(session, key, "charge", user_id, call)
+
+
+async def balance(user_id: int) -> int:
+    async with sessionmanager.session() as session:
+        return await session.scalar(select(User.balance_in_cents).where(User.id == user_id))
+
+
+@pytest.fixture()
+async def user_id(clean_db) -> int:
+    async with sessionmanager.session() as session:
+        return (await User.create_with_invite_code(session=session, qq_number="2468024")).id
+
+
+async def test_retry_returns_stored_result(user_id):
+    before = await balance(user_id)
+    assert await charge(user_id, "retry-1") is True
+    assert await balance(user_id) == before + 100
+
+    with StatementLog() as statements:
+        assert await charge(user_id, "retry-1") is True
+    assert statements == []
+
+    idempotency.clear()
+    with StatementLog() as statements:
+        assert await charge(user_id, "retry-1") is True
+    assert statements and not any("users" in statement for statement in statements)
+    assert await balance(user_id) == before + 100
+
+    # a new key, another operation or no key at all is a new call
+    assert await charge(user_id, "retry-2") is True
+    assert await charge(user_id, None) is True
+    async with sessionmanager.session() as session:
+        assert await idempotency.run(session, "retry-1", "pay", user_id, lambda: asyncio.sleep(0, "paid")) == "paid"
+    assert await balance(user_id) == before + 300
+
+
+async def test_concurrent_retries_run_once(user_id):
+    before = await balance(user_id)
+    assert await asyncio.gather(*[charge(user_id, "concurrent") for _ in range(5)]) == [True] * 5
+    assert await balance(user_id) == before + 100
+
+
+async def test_concurrent_retries_in_requests_run_once(user_id):
+    before = await balance(user_id)
+    assert await asyncio.gather(*[charge_in_request(user_id, "in-request") for _ in range(3)]) == [True] * 3
+    assert await balance(user_id) == before + 100
+
+    # a retry waits until the first request's transaction ends, not just its call
+    async with contextlib.asynccontextmanager(get_db_session)() as session:
+        user = await User.get(session=session, id=user_id)
+        assert await idempotency.run(session, "in-request-2", "charge", user_id,
+                                     lambda: user.charge(session=session, amount=100)) is True
+        retry = asyncio.create_task(charge_in_request(user_id, "in-request-2"))
+        await asyncio.sleep(0.01)
+        assert not retry.done()
+    assert await retry is True
+    assert await balance(user_id) == before + 200
+
+
+async def test_lost_race_returns_stored_result(user_id, monkeypatch):
+    digest = key_hash("charge", user_id, "raced")
+    async with sessionmanager.session() as session:
+        await IdempotencyRecord.put(session=session, key_hash=digest, operation="charge", result="false",
+                                    expires_at=datetime.utcnow() + timedelta(hours=1))
+        await session.commit()
+
+    # the other worker commits between this worker's lookup and its insert
+    get_result = IdempotencyRecord.get_result
+    lookups = 0
+
+    async def racing(*args, **kwargs):
+        nonlocal lookups
+        lookups += 1
+        return None if lookups == 1 else await get_result(*args, **kwargs)
+
+    monkeypatch.setattr(IdempotencyRecord, "get_result", racing)
+    before = await balance(user_id)
+    assert await charge_in_request(user_id, "raced") is False
+    assert await balance(user_id) == before
+
+
+async def test_failed_call_not_recorded(user_id):
+    async def failing():
+        raise ConnectionError()
+
+    async with sessionmanager.session() as session:
+        with pytest.raises(ConnectionError):
+            await idempotency.run(session, "flaky", "charge", user_id, failing)
+        assert await IdempotencyRecord.get_result(session=session, key_hash=key_hash("charge", user_id, "flaky")) \
+            is None
+
+    before = await balance(user_id)
+    assert await charge(user_id, "flaky") is True
+    assert await balance(user_id) == before + 100
+
+
+async def test_purge(clean_db):
+    async with sessionmanager.session() as session:
+        now = datetime.utcnow()
+        for n, hours in enumerate((-1, 1)):
+            await IdempotencyRecord.put(
+                session=session, key_hash=f"hash-{n}", operation="pay", result="true",
+                expires_at=now + timedelta(hours=hours)
+            )
+        await session.flush()
+        assert await IdempotencyRecord.get_result(session=session, key_hash="hash-0") is None
+        assert await IdempotencyRecord.get_result(session=session, key_hash="hash-1") == "true"
+        assert await idempotency.purge(session=session) == 1
+
+
+async def test_header():
+    def make_request(*headers: tuple[bytes, bytes]) -> Request:
+        return Request({"type": "http", "method": "POST", "path": "/v1", "query_string": b"",
+                        "headers": list(headers)})
+
+    assert await idempotency_key(make_request()) is None
+    assert await idempotency_key(make_request((b"idempotency-key", b"abc"))) == "abc"
+    with pytest.raises(HTTPException) as e:
+        await idempotency_key(make_request((b"idempotency-key", b"x" * 256)))
+    assert e.value.status_code == 400
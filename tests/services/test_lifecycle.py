@@ -0,0 +1,39 @@
+import asyncio
+
+from app.services.lifecycle import Lifecycle
+
+
+async def test_drain_waits_for_runs():
+    lifecycle = Lifecycle()
+    finished = []
+
+    async def run():
+        async with lifecycle.track():
+            await asyncio.sleep(0.05)
+            finished.append(1)
+
+    task = asyncio.create_task(run())
+    await asyncio.sleep(0)
+    assert lifecycle.inflight == 1
+
+    lifecycle.stop_accepting()
+    assert await lifecycle.drain(timeout=1)
+    assert finished == [1]
+    assert not lifecycle.accepting
+    await task
+
+
+async def test_drain_timeout():
+    lifecycle = Lifecycle()
+    release = asyncio.Event()
+
+    async def run():
+        async with lifecycle.track():
+            await release.wait()
+
+    task = asyncio.create_task(run())
+    await asyncio.sleep(0)
+    assert not await lifecycle.drain(timeout=0.01)
+    release.set()
+    await task
+    assert lifecycle.inflight == 0
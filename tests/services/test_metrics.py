@@ -0,0 +1,79 @@
+from fastapi import FastAPI, APIRouter, Depends
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database.connector import get_db_session
+from app.services.metrics import HistogramFamily, MetricsMiddleware, metrics
+from tests.clean_db import clean_db
+
+
+def test_histogram_render():
+    family = HistogramFamily("latency_seconds", "Latency", ("route",), (.1, 1))
+    family.labels("/a").observe(.05)
+    family.labels("/a").observe(.5)
+    family.labels("/a").observe(5)
+
+    assert family.render() == [
+        "# HELP latency_seconds Latency",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{route="/a",le="0.1"} 1',
+        'latency_seconds_bucket{route="/a",le="1.0"} 2',
+        'latency_seconds_bucket{route="/a",le="+Inf"} 3',
+        'latency_seconds_sum{route="/a"} 5.55',
+        'latency_seconds_count{route="/a"} 3',
+    ]
+
+
+def test_time_upstream():
+    try:
+        with metrics.time_upstream("test-upstream"):
+            raise TimeoutError
+    except TimeoutError:
+        pass
+    with metrics.time_upstream("test-upstream"):
+        pass
+
+    assert metrics.upstream_duration.labels("test-upstream", "error").count == 1
+    assert metrics.upstream_duration.labels("test-upstream", "ok").count == 1
+
+
+async def call(app, path: str) -> int:
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    await app({
+        "type": "http", "method": "GET", "path": path, "raw_path": path.encode(), "query_string": b"",
+        "headers": [], "client": ("127.0.0.1", 50000), "server": ("test", 80), "scheme": "http",
+        "root_path": "", "http_version": "1.1",
+    }, receive, send)
+    return messages[0]["status"]
+
+
+async def test_middleware_counts_statements(clean_db):
+    router = APIRouter()
+
+    @router.get("/items/{item_id}")
+    async def get_item(item_id: int, session: AsyncSession = Depends(get_db_session)):
+        await session.execute(text("SELECT 1"))
+        await session.execute(text("SELECT 2"))
+        return item_id
+
+    app = FastAPI()
+    app.include_router(router)
+    app.add_middleware(MetricsMiddleware)
+
+    assert await call(app, "/items/1") == 200
+    assert await call(app, "/items/2") == 200
+    assert await call(app, "/missing") == 404
+
+    assert metrics.request_duration.labels("GET", "/items/{item_id}", "200").count == 2
+    assert metrics.request_duration.labels("GET", "unmatched", "404").count >= 1
+    statements = metrics.request_statements.labels("/items/{item_id}")
+    assert statements.count == 2
+    assert statements.sum >= 4
+    assert 'route="/items/{item_id}"' in metrics.render()
@@ -0,0 +1,129 @@
+import pytest
+from fastapi import HTTPException, Request
+
+from app.config import config, get_config, use_config, RateLimit, RateLimitRule
+from app.endpoints.dependencies import rate_limit
+from app.services.rate_limit import LocalRateLimitBackend, RateLimiter, rate_limiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+
+async def test_token_bucket():
+    clock = FakeClock()
+    backend = LocalRateLimitBackend(clock=clock)
+
+    for _ in range(3):
+        assert await backend.acquire(["a"], rate=1, burst=3) == 0
+    assert await backend.acquire(["a"], rate=1, burst=3) == 1
+    # other keys are independent
+    assert await backend.acquire(["b"], rate=1, burst=3) == 0
+
+    clock.now = 1.5
+    assert await backend.acquire(["a"], rate=1, burst=3) == 0
+    assert await backend.acquire(["a"], rate=1, burst=3) == 0.5
+
+
+async def test_all_or_nothing():
+    backend = LocalRateLimitBackend(clock=FakeClock())
+    assert await backend.acquire(["ip"], rate=1, burst=1) == 0
+
+    # "user" must not be charged when "ip" is exhausted
+    assert await backend.acquire(["user", "ip"], rate=1, burst=1) > 0
+    assert await backend.acquire(["user"], rate=1, burst=1) == 0
+
+
+async def test_idle_eviction():
+    clock = FakeClock()
+    backend = LocalRateLimitBackend(idle_timeout_in_seconds=10, max_keys=3, clock=clock)
+    for key in "abc":
+        await backend.acquire([key], rate=1, burst=1)
+    assert len(backend) == 3
+
+    await backend.acquire(["d"], rate=1, burst=1)
+    assert len(backend) == 3  # "a" evicted by max_keys
+
+    clock.now = 20
+    await backend.acquire(["e"], rate=1, burst=1)
+    assert len(backend) == 1
+
+
+def test_endpoint_class():
+    limiter = RateLimiter(LocalRateLimitBackend())
+    assert limiter.endpoint_class("/v1/run/tts") == "default"
+
+    original_config = get_config()
+    use_config(original_config.copy(update={
+        "rate_limit": original_config.rate_limit.copy(
+            update={"endpoint_classes": {"/v1/run": "chat", "/v1/run/tts": "tts"}}
+        )
+    }))
+    try:
+        assert limiter.endpoint_class("/v1/run/tts") == "tts"
+        assert limiter.endpoint_class("/v1/run/{run_id}") == "chat"
+        assert limiter.endpoint_class("/v1/threads") == "default"
+    finally:
+        use_config(original_config)
+
+
+def make_request(path: str, query_string: str, client: tuple[str, int] = ("127.0.0.1", 50000)) -> Request:
+    return Request({
+        "type": "http", "method": "GET", "path": path, "query_string": query_string.encode(),
+        "headers": [], "client": client,
+    })
+
+
+async def test_dependency(monkeypatch):
+    monkeypatch.setattr(rate_limiter, "backend", LocalRateLimitBackend(clock=FakeClock()))
+    burst = config.rate_limit.default.burst
+
+    for _ in range(burst):
+        await rate_limit(make_request("/v1/ping", "qq_number=10001"))
+    with pytest.raises(HTTPException) as exc_info:
+        await rate_limit(make_request("/v1/ping", "qq_number=10001"))
+    assert exc_info.value.status_code == 429
+    assert int(exc_info.value.headers["Retry-After"]) >= 1
+
+    # users behind the same gateway IP have their own budgets
+    await rate_limit(make_request("/v1/ping", "qq_number=10002"))
+
+    # anonymous requests are limited by their IP
+    for _ in range(burst):
+        await rate_limit(make_request("/v1/ping", "", client=("127.0.0.2", 50000)))
+    with pytest.raises(HTTPException):
+        await rate_limit(make_request("/v1/ping", "", client=("127.0.0.2", 50000)))
+    await rate_limit(make_request("/v1/ping", "qq_number=10003", client=("127.0.0.2", 50000)))
+
+
+async def test_ip_limit(monkeypatch):
+    monkeypatch.setattr(rate_limiter, "backend", LocalRateLimitBackend(clock=FakeClock()))
+    original_config = get_config()
+    use_config(original_config.copy(update={"rate_limit": original_config.rate_limit.copy(
+        update={"ip": RateLimitRule(requests_per_minute=60, burst=3)}
+    )}))
+    try:
+        for n in range(3):
+            await rate_limit(make_request("/v1/ping", f"qq_number={20000 + n}"))
+        with pytest.raises(HTTPException):
+            await rate_limit(make_request("/v1/ping", "qq_number=20003"))
+        # another gateway is not affected
+        await rate_limit(make_request("/v1/ping", "qq_number=20003", client=("127.0.0.3", 50000)))
+    finally:
+        use_config(original_config)
+
+
+def test_unknown_endpoint_class():
+    with pytest.raises(ValueError):
+        RateLimit(endpoint_classes={"/v1/run": "chats"})
+
+
+def test_non_positive_rule():
+    with pytest.raises(ValueError):
+        RateLimitRule(requests_per_minute=0)
+    with pytest.raises(ValueError):
+        RateLimit(chat={"requests_per_minute": 20, "burst": 0})
@@ -0,0 +1,92 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import select, func
+
+from tests.clean_db import clean_db
+from app.config import get_config, use_config
+from app.database.connector import sessionmanager
+from app.database.models.cached_response import CachedResponse
+from app.services.response_cache import normalize, simhash, response_cache
+
+SYSTEM_PROMPT = "You are a helpful AI assistant."
+
+
+@pytest.fixture()
+def enabled():
+    original_config = get_config()
+    use_config(original_config.copy(update={
+        "response_cache": original_config.response_cache.copy(update={"enabled": True, "max_entry_bytes": 1000})
+    }))
+    yield
+    use_config(original_config)
+
+
+MESSAGE = "Hello! Could you please tell me what kinds of things you are able to help me with as an assistant?"
+NEAR_DUPLICATE = "hello, could you please tell me what kind of things you are able to help me with as an assistant"
+
+
+def test_similarity():
+    assert normalize("ＡＢＣ,  def?\n") == "abc def"
+    assert normalize("What can you do?") == normalize("what can you do")
+    base = simhash(normalize(MESSAGE))
+    assert (base ^ simhash(normalize(NEAR_DUPLICATE))).bit_count() <= 4
+    assert (base ^ simhash(normalize("Write an essay about the history of the Roman empire."))).bit_count() > 10
+    # a different question, not a near duplicate
+    assert (simhash(normalize("帮我写一篇关于春天的作文")) ^ simhash(normalize("帮我写一篇关于秋天的作文"))).bit_count() > 10
+
+
+def test_cacheable(enabled):
+    assert response_cache.cacheable(assistant_enabled=True, temperature=0.2)
+    assert not response_cache.cacheable(assistant_enabled=True, temperature=0.8)
+    assert not response_cache.cacheable(assistant_enabled=False, temperature=0.2)
+
+
+async def test_store_and_lookup(clean_db, enabled):
+    async with sessionmanager.session() as session:
+        stored = await response_cache.store(
+            session, SYSTEM_PROMPT, MESSAGE, "gpt-3.5-turbo", 0.2, response="I can chat, draw and read images.",
+            token_usage=12, amount_in_cents=9
+        )
+        assert stored is not None
+
+        hit = await response_cache.lookup(session, SYSTEM_PROMPT, MESSAGE, "gpt-3.5-turbo", 0.2)
+        assert hit.id == stored.id
+        near = await response_cache.lookup(session, SYSTEM_PROMPT, NEAR_DUPLICATE, "gpt-3.5-turbo", 0.2)
+        assert near.id == stored.id
+        await session.refresh(stored)
+        assert stored.hits == 2
+        assert response_cache.hit_price(hit) == 2
+
+        assert "".join([delta async for delta in response_cache.stream(hit)]) == hit.response
+
+        assert await response_cache.lookup(session, SYSTEM_PROMPT, MESSAGE, "gpt-4", 0.2) is None
+        assert await response_cache.lookup(session, SYSTEM_PROMPT, MESSAGE, "gpt-3.5-turbo", 0.1) is None
+        assert await response_cache.lookup(session, "Be terse.", MESSAGE, "gpt-3.5-turbo", 0.2) is None
+        assert await response_cache.lookup(
+            session, SYSTEM_PROMPT, "Write an essay about Rome.", "gpt-3.5-turbo", 0.2
+        ) is None
+
+        await response_cache.store(session, SYSTEM_PROMPT, "Solve 2x+3=7", "gpt-3.5-turbo", 0.2, "x=2")
+        assert await response_cache.lookup(session, SYSTEM_PROMPT, "Solve 2x+3=9", "gpt-3.5-turbo", 0.2) is None
+        exact = await response_cache.lookup(session, SYSTEM_PROMPT, "solve 2x+3=7", "gpt-3.5-turbo", 0.2)
+        assert exact.response == "x=2"
+
+        assert await response_cache.store(session, SYSTEM_PROMPT, "Long", "gpt-3.5-turbo", 0.2, "x" * 1001) is None
+
+
+async def test_expiry_and_byte_limit(clean_db):
+    async with sessionmanager.session() as session:
+        now = datetime.utcnow()
+        for n in range(4):
+            await CachedResponse.put(
+                session, key=f"key-{n}", scope="scope", simhash=n, model="gpt-3.5-turbo", temperature=0,
+                response="x" * 100, expires_at=now + timedelta(hours=1 if n else -1)
+            )
+        await session.flush()
+        assert await CachedResponse.find(session, key="key-0", scope="scope", simhash=0) is None
+
+        assert await CachedResponse.purge(session, max_total_bytes=250) == 2
+        keys = await session.scalars(select(CachedResponse.key).order_by(CachedResponse.key))
+        assert list(keys) == ["key-2", "key-3"]
+        assert await session.scalar(select(func.sum(CachedResponse.size_in_bytes))) == 200
@@ -0,0 +1,108 @@
+import asyncio
+import uuid
+
+import pytest
+
+from app.config import get_config, use_config
+from app.services.metrics import metrics
+from app.services.scheduler import Scheduler, Overloaded, tier_of
+from app.services.user_cache import UserSnapshot
+
+
+@pytest.fixture()
+def settings():
+    original_config = get_config()
+
+    def configure(max_concurrency: int = 64, **tiers):
+        scheduler_config = original_config.scheduler
+        use_config(original_config.copy(update={"scheduler": scheduler_config.copy(update={
+            "max_concurrency": max_concurrency,
+            **{name: getattr(scheduler_config, name).copy(update=changes) for name, changes in tiers.items()}
+        })}))
+
+    yield configure
+    use_config(original_config)
+
+
+def user(balance_in_cents: int, gifted_balance_in_cents: int) -> UserSnapshot:
+    return UserSnapshot(
+        id=1, uuid=uuid.uuid4(), qq_number="10001", wechat_id=None, phone_number=None, email=None, is_banned=False,
+        balance_in_cents=balance_in_cents, gifted_balance_in_cents=gifted_balance_in_cents, billing_rate=100
+    )
+
+
+def test_tier_of():
+    assert tier_of(user(balance_in_cents=300, gifted_balance_in_cents=300)) == "free"
+    assert tier_of(user(balance_in_cents=1300, gifted_balance_in_cents=300)) == "paid"
+    assert tier_of(user(balance_in_cents=0, gifted_balance_in_cents=0)) == "free"
+
+
+async def test_weighted_fair_share(settings):
+    settings(max_concurrency=1, paid={"weight": 3}, free={"weight": 1})
+    scheduler = Scheduler()
+    held = await scheduler.acquire("paid")
+
+    served = []
+
+    async def call(tier: str):
+        slot = await scheduler.acquire(tier)
+        served.append(tier)
+        await asyncio.sleep(0)
+        slot.release()
+
+    tasks = [asyncio.create_task(call(tier)) for tier in ["free"] * 8 + ["paid"] * 8]
+    await asyncio.sleep(0)
+    held.release()
+    await asyncio.gather(*tasks)
+    assert served[:8].count("paid") == 6
+    assert sorted(served) == ["free"] * 8 + ["paid"] * 8
+
+
+async def test_tier_concurrency_cap(settings):
+    settings(max_concurrency=10, free={"max_concurrency": 2, "max_queue_time_in_seconds": 1})
+    scheduler = Scheduler()
+    slots = [await scheduler.acquire("free"), await scheduler.acquire("free")]
+    waiting = asyncio.create_task(scheduler.acquire("free"))
+    await asyncio.sleep(0)
+    assert not waiting.done()
+    assert scheduler.tiers["free"].queued == 1
+
+    (await scheduler.acquire("paid")).release()
+    slots[0].release()
+    (await waiting).release()
+    assert scheduler.inflight == 1
+
+
+async def test_load_shedding(settings):
+    settings(max_concurrency=1, free={"max_queue_time_in_seconds": 0.05})
+    scheduler = Scheduler()
+    held = await scheduler.acquire("free")
+
+    with pytest.raises(Overloaded) as e:
+        await scheduler.acquire("free")
+    assert e.value.reason == "timeout"
+    assert scheduler.tiers["free"].queued == 0
+
+    # a slot is held for a second on average, the queue cannot clear within the SLO
+    scheduler.tiers["free"].hold_time = 1.
+    with pytest.raises(Overloaded) as e:
+        await scheduler.acquire("free")
+    assert e.value.reason == "estimate"
+    assert scheduler.tiers["free"].shed == {"estimate": 1, "timeout": 1}
+    held.release()
+    (await scheduler.acquire("free")).release()
+
+
+async def test_metrics():
+    from app.services.scheduler import scheduler
+    scheduler.register_metrics()
+    scheduler.register_metrics()
+    assert sum(family is scheduler.queue_wait for family in metrics.families) == 1
+    async with scheduler.slot(user(balance_in_cents=1000, gifted_balance_in_cents=0)):
+        rendered = metrics.render()
+        assert 'scheduler_inflight{tier="paid"} 1' in rendered
+        assert 'scheduler_queue_depth{tier="free"} 0' in rendered
+    rendered = metrics.render()
+    assert 'scheduler_inflight{tier="paid"} 0' in rendered
+    assert 'scheduler_queue_wait_seconds_count{tier="paid"}' in rendered
+    assert 'scheduler_shed_total{tier="free",reason="timeout"}' in rendered
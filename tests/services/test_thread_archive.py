@@ -0,0 +1,129 @@
+import os
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import select, func
+
+from app.config import get_config, use_config
+from app.database.connector import sessionmanager
+from app.database.models.thread import Thread
+from app.database.models.thread_message import ThreadMessage
+from app.services.thread_archive import ThreadArchive, ArchiveError, encode, thread_archive
+from tests.clean_db import clean_db
+
+MESSAGES = [("system", "You are a helpful AI assistant."), ("user", "你好，帮我写一首关于春天的诗"),
+            ("assistant", "春风拂面柳丝长，" * 50), ("user", "")]
+
+
+@pytest.fixture()
+def archive(tmp_path):
+    original_config = get_config()
+    use_config(original_config.copy(update={"archive": original_config.archive.copy(update={
+        "directory": str(tmp_path)
+    })}))
+    archive = ThreadArchive()
+    yield archive
+    archive.close()
+    thread_archive.close()
+    use_config(original_config)
+
+
+async def create_thread(session, messages=MESSAGES, idle_days: int = 0) -> Thread:
+    thread = Thread()
+    session.add(thread)
+    await session.flush()
+    for role, content in messages:
+        await thread.add_message(session=session, role=role, content=content)
+    thread.last_active_time = datetime.utcnow() - timedelta(days=idle_days)
+    await session.commit()
+    return thread
+
+
+async def live_messages(session, thread: Thread) -> int:
+    return await session.scalar(select(func.count()).where(ThreadMessage.thread_id == thread.id))
+
+
+async def test_archive_and_resume(clean_db, archive):
+    async with sessionmanager.session() as session:
+        idle = await create_thread(session, idle_days=40)
+        active = await create_thread(session, idle_days=1)
+
+        assert await archive.archive_idle(session=session, idle_days=30) == 1
+        assert idle.archived and not active.archived
+        assert await live_messages(session, idle) == 0
+        assert await live_messages(session, active) == len(MESSAGES)
+
+        assert archive.read_message(idle, 2) == MESSAGES[2]
+        assert archive.read_message(idle, 3) == MESSAGES[3]
+        with pytest.raises(IndexError):
+            archive.read_message(idle, len(MESSAGES))
+
+        await archive.resume(session=session, thread=idle)
+        assert not idle.archived
+        assert [(m.role, m.content) for m in await idle.get_messages(session=session)] == MESSAGES
+        await idle.add_message(session=session, role="user", content="继续")
+        assert idle.message_count == len(MESSAGES) + 1
+
+        # archived threads come back on their own
+        assert await archive.archive_idle(session=session, idle_days=0) == 2
+        assert [(m.role, m.content) for m in await active.get_messages(session=session)] == MESSAGES
+        await idle.add_message(session=session, role="user", content="还在吗")
+        assert not idle.archived and idle.message_count == len(MESSAGES) + 2
+
+
+async def test_concurrent_archivers(clean_db, archive):
+    async with sessionmanager.session() as session:
+        await create_thread(session, idle_days=40)
+        await create_thread(session, idle_days=40)
+    # another worker picked the same idle threads before this one archived them
+    async with sessionmanager.session() as session:
+        [stale, changed] = await Thread.get_idle(session=session, before=datetime.utcnow(), limit=10)
+        messages = await changed.get_messages(session=session)
+
+    async with sessionmanager.session() as session:
+        [thread, live] = await Thread.get_idle(session=session, before=datetime.utcnow(), limit=10)
+        assert await archive.archive(session=session, thread=thread)
+        await live.add_message(session=session, role="user", content="!")
+        await session.commit()
+
+    async with sessionmanager.session() as session:
+        session.add_all([stale, changed])
+        assert not await archive.archive(session=session, thread=stale)
+        assert (stale.archive_file, stale.archive_offset) == (thread.archive_file, thread.archive_offset)
+        # a message added after the snapshot was read keeps the thread live
+        assert not await changed.mark_archived(session=session, file=thread.archive_file, offset=5, length=1,
+                                               message_count=len(messages))
+        assert not changed.archived and await live_messages(session, changed) == len(MESSAGES) + 1
+
+        assert [(m.role, m.content) for m in await stale.get_messages(session=session)] == MESSAGES
+
+
+async def test_files(clean_db, archive):
+    original_config = get_config()
+    use_config(original_config.copy(update={"archive": original_config.archive.copy(update={"max_file_bytes": 100})}))
+    try:
+        async with sessionmanager.session() as session:
+            threads = [await create_thread(session, idle_days=40) for _ in range(3)]
+            assert await archive.archive_idle(session=session, idle_days=30) == 3
+    finally:
+        use_config(original_config)
+
+    assert sorted(os.listdir(archive.directory)) == ["threads-000000.bin", "threads-000001.bin", "threads-000002.bin"]
+    assert [thread.archive_offset for thread in threads] == [5, 5, 5]
+    assert all(archive.read_messages(thread) == MESSAGES for thread in threads)
+
+    # appended to after it was mapped
+    record = encode([("user", "hi")])
+    name, offset = archive.write(record)
+    assert archive.read_message(Thread(archive_file=name, archive_offset=offset, archive_length=len(record)), 0) \
+        == ("user", "hi")
+
+    path = os.path.join(archive.directory, threads[0].archive_file)
+    with open(path, "r+b") as f:
+        f.seek(threads[0].archive_offset + 20)
+        byte = f.read(1)
+        f.seek(-1, os.SEEK_CUR)
+        f.write(bytes([byte[0] ^ 0xFF]))
+    archive.close()
+    with pytest.raises(ArchiveError):
+        archive.read_messages(threads[0])
@@ -0,0 +1,238 @@
+import asyncio
+import contextlib
+import time
+from urllib.parse import urlsplit
+
+import pytest
+
+from app.config import get_config, use_config, OpenAIKeyConfig
+from app.services.upstream_pool import UpstreamPool, Lease, parse_duration
+
+
+class FakeOpenAI:
+    """
+    Answers every request with x-ratelimit-* headers, 429 once a key is out of requests, 500 for failing keys and
+    401 for revoked ones
+    """
+
+    def __init__(self, limits: dict[str, int], reset_in_seconds: float = 0.1):
+        self.limits = limits
+        self.remaining = dict(limits)
+        self.reset_in_seconds = reset_in_seconds
+        self.reset_at = {key: 0. for key in limits}
+        self.failing: set[str] = set()
+        self.revoked: set[str] = set()
+        self.requests: list[str] = []
+        self.endpoint = ""
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        lines = (await reader.readuntil(b"\r\n\r\n")).decode().split("\r\n")
+        headers = dict(line.split(": ", 1) for line in lines[1:] if line)
+        key = headers["Authorization"].removeprefix("Bearer ")
+        self.requests.append(key)
+
+        now = time.monotonic()
+        if now >= self.reset_at[key]:
+            self.remaining[key] = self.limits[key]
+            self.reset_at[key] = now + self.reset_in_seconds
+        response_headers = {
+            "x-ratelimit-limit-requests": self.limits[key],
+            "x-ratelimit-reset-requests": f"{int((self.reset_at[key] - now) * 1000)}ms",
+        }
+        if key in self.failing:
+            status, response_headers = 500, {}
+        elif key in self.revoked:
+            status, response_headers = 401, {}
+        elif self.remaining[key] <= 0:
+            status = 429
+            response_headers["x-ratelimit-remaining-requests"] = 0
+            response_headers["retry-after"] = f"{self.reset_at[key] - now:.3f}"
+        else:
+            status = 200
+            self.remaining[key] -= 1
+            response_headers["x-ratelimit-remaining-requests"] = self.remaining[key]
+
+        head = "".join(f"{name}: {value}\r\n" for name, value in response_headers.items())
+        writer.write(f"HTTP/1.1 {status} X\r\n{head}Content-Length: 0\r\nConnection: close\r\n\r\n".encode())
+        await writer.drain()
+        writer.close()
+
+
+@contextlib.asynccontextmanager
+async def serve(limits: dict[str, int], reset_in_seconds: float = 0.1):
+    fake = FakeOpenAI(limits, reset_in_seconds)
+    server = await asyncio.start_server(fake.handle, "127.0.0.1", 0)
+    fake.endpoint = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}/v1"
+    async with server:
+        yield fake
+
+
+async def call(lease: Lease) -> int:
+    url = urlsplit(lease.api_endpoint)
+    reader, writer = await asyncio.open_connection(url.hostname, url.port)
+    writer.write(f"POST {url.path}/chat/completions HTTP/1.1\r\nHost: {url.netloc}\r\n"
+                 f"Authorization: Bearer {lease.api_key}\r\nContent-Length: 0\r\n\r\n".encode())
+    await writer.drain()
+    lines = (await reader.readuntil(b"\r\n\r\n")).decode().split("\r\n")
+    writer.close()
+    await writer.wait_closed()
+    status = int(lines[0].split()[1])
+    lease.report(status, dict(line.split(": ", 1) for line in lines[1:] if line))
+    return status
+
+
+def make_pool(fake: FakeOpenAI, **kwargs) -> UpstreamPool:
+    return UpstreamPool(keys=[(key, fake.endpoint) for key in fake.limits], **kwargs)
+
+
+async def request(pool: UpstreamPool, **kwargs) -> int:
+    async with pool.lease(**kwargs) as lease:
+        return await call(lease)
+
+
+def test_parse_duration():
+    assert parse_duration("20ms") == pytest.approx(0.02)
+    assert parse_duration("6m0s") == 360
+    assert parse_duration("1h2m3.5s") == 3723.5
+    assert parse_duration("2") == 2
+    assert parse_duration("soon") is None
+    assert parse_duration(None) is None
+
+
+async def test_most_headroom():
+    async with serve({"sk-a": 4, "sk-b": 40}, reset_in_seconds=60) as fake:
+        pool = make_pool(fake)
+        # two requests in flight go to different keys
+        assert await asyncio.gather(request(pool), request(pool)) == [200, 200]
+        assert sorted(fake.requests) == ["sk-a", "sk-b"]
+
+        for _ in range(5):
+            assert await request(pool) == 200
+        assert fake.requests[2:] == ["sk-b"] * 5
+
+
+async def test_rate_limited_key_skipped_until_reset():
+    async with serve({"sk-a": 1, "sk-b": 5}, reset_in_seconds=0.3) as fake:
+        fake.remaining["sk-a"] = 0
+        fake.reset_at["sk-a"] = time.monotonic() + 0.3
+        pool = make_pool(fake)
+
+        assert await request(pool) == 429
+        assert await request(pool) == 200
+        assert fake.requests == ["sk-a", "sk-b"]
+        assert pool.keys[0].failures == 0
+
+        await asyncio.sleep(0.35)
+        assert await request(pool) == 200
+        assert fake.requests[-1] == "sk-a"
+
+
+async def test_queued_until_reset():
+    async with serve({"sk-a": 1}, reset_in_seconds=0.2) as fake:
+        pool = make_pool(fake)
+        assert await request(pool) == 200
+
+        start = time.monotonic()
+        assert await request(pool, timeout=2) == 200
+        assert time.monotonic() - start >= 0.15
+
+
+async def test_circuit_breaker():
+    async with serve({"sk-a": 100, "sk-b": 100}, reset_in_seconds=60) as fake:
+        fake.failing.add("sk-a")
+        pool = make_pool(fake, failure_threshold=2, cooldown_in_seconds=0.2)
+        key_a = pool.keys[0]
+
+        for _ in range(4):
+            await request(pool)
+        assert fake.requests == ["sk-a", "sk-a", "sk-b", "sk-b"]
+        assert key_a.trips == 1
+
+        # back from the cooldown, a single probe fails and the cooldown doubles
+        await asyncio.sleep(0.25)
+        first, second = await pool.acquire(), await pool.acquire()
+        assert (first.key, second.key) == (key_a, pool.keys[1])
+        second.release()
+        assert await call(first) == 500
+        first.release()
+        assert key_a.unavailable_until - time.monotonic() == pytest.approx(0.4, abs=0.05)
+
+        fake.failing.clear()
+        await asyncio.sleep(0.45)
+        assert await request(pool) == 200
+        assert fake.requests[-1] == "sk-a"
+        assert key_a.trips == 0
+
+
+async def test_revoked_key_benched_at_once():
+    async with serve({"sk-a": 100, "sk-b": 50}, reset_in_seconds=60) as fake:
+        fake.revoked.add("sk-a")
+        pool = make_pool(fake, failure_threshold=3, cooldown_in_seconds=60)
+
+        assert [await request(pool) for _ in range(3)] == [401, 200, 200]
+        assert fake.requests == ["sk-a", "sk-b", "sk-b"]
+        assert pool.keys[0].trips == 1
+
+
+async def test_priority_when_saturated():
+    async with serve({"sk-a": 1}, reset_in_seconds=0.1) as fake:
+        pool = make_pool(fake)
+        assert await request(pool) == 200
+
+        served = []
+
+        async def queued(priority: int):
+            async with pool.lease(priority=priority, timeout=2) as lease:
+                served.append(priority)
+                await call(lease)
+
+        tasks = []
+        for priority in (5, 1, 3):
+            tasks.append(asyncio.create_task(queued(priority)))
+            await asyncio.sleep(0)
+        assert pool.queued == 3
+        await asyncio.gather(*tasks)
+        assert served == [1, 3, 5]
+
+
+async def test_queue_timeout_and_failure_on_exception():
+    async with serve({"sk-a": 1}, reset_in_seconds=10) as fake:
+        pool = make_pool(fake)
+        assert await request(pool) == 200
+        with pytest.raises(TimeoutError):
+            await pool.acquire(timeout=0.05)
+        assert pool.queued == 0
+
+    pool = UpstreamPool(keys=[("sk-c", "http://127.0.0.1:9/v1")])
+    with pytest.raises(ConnectionError):
+        async with pool.lease():
+            raise ConnectionError()
+    assert pool.keys[0].failures == 1
+    assert pool.keys[0].inflight == 0
+
+
+def test_keys_follow_config():
+    original_config = get_config()
+    pool = UpstreamPool()
+    try:
+        use_config(original_config.copy(update={"openai": original_config.openai.copy(update={
+            "api_key": "sk-main", "keys": [OpenAIKeyConfig(api_key="sk-extra", api_endpoint="http://proxy/v1")]
+        })}))
+        assert [key.name for key in pool.keys] == [f"{original_config.openai.api_endpoint} ...main",
+                                                   "http://proxy/v1 ...xtra"]
+        extra = pool.keys[1]
+        extra.failures = 1
+
+        use_config(original_config.copy(update={"openai": original_config.openai.copy(update={
+            "api_key": None, "keys": [OpenAIKeyConfig(api_key="sk-extra", api_endpoint="http://proxy/v1")]
+        })}))
+        assert pool.keys == [extra]
+        assert extra.failures == 1
+    finally:
+        use_config(original_config)
+
+
+def test_explicit_limits_override_config():
+    pool = UpstreamPool(keys=[("sk-a", "http://a/v1")], failure_threshold=0, cooldown_in_seconds=0)
+    assert (pool.failure_threshold, pool.cooldown_in_seconds) == (0, 0)
+    assert UpstreamPool(keys=[]).failure_threshold == get_config().openai.key_failure_threshold
@@ -0,0 +1,137 @@
+import asyncio
+import dataclasses
+import uuid
+
+import pytest
+from fastapi import HTTPException, Request
+from sqlalchemy import event
+
+from app.database.connector import sessionmanager
+from app.database.models.user import User
+from app.endpoints.dependencies import load_user, current_user
+from app.services.user_cache import UserSnapshot, UserSnapshotCache, user_snapshots
+from app.services.user_resolver import resolve_snapshot
+from tests.clean_db import clean_db
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+
+def snapshot(id: int = 1, **changes) -> UserSnapshot:
+    values = dict(
+        id=id, uuid=uuid.uuid4(), qq_number=str(10_000 + id), wechat_id=None, phone_number=None, email=None,
+        is_banned=False, balance_in_cents=300, gifted_balance_in_cents=300, billing_rate=100
+    )
+    return UserSnapshot(**{**values, **changes})
+
+
+def test_snapshot_is_immutable():
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        snapshot().balance_in_cents = 0
+    assert not hasattr(snapshot(), "__dict__")
+
+
+def test_lookup_and_expiry():
+    clock = FakeClock()
+    cache = UserSnapshotCache(clock=clock)
+    cached = snapshot()
+    cache.put(cached, cache.generation)
+
+    assert cache.get(id=1) is cached
+    assert cache.get(qq_number="10001") is cached
+    assert cache.get(uuid=str(cached.uuid).upper()) is cached
+    assert cache.get(id=1, qq_number="10002") is None
+    assert cache.get(email="nobody@example.com") is None
+
+    clock.now = 3600
+    assert cache.get(id=1) is None
+    assert len(cache) == 0
+
+
+def test_stale_read_not_stored():
+    cache = UserSnapshotCache()
+    generation = cache.generation
+    cache.invalidate(1)  # a balance change committed while the snapshot was being read
+    cache.put(snapshot(), generation)
+    assert cache.get(id=1) is None
+
+
+def test_other_users_invalidation_keeps_read():
+    cache = UserSnapshotCache()
+    generation = cache.generation
+    cache.invalidate(2)  # another user was charged meanwhile
+    cached = snapshot()
+    cache.put(cached, generation)
+    assert cache.get(id=1) is cached
+
+    generation = cache.generation
+    cache.clear()
+    cache.put(snapshot(), generation)
+    assert cache.get(id=1) is None
+
+
+async def test_get_snapshot_and_invalidation(clean_db):
+    async with sessionmanager.session() as session:
+        user = await User.create_with_invite_code(session=session, qq_number="1234567")
+        cached = await User.get_snapshot(session=session, qq_number="1234567")
+        assert cached.id == user.id
+        assert cached.balance_in_cents == user.balance_in_cents
+        assert user_snapshots.get(qq_number="1234567") is cached
+
+        await user.pay(session=session, amount=100)
+        assert user_snapshots.get(id=user.id) is None
+        assert (await User.get_snapshot(session=session, id=user.id)).balance_in_cents == user.balance_in_cents
+
+        await user.ban(session=session)
+        assert user_snapshots.get(id=user.id) is None
+        assert (await User.get_snapshot(session=session, id=user.id)).is_banned
+
+
+def make_request(**query) -> Request:
+    query_string = "&".join(f"{name}={value}" for name, value in query.items())
+    return Request({"type": "http", "method": "GET", "path": "/v1", "query_string": query_string.encode(),
+                    "headers": []})
+
+
+async def test_load_user(clean_db):
+    async with sessionmanager.session() as session:
+        user = await User.create_with_invite_code(session=session, qq_number="7654321")
+        user_id = user.id
+
+    request = make_request(qq_number="7654321")
+    await load_user(request)
+    assert (await current_user(request)).id == user_id
+    assert user_snapshots.get(id=user_id) is request.state.user
+
+    anonymous = make_request()
+    await load_user(anonymous)
+    with pytest.raises(HTTPException) as e:
+        await current_user(anonymous)
+    assert e.value.status_code == 401
+
+    user_snapshots.put(dataclasses.replace(request.state.user, is_banned=True), user_snapshots.generation)
+    with pytest.raises(HTTPException) as e:
+        await load_user(make_request(qq_number="7654321"))
+    assert e.value.status_code == 403
+
+
+async def test_concurrent_misses_share_a_query(clean_db):
+    async with sessionmanager.session() as session:
+        for n in range(3):
+            await User.create_with_invite_code(session=session, qq_number=str(555_000 + n))
+
+    selects = []
+    listener = lambda conn, cursor, statement, *args: selects.append(statement)
+    event.listen(sessionmanager.engine.sync_engine, "before_cursor_execute", listener)
+    try:
+        snapshots = await asyncio.gather(*[resolve_snapshot(qq_number=str(555_000 + n)) for n in (0, 1, 2, 0)])
+    finally:
+        event.remove(sessionmanager.engine.sync_engine, "before_cursor_execute", listener)
+    assert [snapshot.qq_number for snapshot in snapshots] == ["555000", "555001", "555002", "555000"]
+    assert len([statement for statement in selects if statement.startswith("SELECT")]) == 1
+    assert await resolve_snapshot(qq_number="555001", email="other@example.com") is None
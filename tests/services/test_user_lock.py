@@ -0,0 +1,119 @@
+import asyncio
+import os
+import random
+import tempfile
+
+import pytest
+from sqlalchemy import select
+
+from app.config import hot_config
+from app.database.connector import DatabaseSessionManager
+from app.database.migrations import migrate
+from app.database.models.user import User
+from app.database.unit_of_work import unit_of_work
+from app.services.user_lock import UserLocks, user_locks
+
+
+class FakeSession:
+    def __init__(self):
+        self.info = {}
+
+
+async def test_different_users_do_not_wait():
+    locks = UserLocks(stripes=8)
+    async with locks.hold(FakeSession(), 1):
+        async with locks.hold(FakeSession(), 2):
+            assert locks.locked(1) and locks.locked(2)
+    assert not locks.locked(1) and not locks.locked(2)
+
+
+async def test_reentrant_per_session():
+    locks = UserLocks(stripes=8)
+    session = FakeSession()
+    async with locks.hold(session, 1, 9):  # same stripe
+        async with locks.hold(session, 1):
+            assert locks.locked(1)
+        assert locks.locked(1)
+    assert not locks.locked(1)
+
+
+async def test_first_come_first_served():
+    locks = UserLocks(stripes=8)
+    order = []
+
+    async def waiter(n):
+        async with locks.hold(FakeSession(), 1):
+            order.append(n)
+            await asyncio.sleep(0)
+
+    async with locks.hold(FakeSession(), 1):
+        tasks = []
+        for n in range(5):
+            tasks.append(asyncio.create_task(waiter(n)))
+            await asyncio.sleep(0)
+    await asyncio.gather(*tasks)
+    assert order == list(range(5))
+
+
+async def test_held_until_unit_of_work_ends():
+    locks = UserLocks(stripes=8)
+    manager = DatabaseSessionManager(host="sqlite+aiosqlite://")
+    async with manager.session() as session:
+        async with unit_of_work(session):
+            async with locks.hold(session, 1):
+                pass
+            assert locks.locked(1)
+        assert not locks.locked(1)
+    await manager.close()
+
+
+@pytest.fixture()
+async def manager():
+    with tempfile.TemporaryDirectory() as tmp:
+        manager = DatabaseSessionManager(host=f"sqlite+aiosqlite:///{os.path.join(tmp, 'locks.db')}")
+        await migrate(manager.engine)
+        yield manager
+        await manager.close()
+
+
+async def test_balances_conserved_under_contention(manager):
+    async with manager.session() as session:
+        inviter = await User.create_with_invite_code(session=session, email="inviter@example.com")
+        users = [inviter] + [
+            await User.create_with_invite_code(session=session, email=f"{n}@example.com") for n in range(3)
+        ]
+        for user in users[1:]:
+            user.inviter_id = inviter.id
+        await session.commit()
+        ids = [user.id for user in users]
+        expected = {user.id: user.balance_in_cents for user in users}
+
+    hot = hot_config()
+    random.seed(0)
+
+    async def operation(n):
+        user_id = random.choice(ids)
+        amount = random.randint(1, 500)
+        async with manager.session() as session, unit_of_work(session):
+            user = await User.get(session=session, id=user_id)
+            await asyncio.sleep(0)  # let others load the same user
+            if n % 2:
+                await user.pay(session=session, amount=amount)
+                return user_id, -amount, None, 0
+            await user.charge(session=session, amount=amount)
+            if not hot.cash_back_when_invitee_charges:
+                return user_id, amount, None, 0
+            cash_back = int(hot.inviter_cash_back_amount_when_invitee_charges_percent * amount)
+            return user_id, amount, user.inviter_id, cash_back
+
+    # without the locks most of these fail, or silently overwrite each other's balance
+    results = await asyncio.gather(*[operation(n) for n in range(200)])
+    for user_id, delta, inviter_id, cash_back in results:
+        expected[user_id] += delta
+        if inviter_id:
+            expected[inviter_id] += cash_back
+
+    async with manager.session() as session:
+        rows = await session.execute(select(User.id, User.balance_in_cents).where(User.id.in_(ids)))
+        assert dict(rows.all()) == expected
+        assert not any(user_locks.locked(user_id) for user_id in ids)
@@ -1,7 +1,8 @@
 import os
 import tempfile
+import pytest
 import toml
-from app.config import Config
+from app.config import Config, config, get_config, hot_config, reload_config, use_config
 from loguru import logger
 
 logger.remove()  # 移除默认的logger，以避免在测试中打印日志
@@ -58,3 +59,35 @@ def test_load_config():
     # 清理：删除临时文件，并恢复 Config 类的原始方法
     os.remove(temp_config_path)
     Config.load_config = original_load_config_method
+
+
+def test_load_gbk_config():
+    prompt = "你是一个有用的人工智能助手，默认使用中文回答用户的问题。"
+    temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".toml")
+    with open(temp_file.name, 'wb') as file:
+        file.write(f'[openai.gpt_config]\nbase_system_prompt = "{prompt}"\n'.encode("gbk"))
+
+    # not valid UTF-8, falls back to encoding detection
+    loaded_config = Config.read(temp_file.name)
+    assert loaded_config.openai.gpt_config.base_system_prompt == prompt
+    os.remove(temp_file.name)
+
+
+def test_reload_config():
+    original_config = get_config()
+    temp_config_path = create_temp_config_file({"billing": {"balance_in_cents": 1234}})
+    try:
+        assert reload_config(temp_config_path)
+        assert config.billing.balance_in_cents == 1234
+        assert hot_config().default_balance_in_cents == 1234
+
+        # snapshots are immutable, a broken file keeps the current one
+        with pytest.raises(TypeError):
+            config.billing.balance_in_cents = 1
+        with open(temp_config_path, 'w') as file:
+            file.write("[billing]\nbalance_in_cents = 'not a number'\n")
+        assert not reload_config(temp_config_path)
+        assert config.billing.balance_in_cents == 1234
+    finally:
+        use_config(original_config)
+        os.remove(temp_config_path)
@@ -0,0 +1,35 @@
+from app.main import app, mount_routes, on_startup
+from tests.clean_db import clean_db
+
+
+async def get(path: str) -> tuple[int, str]:
+    status, body = 0, b""
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        nonlocal status, body
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body":
+            body += message.get("body", b"")
+
+    await app({
+        "type": "http", "method": "GET", "path": path, "raw_path": path.encode(), "query_string": b"",
+        "headers": [], "client": ("127.0.0.1", 50000), "server": ("test", 80), "scheme": "http",
+        "root_path": "", "http_version": "1.1",
+    }, receive, send)
+    return status, body.decode()
+
+
+async def test_scheduler_metrics_scraped(clean_db):
+    await on_startup()
+    mount_routes(app)
+
+    status, body = await get("/metrics")
+    assert status == 200
+    for family in ("scheduler_queue_wait_seconds", "scheduler_queue_depth", "scheduler_inflight",
+                   "scheduler_shed_total"):
+        assert f"# TYPE {family} " in body
+    assert 'scheduler_queue_depth{tier="paid"} 0' in body